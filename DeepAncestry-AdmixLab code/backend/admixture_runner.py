@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+admixture_runner.py – تشغيل ADMIXTURE لكذا K بالتوازي بميزانية cores مشتركة
+
+كل K في مجلد لوحده (ADMIXTURE بيكتب في الـ cwd)، و -j لكل K = نصيبه من الـ cores.
+projection mode (-P) بيقرأ <base>.K.P.in ويحسب Q للـ kit بس.
+"""
+
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import genotype_io
+import stage_metrics
+
+ADMIXTURE_PATH = "admixture"
+ADMIXTURE_KS = [5, 8, 10, 13]
+
+
+def split_cores(n_jobs, budget=None):
+    """(عدد الـ K اللي بتشتغل مع بعض, threads لكل واحد)."""
+    budget = budget or os.cpu_count() or 4
+    parallel = max(1, min(n_jobs, budget))
+    return parallel, max(1, budget // parallel)
+
+
+def _link(src, dst):
+    dst = Path(dst)
+    if dst.is_symlink() or dst.exists():
+        dst.unlink()
+    dst.symlink_to(Path(src).resolve())
+
+
+def run_admixture_k(bfile, k, work_dir, threads, p_file=None):
+    """يشغّل K واحد في work_dir/K<k>؛ يرجّع مسارات .Q و .P الناتجة."""
+    work = Path(work_dir) / f"K{k}"
+    work.mkdir(parents=True, exist_ok=True)
+    base = Path(bfile).name
+    for ext in genotype_io.PLINK_EXTENSIONS:
+        _link(f"{bfile}{ext}", work / f"{base}{ext}")
+
+    if p_file:
+        _link(p_file, work / f"{base}.{k}.P.in")
+        cmd = [ADMIXTURE_PATH, "-P", f"{base}.bed", str(k), f"-j{threads}"]
+    else:
+        cmd = [ADMIXTURE_PATH, "--cv", "--acceleration", f"{base}.bed", str(k), f"-j{threads}"]
+
+    with open(work / "admixture.log", "w") as out:
+        stage_metrics.run_tool(cmd, cwd=work, stdout=out, stderr=subprocess.STDOUT)
+    return work / f"{base}.{k}.Q", work / f"{base}.{k}.P"
+
+
+def run_admixture_jobs(bfile, ks, work_dir, p_files=None, budget=None):
+    """كل الـ K مع بعض؛ p_files = {k: مسار .P} للـ projection mode. يرجّع {k: (Q, P)}."""
+    p_files = p_files or {}
+    parallel, threads = split_cores(len(ks), budget)
+    # الشغل الحقيقي في processes الـ admixture نفسها – الـ threads هنا بس بتستناها
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        futures = {k: pool.submit(run_admixture_k, bfile, k, work_dir, threads, p_files.get(k)) for k in ks}
+        return {k: fut.result() for k, fut in futures.items()}
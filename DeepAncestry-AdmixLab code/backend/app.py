@@ -3,41 +3,52 @@
 """
 DeepAncestry™ AdmixLab – ULTRA HONEST SUPER POWER 2026 Ultimate Edition
 (Real Honest Results – No Fake – AADR/G25 + qpAdm Transparent – Full Pipeline)
+
+الـ web بس: الإعدادات في settings.py، الجداول في models.py، والـ Celery tasks في tasks.py
+(celery -A tasks.celery worker). الـ pipeline (process_dna / cohort_batch) مابيتعملهوش import هنا، والـ modules
+اللي بتشيل numpy / celery (kit_results، population_engine، tasks …) بتتعمل import جوه الـ routes اللي محتاجاها بس.
 """
 
-from flask import Flask, request, render_template, redirect, url_for, flash, jsonify, send_from_directory
-from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
+from flask import (Flask, request, render_template, redirect, url_for, flash, jsonify, send_from_directory,
+                   Response, abort)
+from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from flask_wtf import FlaskForm
 from wtforms import FileField, SubmitField
 from wtforms.validators import DataRequired
 from flask_wtf.csrf import CSRFProtect
-from flask_sqlalchemy import SQLAlchemy
-from celery import Celery
-from dotenv import load_dotenv
+from sqlalchemy import and_, or_
 import os
+import json
 import uuid
-import re
-from datetime import datetime, timedelta
-from pathlib import Path
-import numpy as np
-from scipy.spatial.distance import cosine
+import base64
+import hashlib
+import hmac
+from datetime import datetime
 import shutil
 import time
 
-load_dotenv()
+import models
+import settings
+from models import DNAKit, User, db
 
-BASE_DIR = Path(__file__).resolve().parent
-PROJECT_ROOT = BASE_DIR.parent
-FRONTEND_DIR = PROJECT_ROOT / "frontend"
-UPLOAD_FOLDER = PROJECT_ROOT / "uploads"
-DATABASE_PATH = 'sqlite:///' + str(PROJECT_ROOT / "users.db")
+# celery -A app.celery لسه شغال: celery و enqueue_kit و process_cohort_batch (للـ scripts اللي بتشغّل الدفعة
+# من app) بيتجابوا من tasks أول ما حد يطلبهم بس (PEP 562) – import app نفسه مابيشيلش celery
+TASKS_EXPORTS = ("celery", "enqueue_kit", "process_cohort_batch")
 
-ALLOWED_EXTENSIONS = {'txt', 'csv', 'vcf', 'gz', 'zip', 'bed', 'bim', 'fam'}
+def __getattr__(name):
+    if name in TASKS_EXPORTS:
+        import tasks
+        return getattr(tasks, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-for folder in [UPLOAD_FOLDER]:
-    folder.mkdir(parents=True, exist_ok=True)
+FRONTEND_DIR = settings.FRONTEND_DIR
+UPLOAD_FOLDER = settings.UPLOAD_FOLDER
+
+ALLOWED_EXTENSIONS = {'txt', 'csv', 'vcf', 'gz', 'zip', 'bed', 'bim', 'fam'}
+# .bed/.bim/.fam لوحدهم مينفعوش في الـ chunked upload (ملف واحد) – يترفعوا zip
+PLINK_SINGLE_FILES = ('.bed', '.bim', '.fam')
 
 app = Flask(__name__,
             template_folder=str(FRONTEND_DIR),
@@ -48,44 +59,17 @@ app.config['UPLOAD_FOLDER'] = str(UPLOAD_FOLDER)
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024 * 1024  # 10GB
 app.config['SESSION_COOKIE_SAMESITE'] = "Strict"
 app.config['SESSION_COOKIE_SECURE'] = False
-app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_PATH
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['CELERY_BROKER_URL'] = 'redis://localhost:6379/0'
-app.config['CELERY_RESULT_BACKEND'] = 'redis://localhost:6379/0'
+app.config['METRICS_TOKEN'] = settings.METRICS_TOKEN
 
 csrf = CSRFProtect(app)
-db = SQLAlchemy(app)
-
-celery = Celery(app.name, broker=app.config['CELERY_BROKER_URL'])
-celery.conf.update(app.config)
+models.configure(app)
 
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = "login"
 
-# Models
-class User(db.Model, UserMixin):
-    id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(255), unique=True, nullable=False)
-    name = db.Column(db.String(255), nullable=False)
-    password_hash = db.Column(db.String(255), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    last_login = db.Column(db.DateTime)
-
-class DNAKit(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    kit_id = db.Column(db.String(255), unique=True, nullable=False)
-    original_filename = db.Column(db.String(255))
-    status = db.Column(db.String(50), default='queued')
-    progress = db.Column(db.Integer, default=0)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    finished_at = db.Column(db.DateTime)
-    error_message = db.Column(db.Text)
-
 def init_db():
-    with app.app_context():
-        db.create_all()
+    models.init_db(app)
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -100,49 +84,89 @@ class UploadDNAForm(FlaskForm):
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def extract_p_value(qpAdm_path):
-    if not qpAdm_path.exists():
-        return None
-    try:
-        content = qpAdm_path.read_text(encoding='utf-8', errors='replace')
-        match = re.search(r"p-value\s+([\d.eE+-]+)", content, re.IGNORECASE)
-        if match:
-            return float(match.group(1))
-    except Exception as e:
-        print(f"خطأ في استخراج p-value: {e}")
-    return None
-
-@celery.task(bind=True)
-def start_background_processing(self, filepath: str, kit_id: str):
-    kit_dir = UPLOAD_FOLDER / kit_id
-    log_path = kit_dir / f"{kit_id}_process.log"
-    log_path.parent.mkdir(parents=True, exist_ok=True)
-    
-    with open(log_path, 'a', encoding='utf-8') as log:
-        log.write(f"[{datetime.now()}] بدء المعالجة لـ {kit_id}\n")
-    
-    # هنا شغل process_dna.py الحقيقي (استبدل بالمسار الصحيح)
-    # subprocess.call([sys.executable, str(BASE_DIR / "process_dna.py"), filepath, kit_id])
-    
-    # محاكاة للاختبار (استبدلها لاحقًا)
-    for i in range(100):
-        time.sleep(1)  # معالجة طويلة
-        self.update_state(state='PROGRESS', meta={'progress': i+1})
-    
-    with open(log_path, 'a', encoding='utf-8') as log:
-        log.write(f"[{datetime.now()}] انتهت المعالجة بنجاح\n")
-    
-    return {"status": "completed"}
-
-def cleanup_old_kits():
-    old_date = datetime.utcnow() - timedelta(days=30)
-    old_kits = DNAKit.query.filter(DNAKit.created_at < old_date).all()
-    for kit in old_kits:
-        kit_dir = UPLOAD_FOLDER / kit.kit_id
-        if kit_dir.exists():
-            shutil.rmtree(kit_dir)
-        db.session.delete(kit)
-    db.session.commit()
+KITS_PAGE_SIZE = 20
+KITS_PAGE_MAX = 100
+
+def encode_cursor(kit):
+    # keyset: (created_at, id) لآخر kit في الصفحة – الصفحة الجاية من غير OFFSET
+    raw = f"{kit.created_at.isoformat()}|{kit.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    created_at, kit_id = raw.rsplit("|", 1)
+    return datetime.fromisoformat(created_at), int(kit_id)
+
+def kits_page(user_id, limit, cursor=None):
+    """kits المستخدم الأحدث الأول، بعد cursor لو موجود → (kits, في صفحة تانية ولا لأ). ValueError لو الـ cursor بايظ."""
+    query = DNAKit.query.filter_by(user_id=user_id)
+    if cursor:
+        created_at, kit_pk = decode_cursor(cursor)
+        query = query.filter(or_(DNAKit.created_at < created_at,
+                                 and_(DNAKit.created_at == created_at, DNAKit.id < kit_pk)))
+    kits = query.order_by(DNAKit.created_at.desc(), DNAKit.id.desc()).limit(limit + 1).all()
+    return kits[:limit], len(kits) > limit
+
+def kits_etag(user_id, kits, cursor, limit):
+    # من صفوف الـ DB بس: الـ summary بيتغير مع الحالة/الـ panel، فالـ 304 بيتحسب من غير ما نقرا ملفات النتائج
+    import kit_results
+    digest = hashlib.sha256(f"{kit_results.RESULTS_VERSION}|{user_id}|{cursor}|{limit}".encode())
+    for kit in kits:
+        digest.update(f"|{kit.kit_id}:{kit.status}:{kit.progress}:{kit.finished_at}:{kit.panel_version}".encode())
+    return digest.hexdigest()[:32]
+
+def kit_summary(kit):
+    """ملخص الـ kit لقايمة الـ kits؛ المكتمل بياخد best_match/p-value/أول PCs من <kit>_results.json (LRU)."""
+    summary = {
+        "kit_id": kit.kit_id,
+        "filename": kit.original_filename,
+        "status": kit.status,
+        "progress": kit.progress,
+        "created_at": kit.created_at.isoformat() if kit.created_at else None,
+        "finished_at": kit.finished_at.isoformat() if kit.finished_at else None,
+        "error_message": kit.error_message,
+        "panel_version": kit.panel_version,
+    }
+    if kit.status == 'completed':
+        import kit_results
+        try:
+            res = kit_results.load_kit_results(UPLOAD_FOLDER / kit.kit_id, kit.kit_id, kit.panel_version)
+        except (OSError, ValueError) as e:
+            print(f"خطأ في قراءة ملف النتائج لـ {kit.kit_id}: {e}")
+            return summary
+        if res is None:
+            # kit مكتمل ومجلده اتمسح (reaper / مسح يدوي) – الملخص من الـ DB بس
+            return summary
+        summary.update(best_match=res["best_match"], p_value=res["p_value"], is_honest=res["is_honest"],
+                       pc=res["pc_values"][:2])
+    return summary
+
+def relative_token(kit_id, other_kit_id):
+    # معرّف ثابت للزوج ده بس: نفس القريب بيظهر بـ token مختلف من كل kit، ومايتحولش لـ kit_id صاحبه
+    key = app.secret_key if isinstance(app.secret_key, bytes) else app.secret_key.encode()
+    return hmac.new(key, f"relative|{kit_id}|{other_kit_id}".encode(), hashlib.sha256).hexdigest()[:12]
+
+def kit_relatives(kit):
+    """أقارب الـ kit من مخزن الـ genotypes: kits مكتملة لسه موجودة؛ نفس الـ DNA في نفس الحساب (رفع مكرر) مابيظهرش.
+
+    kit_id بيرجع بس لـ kits المستخدم نفسه؛ kit حساب تاني = token للزوج + درجة القرابة والأرقام بس."""
+    import relatives
+    found = relatives.load_relatives(kit.panel_version, kit.kit_id) if kit.status == 'completed' else []
+    if not found:
+        return []
+    owners = dict(db.session.query(DNAKit.kit_id, DNAKit.user_id)
+                  .filter(DNAKit.kit_id.in_([r["kit_id"] for r in found]), DNAKit.status == 'completed').all())
+    listed = []
+    for r in found:
+        if r["kit_id"] not in owners:
+            continue
+        own = owners[r["kit_id"]] == kit.user_id
+        if own and r["degree"] == 0:
+            continue
+        listed.append({**r, "own": own, "kit_id": r["kit_id"] if own else None,
+                       "match_id": r["kit_id"] if own else relative_token(kit.kit_id, r["kit_id"])})
+    return listed
+
 
 # Routes
 @app.route("/")
@@ -192,29 +216,17 @@ def logout():
 @app.route("/dashboard")
 @login_required
 def dashboard():
-    cleanup_old_kits()
-
-    kits = DNAKit.query.filter_by(user_id=current_user.id).order_by(DNAKit.created_at.desc()).limit(10).all()
+    # الـ retention بقى في الـ reaper (celery beat) – الصفحة بتقرا صفحة kits واحدة من الـ index بس
+    kits, _ = kits_page(current_user.id, 10)
 
     heat_points = []
     for kit in kits:
-        if kit.status == 'completed':
-            eigenvec_path = UPLOAD_FOLDER / kit.kit_id / f"{kit.kit_id}_pca.eigenvec"
-            if eigenvec_path.exists():
-                try:
-                    with open(eigenvec_path, 'r', encoding='utf-8', errors='ignore') as f:
-                        for line in f:
-                            if kit.kit_id in line:
-                                parts = line.strip().split()
-                                if len(parts) >= 4:
-                                    pc1 = float(parts[2])
-                                    pc2 = float(parts[3])
-                                    lat = 30 + (pc2 * 10)  # آمن للشرق الأوسط
-                                    lng = 35 + (pc1 * 15)
-                                    heat_points.append([lat, lng, 0.95])
-                                break
-                except Exception as e:
-                    print(f"خطأ PCA: {e}")
+        summary = kit_summary(kit)
+        if any(summary.get("pc") or []):
+            pc1, pc2 = summary["pc"]
+            lat = 30 + (pc2 * 10)  # آمن للشرق الأوسط
+            lng = 35 + (pc1 * 15)
+            heat_points.append([lat, lng, 0.95])
 
     if not heat_points:
         heat_points = [
@@ -241,116 +253,378 @@ def upload():
         if file and allowed_file(file.filename):
             kit_id = f"DA{uuid.uuid4().hex[:10].upper()}"
             kit_dir = UPLOAD_FOLDER / kit_id
-            kit_dir.mkdir(exist_ok=True)
+            kit_dir.mkdir(parents=True, exist_ok=True)
             filename = secure_filename(file.filename)
             filepath = kit_dir / filename
             file.save(filepath)
 
-            kit = DNAKit(user_id=current_user.id, kit_id=kit_id, original_filename=filename, status='processing', progress=0)
+            kit = DNAKit(user_id=current_user.id, kit_id=kit_id, original_filename=filename, status='queued', progress=0)
             db.session.add(kit)
             db.session.commit()
 
-            start_background_processing.delay(str(filepath), kit_id)
+            from tasks import enqueue_kit
+            enqueue_kit(kit)
 
             flash("تم الرفع! التحليل جاري...", "success")
             return jsonify({"success": True, "kit_id": kit_id, "redirect": url_for("results", kit_id=kit_id)})
         flash("ملف غير مدعوم", "error")
     return jsonify({"success": False, "message": "خطأ في الفورم"})
 
-@app.route("/results/<kit_id>")
+# Chunked upload: init → PUT chunk?offset=N (لحد ما الـ offset = الحجم) → finalize؛ الاتصال لو وقع
+# العميل بيسأل /status عن آخر offset مؤكد ويكمل منه
+
+def upload_error(kit, error):
+    if error.reject:
+        shutil.rmtree(UPLOAD_FOLDER / kit.kit_id, ignore_errors=True)
+        db.session.delete(kit)
+        db.session.commit()
+    return jsonify({"success": False, "message": str(error), "offset": error.offset}), error.status
+
+def uploading_kit(kit_id):
+    return DNAKit.query.filter_by(kit_id=kit_id, user_id=current_user.id, status='uploading').first_or_404()
+
+@app.route("/upload/init", methods=["POST"])
 @login_required
-def results(kit_id):
-    kit = DNAKit.query.filter_by(kit_id=kit_id, user_id=current_user.id).first_or_404()
+def upload_init():
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(data.get("filename") or "")
+    size = data.get("size")
+    if not filename or not allowed_file(filename) or filename.lower().endswith(PLINK_SINGLE_FILES):
+        return jsonify({"success": False, "message": "ملف غير مدعوم"}), 415
+    if not isinstance(size, int) or not 0 < size <= app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({"success": False, "message": "حجم الملف غير صالح (الحد الأقصى 10 جيجا)"}), 413
+
+    import chunked_upload
+    kit_id = f"DA{uuid.uuid4().hex[:10].upper()}"
+    chunked_upload.init_upload(UPLOAD_FOLDER / kit_id, filename, size)
+    db.session.add(DNAKit(user_id=current_user.id, kit_id=kit_id, original_filename=filename, status='uploading', progress=0))
+    db.session.commit()
+    return jsonify({"success": True, "kit_id": kit_id, "offset": 0, "chunk_size": chunked_upload.CHUNK_SIZE})
 
-    base_path = UPLOAD_FOLDER / kit_id
-    qpAdm_path = base_path / f"{kit_id}_qpAdm.out"
-    p_value = extract_p_value(qpAdm_path)
-    is_honest = p_value is not None and p_value > 0.05
+@app.route("/upload/<kit_id>/status")
+@login_required
+def upload_status(kit_id):
+    import chunked_upload
+    kit = uploading_kit(kit_id)
+    try:
+        state, offset = chunked_upload.upload_offset(UPLOAD_FOLDER / kit_id)
+    except chunked_upload.UploadError as e:
+        return upload_error(kit, e)
+    return jsonify({"success": True, "kit_id": kit_id, "offset": offset, "size": state["size"], "sniff": state["sniff"]})
 
-    qpAdm_content = qpAdm_path.read_text(encoding='utf-8', errors='replace') if qpAdm_path.exists() else "جاري..."
+@app.route("/upload/<kit_id>/chunk", methods=["PUT"])
+@login_required
+def upload_chunk(kit_id):
+    import chunked_upload
+    kit = uploading_kit(kit_id)
+    offset = request.args.get("offset", type=int)
+    if offset is None:
+        return jsonify({"success": False, "message": "offset مطلوب"}), 400
+    try:
+        result = chunked_upload.write_chunk(UPLOAD_FOLDER / kit_id, offset, request.stream)
+    except chunked_upload.UploadError as e:
+        return upload_error(kit, e)
+    return jsonify({"success": True, **result})
 
-    # Super Power Fix – حساب distances + best_match
-    pc_values = [0.0] * 30
-    pc_variance = [0.0] * 30
-    eigenvec_path = base_path / f"{kit.kit_id}_pca.eigenvec"
-    eigenval_path = base_path / f"{kit.kit_id}_pca.eigenval"
+@app.route("/upload/<kit_id>/finalize", methods=["POST"])
+@login_required
+def upload_finalize(kit_id):
+    import chunked_upload
+    from tasks import enqueue_kit
+    kit = uploading_kit(kit_id)
+    data = request.get_json(silent=True) or {}
+    try:
+        result = chunked_upload.finalize_upload(UPLOAD_FOLDER / kit_id, data.get("sha256"))
+    except chunked_upload.UploadError as e:
+        return upload_error(kit, e)
 
-    if eigenvec_path.exists():
-        try:
-            with open(eigenvec_path, 'r', encoding='utf-8', errors='ignore') as f:
-                for line in f:
-                    if kit.kit_id in line:
-                        parts = line.strip().split()
-                        if len(parts) >= 32:
-                            pc_values = [float(x) for x in parts[2:32]]
-                        break
-        except:
-            pass
-
-    if eigenval_path.exists():
-        try:
-            with open(eigenval_path, 'r') as f:
-                vals = [float(line.strip()) for line in f if line.strip()]
-                pc_variance = vals[:30] + [0.0] * (30 - len(vals))
-        except:
-            pass
-
-    # demo_refs (مثال صادق – أضفت كنعاني – كمل الباقي زي فينيقي, أنباطي).
-    # Super Power Add: أوروبا, شرق أفريقيا, حميري أكسومي, ساساني فارسي (تقريبي بناءً على بيانات جينية معروفة)
-    demo_refs = {
-        "أوروبي شمالي": np.array([0.055, -0.035, 0.015] + [0.0]*27),
-        "أوروبي جنوبي": np.array([0.045, -0.015, -0.025] + [0.0]*27),
-        "أوروبي شرقي": np.array([0.035, -0.025, 0.025] + [0.0]*27),
-        "إفريقي شرقي": np.array([0.000, 0.065, -0.010] + [0.0]*27),
-        "حميري أكسومي": np.array([0.010, 0.050, -0.015] + [0.0]*27),  # تقريبي لأكسوم/حمير قديم
-        "ساساني فارسي": np.array([0.020, 0.010, -0.010] + [0.0]*27),  # تقريبي لفارسي ساساني
-        "كنعاني": np.array([0.030, 0.010, -0.020] + [0.0]*27),
-        "فينيقي": np.array([0.035, 0.015, -0.015] + [0.0]*27),
-        "أنباطي": np.array([0.028, 0.008, -0.018] + [0.0]*27),
-    }
+    kit.status = 'queued'
+    db.session.commit()
+    enqueue_kit(kit)
+    return jsonify({"success": True, "kit_id": kit_id, "sha256": result["sha256"], "sniff": result["sniff"],
+                    "message": "تم الرفع! التحليل جاري...", "redirect": url_for("results", kit_id=kit_id)})
 
-    user_vec = np.array(pc_values[:15])
-    distances = {}
-    for name, ref in demo_refs.items():
-        ref_vec = np.array(ref[:15])
-        try:
-            sim = 1 - cosine(user_vec, ref_vec)
-            distances[name] = round(sim * 100, 1)
-        except:
-            distances[name] = 0
-
-    best_match = max(distances, key=distances.get, default="غير متوفر") if distances else "غير متوفر"
-
-    # Admixture (مثال – أضف قراءة حقيقية)
-    admixture = {}
-    for k in [5, 8, 10, 13, 20]:
-        qfile = base_path / f"{kit.kit_id}.K{k}.Q"
-        if qfile.exists():
-            try:
-                with open(qfile) as f:
-                    line = f.readline().strip()
-                    values = [float(x) for x in line.split() if x.strip()]
-                    admixture[k] = [round(v * 100, 1) for v in values]
-            except:
-                pass
+@app.route("/results/<kit_id>")
+@login_required
+def results(kit_id):
+    import kit_results
+    kit = DNAKit.query.filter_by(kit_id=kit_id, user_id=current_user.id).first_or_404()
+
+    # kit مكتمل → <kit>_results.json من الـ LRU cache؛ لسه شغال → من الملفات الخام (بتتغير) من غير كتابة
+    base_path = UPLOAD_FOLDER / kit_id
+    if kit.status == 'completed':
+        res = kit_results.load_kit_results(base_path, kit_id, kit.panel_version)
+        if res is None:
+            abort(404)
+    else:
+        res = kit_results.build_kit_results(base_path, kit_id, kit.panel_version)
 
     return render_template("results.html", kit_id=kit_id, user_name=current_user.name,
-                           pc_values=pc_values, pc_variance=pc_variance, admixture_results=admixture,
-                           qpAdm_content=qpAdm_content, p_value=p_value, is_honest=is_honest,
-                           distances=distances, best_match=best_match, progress=kit.progress, status=kit.status,
+                           pc_values=res["pc_values"], pc_variance=res["pc_variance"], admixture_results=res["admixture"],
+                           qpAdm_content=res["qpAdm_content"], p_value=res["p_value"], is_honest=res["is_honest"],
+                           distances=res["distances"], best_match=res["best_match"], relatives=kit_relatives(kit),
+                           progress=kit.progress, status=kit.status,
                            message="النتائج جاري..." if kit.status != 'completed' else "مكتمل ✅")
 
 @app.route("/get_results/<kit_id>")
 @login_required
 def get_results(kit_id):
+    DNAKit.query.filter_by(kit_id=kit_id, user_id=current_user.id).first_or_404()
     log_path = UPLOAD_FOLDER / kit_id / f"{kit_id}_process.log"
     if log_path.exists():
         return "<pre>" + log_path.read_text(encoding='utf-8', errors='replace') + "</pre>"
     return "جاري..."
 
+def kit_target(kit):
+    """(مصفوفة المراجع, إحداثيات الـ kit scaled, النتيجة المجمّعة) أو رسالة خطأ لـ API الـ populations."""
+    import kit_results
+    import population_engine
+    pops = population_engine.load_populations()
+    if pops is None:
+        return None, "مصفوفة المراجع مش متبنية – reference_panel.py build"
+    if kit.status != 'completed' or kit.panel_version != pops["version"]:
+        return None, "الـ kit مش مكتمل على الـ panel الحالي"
+    res = kit_results.load_kit_results(UPLOAD_FOLDER / kit.kit_id, kit.kit_id, kit.panel_version)
+    if res is None:
+        abort(404)
+    return (pops, population_engine.scale_target(pops, res["pc_values"]), res), None
+
+@app.route("/api/kits")
+@login_required
+def api_kits():
+    # ?limit=&cursor= (next_cursor من الصفحة اللي قبلها)؛ If-None-Match بالـ ETag → 304 من غير ملفات النتائج
+    limit = max(1, min(request.args.get("limit", KITS_PAGE_SIZE, type=int), KITS_PAGE_MAX))
+    cursor = request.args.get("cursor") or None
+    try:
+        kits, has_more = kits_page(current_user.id, limit, cursor)
+    except ValueError:
+        return jsonify({"success": False, "message": "cursor غير صالح"}), 400
+
+    etag = kits_etag(current_user.id, kits, cursor, limit)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify({"success": True, "kits": [kit_summary(kit) for kit in kits],
+                            "next_cursor": encode_cursor(kits[-1]) if has_more else None})
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+@app.route("/api/kits/<kit_id>/nearest")
+@login_required
+def api_nearest(kit_id):
+    import population_engine
+    kit = DNAKit.query.filter_by(kit_id=kit_id, user_id=current_user.id).first_or_404()
+    metric = request.args.get("metric", "euclidean")
+    kind = request.args.get("kind", "population")
+    k = request.args.get("k", 20, type=int)
+    if metric not in population_engine.METRICS or kind not in population_engine.KINDS:
+        return jsonify({"success": False, "message": "metric أو kind غير مدعوم"}), 400
+    target, error = kit_target(kit)
+    if error:
+        return jsonify({"success": False, "message": error}), 409
+    pops, coords, res = target
+    top = population_engine.nearest(pops, coords, k=min(k, 500), metric=metric, kind=kind)[0]
+    return jsonify({"success": True, "kit_id": kit_id, "metric": metric, "kind": kind,
+                    "nearest": [{"name": name, "distance": round(dist, 6)} for name, dist, _ in top],
+                    "distances": res["distances"], "best_match": res["best_match"]})
+
+@app.route("/api/kits/<kit_id>/mixture")
+@login_required
+def api_mixture(kit_id):
+    # Vahaduo-style: مصادر محددة (?sources=A&sources=B) أو أقرب candidates population، وكل توليفات size منها
+    import population_engine
+    kit = DNAKit.query.filter_by(kit_id=kit_id, user_id=current_user.id).first_or_404()
+    size = request.args.get("size", 3, type=int)
+    candidates = request.args.get("candidates", 15, type=int)
+    top = request.args.get("top", 10, type=int)
+    target, error = kit_target(kit)
+    if error:
+        return jsonify({"success": False, "message": error}), 409
+    pops, coords, res = target
+
+    names = request.args.getlist("sources")
+    if names:
+        lookup = {name: i for i, name in enumerate(pops["names"][:pops["ranges"]["population"][1]])}
+        missing = [name for name in names if name not in lookup]
+        if missing:
+            return jsonify({"success": False, "message": f"populations غير موجودة: {', '.join(missing)}"}), 400
+        source_idx = [lookup[name] for name in names]
+    else:
+        source_idx = [i for _, _, i in population_engine.nearest(pops, coords, k=candidates)[0]]
+
+    try:
+        models = population_engine.best_mixtures(pops, coords[0], source_idx, size=size, top=min(top, 100))
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    return jsonify({"success": True, "kit_id": kit_id, "size": size, "models": models,
+                    "distances": res["distances"], "best_match": res["best_match"]})
+
+@app.route("/api/kits/<kit_id>/qpadm")
+@login_required
+def api_qpadm(kit_id):
+    # كل موديلات الـ sweep مرتبة (qpadm_sweep.rank_models: أبسط موديل بيعدّي الأول) – <kit>_qpadm.json زي ما هو
+    import qpadm_sweep
+    kit = DNAKit.query.filter_by(kit_id=kit_id, user_id=current_user.id).first_or_404()
+    report = qpadm_sweep.load_report(UPLOAD_FOLDER / kit_id, kit_id)
+    if report is None:
+        return jsonify({"success": False, "message": "qpAdm لسه ماخلصش للـ kit ده"}), 409
+    top = request.args.get("top", type=int)
+    models = report["models"][:top] if top else report["models"]
+    return jsonify({"success": True, "kit_id": kit_id, "engine": report["engine"], "right": report["right"],
+                    "missing": report["missing"], "models": models})
+
+@app.route("/api/kits/<kit_id>/relatives")
+@login_required
+def api_relatives(kit_id):
+    # أقارب الـ kit مرتبين بالـ kinship (KING-robust) – بيتحدث كل ما kit جديد يتطابق معاه
+    kit = DNAKit.query.filter_by(kit_id=kit_id, user_id=current_user.id).first_or_404()
+    return jsonify({"success": True, "kit_id": kit_id, "relatives": kit_relatives(kit)})
+
+@app.route("/api/kits/<kit_id>/metrics")
+@login_required
+def api_kit_metrics(kit_id):
+    # <kit>_metrics.jsonl: record لكل stage اتنفذ ولكل أداة (wall/CPU/RSS/I-O/exit status)
+    import stage_metrics
+    kit = DNAKit.query.filter_by(kit_id=kit_id, user_id=current_user.id).first_or_404()
+    return jsonify({"success": True, "kit_id": kit_id,
+                    "records": stage_metrics.load_records(UPLOAD_FOLDER / kit_id, kit_id)})
+
+def metrics_authorized():
+    # fail closed: من غير METRICS_TOKEN مفيش حد بيشوف بيانات الـ node (ورا reverse proxy كل الطلبات localhost)
+    token = app.config['METRICS_TOKEN']
+    supplied = request.headers.get("Authorization", "")
+    return bool(token) and hmac.compare_digest(supplied.encode(), f"Bearer {token}".encode())
+
+@app.route("/metrics")
+def metrics():
+    # Prometheus scrape: histograms كل الـ workers على الـ node (من stage_metrics)
+    import stage_metrics
+    if not app.config['METRICS_TOKEN']:
+        return Response("metrics disabled (METRICS_TOKEN not set)\n", status=404, mimetype="text/plain")
+    if not metrics_authorized():
+        return Response("unauthorized\n", status=401, mimetype="text/plain")
+    return Response(stage_metrics.render_prometheus(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+GOVERNOR_PUBLIC_FIELDS = ("stage", "kit_id", "cores", "memory_mb", "since", "granted_at", "seconds")
+
+@app.route("/api/governor")
+def api_governor():
+    # حجوزات الـ cores/RAM والطابور على الـ node ده (debugging لما الـ kits تبان واقفة):
+    # بالـ METRICS_TOKEN كله، والمستخدم العادي الأرقام الإجمالية + stages الـ kits بتاعته بس (من غير pid)
+    import resource_governor
+    snapshot = resource_governor.snapshot()
+    if metrics_authorized():
+        return jsonify({"success": True, **snapshot})
+    if not current_user.is_authenticated:
+        return login_manager.unauthorized()
+    own = {kit_id for kit_id, in DNAKit.query.filter_by(user_id=current_user.id).with_entities(DNAKit.kit_id)}
+
+    def mine(entries):
+        return [{field: entry[field] for field in GOVERNOR_PUBLIC_FIELDS if field in entry}
+                for entry in entries if entry["kit_id"] in own]
+
+    return jsonify({"success": True, "enabled": snapshot["enabled"], "cores": snapshot["cores"],
+                    "memory_mb": snapshot["memory_mb"], "used_cores": snapshot["used_cores"],
+                    "used_memory_mb": snapshot["used_memory_mb"], "waiting_count": len(snapshot["waiting"]),
+                    "allocations": mine(snapshot["allocations"]), "waiting": mine(snapshot["waiting"])})
+
+SSE_POLL_SECONDS = 1.0
+SSE_HEARTBEAT_SECONDS = 15
+
+def read_new_lines(path, offset):
+    """الأسطر الكاملة اللي اتضافت بعد offset → (أسطر, offset جديد). لو الحجم ماتغيرش: stat بس من غير فتح."""
+    try:
+        size = path.stat().st_size
+    except FileNotFoundError:
+        return [], offset
+    if size <= offset:
+        return [], offset
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(size - offset)
+    end = data.rfind(b"\n") + 1  # السطر الأخير ممكن يكون لسه بيتكتب
+    return data[:end].decode('utf-8', errors='replace').splitlines(), offset + end
+
+def sse_message(event, data, event_id=None):
+    lines = [f"event: {event}"]
+    if event_id:
+        lines.append(f"id: {event_id}")
+    lines += [f"data: {line}" for line in data.split("\n")]
+    return "\n".join(lines) + "\n\n"
+
+@app.route("/stream/<kit_id>")
+@login_required
+def stream_status(kit_id):
+    # Server-Sent Events: أسطر السجل الجديدة + تغيّر الـ progress بس؛ الملكية بتتحقق مرة وحدة والـ DB مش بيتلمس تاني
+    kit = DNAKit.query.filter_by(kit_id=kit_id, user_id=current_user.id).first_or_404()
+    kit_dir = UPLOAD_FOLDER / kit_id
+    log_path, events_path = kit_dir / f"{kit_id}_process.log", kit_dir / f"{kit_id}_events.jsonl"
+    finished_before = kit.status in ('completed', 'failed')
+    last_state = {"progress": kit.progress, "status": kit.status}
+    # الـ stream ممكن يفضل مفتوح ساعات – الـ connection يرجع للـ pool قبل ما يبدأ
+    db.session.remove()
+
+    # Last-Event-ID = "<offset السجل>:<offset الأحداث>" – إعادة الاتصال بتكمل من مكانها
+    try:
+        log_offset, events_offset = (int(x) for x in request.headers.get("Last-Event-ID", "0:0").split(":"))
+    except ValueError:
+        log_offset, events_offset = 0, 0
+
+    def generate():
+        nonlocal log_offset, events_offset
+        yield "retry: 3000\n\n"
+        yield sse_message("progress", json.dumps(last_state))
+        sent = dict(last_state)
+        idle_since = time.time()
+        deadline = idle_since + settings.SSE_MAX_SECONDS
+        while time.time() < deadline:
+            lines, log_offset = read_new_lines(log_path, log_offset)
+            events, events_offset = read_new_lines(events_path, events_offset)
+            event_id = f"{log_offset}:{events_offset}"
+            if lines:
+                yield sse_message("log", "\n".join(lines), event_id)
+
+            # الأحداث اللي اتراكمت من آخر poll → آخر حالة بس (delta وحد بدل إعادة التاريخ كله)
+            latest = None
+            for raw in events:
+                try:
+                    latest = json.loads(raw)
+                except ValueError:
+                    continue
+            final = None
+            if latest is not None:
+                state = {"progress": latest["progress"], "status": latest["status"]}
+                if state != sent:
+                    yield sse_message("progress", json.dumps({**state, "stage": latest["stage"]}), event_id)
+                    sent = state
+                if state["status"] in ('completed', 'failed'):
+                    final = state
+
+            if final is None and finished_before:
+                final = sent
+            if final is not None:
+                yield sse_message("done", json.dumps(final), event_id)
+                return
+
+            if lines or events:
+                idle_since = time.time()
+            elif time.time() - idle_since >= SSE_HEARTBEAT_SECONDS:
+                yield ": heartbeat\n\n"
+                idle_since = time.time()
+            time.sleep(SSE_POLL_SECONDS)
+        # انتهى عمر الاتصال: id بس (من غير data) بيحدّث Last-Event-ID، والـ client يرجع بعد الـ retry من نفس المكان
+        yield f"id: {log_offset}:{events_offset}\n\n"
+
+    # generate مابيستخدمش أي حاجة من الـ request بعد كده – من غير stream_with_context (مايمسكش الـ context)
+    return Response(generate(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.route("/download_coords/<kit_id>")
 @login_required
 def download_coords(kit_id):
+    # الملفات ممكن تكون مربوطة من kit تاني بنفس الـ fingerprint – الملكية بتتحقق من الـ DB مش من المسار
+    DNAKit.query.filter_by(kit_id=kit_id, user_id=current_user.id).first_or_404()
     file_path = UPLOAD_FOLDER / kit_id / f"{kit_id}_G25_scaled.eigenvec"
     if file_path.exists():
         return send_from_directory(UPLOAD_FOLDER / kit_id, file_path.name, as_attachment=True)
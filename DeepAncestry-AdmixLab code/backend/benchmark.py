@@ -0,0 +1,874 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark.py – benchmark قابل للتكرار للـ pipeline والـ routes على جهاز Linux عادي من غير نت
+
+kits صناعية بكل الصيغ والأحجام (600k / 1M / 5M SNP؛ txt / csv / gz / zip / vcf) + ref_panel صناعي صغير
+(populations الـ qpAdm وغيرها)، كلهم من seed ثابت فنفس الأرقام في كل مرة. plink2 / ADMIXTURE / qpAdm / convertf
+لو مش متثبتين (أو --standins) بيتبدلوا بـ stand-ins محلية deterministic (نفس الملف: benchmark.py standin <tool>)
+– بتكتب مخرجات بنفس الشكل بس مابتقيسش حسابات الأدوات الحقيقية.
+
+كل kit بيتشغل في process لوحده (peak RSS نضيف)، والأوقات لكل stage من <kit>_metrics.jsonl (stage_metrics).
+الـ routes (dashboard / results) بتتقاس على server werkzeug حقيقي بـ clients متوازيين. وقت import كل entry
+point (app / tasks / process_dna …) في process جديد بيتقارن بـ IMPORT_BUDGETS. النتيجة JSON:
+
+  python benchmark.py run --sizes 600k,1M --formats txt,vcf --out bench.json
+  python benchmark.py compare old.json new.json
+  python benchmark.py imports          # الـ budget بس – exit 1 لو entry point عدّاه
+"""
+
+import argparse
+import gzip
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.cookiejar import CookieJar
+from pathlib import Path
+
+BENCH_VERSION = 1
+BENCH_DIR = Path(os.getenv('BENCH_DIR') or Path(tempfile.gettempdir()) / "deepancestry_bench")
+SEED = 20240611
+GRID_SNPS = 5_000_000
+GRID_SPACING = 500
+ALLELE_PAIRS = [("A", "G"), ("G", "A"), ("C", "T"), ("T", "C"), ("A", "C"), ("C", "A"), ("G", "T"), ("T", "G")]
+EXTRA_POPULATIONS = ["Yoruba", "Han", "French", "Bedouin"]
+DRIFT_SD = 0.08
+# drift سلالة كل مصدر في الـ pool واللي الـ right pops بتشاركه (لحد LINEAGE_LOADING_MAX منه)
+LINEAGE_SD = 0.08
+LINEAGE_LOADING_MAX = 0.8
+# رقم شكل الـ panel الصناعي – بيتغير لما panel_layout يتغير فالـ panel المتخزن في BENCH_DIR يتولد من جديد
+PANEL_LAYOUT = 2
+MISSING_RATE = 0.01
+# الـ kit الصناعي = خليط الاتنين دول (الـ qpAdm sweep المفروض يلاقيه)
+KIT_MIXTURE = {"Natufian": 0.6, "Anatolian_N": 0.4}
+# أقصى فرق مقبول بين أوزان أحسن موديل و KIT_MIXTURE (kit وحد diploid → SE حوالي 0.05–0.1)
+MIXTURE_TOLERANCE = 0.15
+WRITE_ROWS = 200_000
+SIZES = {"600k": 600_000, "1M": 1_000_000, "5M": 5_000_000}
+FORMATS = {"txt": "txt", "csv": "csv", "gz": "txt.gz", "zip": "zip", "vcf": "vcf"}
+TOOLS = ["plink2", "admixture", "qpAdm", "convertf"]
+STANDIN_PRUNE_STRIDE = 4
+ROUTE_CONCURRENCY = [1, 8, 32]
+ROUTE_REQUESTS = 200
+ROUTE_KITS = 10
+IMPORT_REPEAT = 5
+# entry point → (أقصى ms للـ import، modules ممنوع تتحمل معاه). gunicorn والـ celery prefork والـ CLI
+# بيدفعوا الوقت ده عند كل تشغيل؛ scipy والـ pipeline بيتحملوا lazy أو في preload الـ parent بس
+PIPELINE_ONLY = ["scipy", "flask", "celery", "sqlalchemy"]
+IMPORT_BUDGETS = {
+    "settings": (150, ["flask", "numpy", "celery"]),
+    "app": (1500, ["numpy", "celery", "scipy", "process_dna", "cohort_batch"]),
+    "tasks": (1200, ["scipy", "process_dna", "cohort_batch", "flask_wtf", "wtforms"]),
+    "process_dna": (500, PIPELINE_ONLY),
+    "cohort_batch": (500, PIPELINE_ONLY),
+    "kit_results": (400, PIPELINE_ONLY),
+}
+# جهاز أبطأ (CI مشترك مثلاً): IMPORT_BUDGET_SCALE=2 بيضاعف كل الـ budgets
+IMPORT_BUDGET_SCALE = float(os.getenv('IMPORT_BUDGET_SCALE', 1))
+BENCH_EMAIL, BENCH_PASSWORD = "bench@deepancestry.local", "bench"
+
+
+def log(msg):
+    print(f"[*] {msg}", flush=True)
+
+
+def parse_size(label):
+    if label in SIZES:
+        return SIZES[label]
+    units = {"k": 1_000, "M": 1_000_000}
+    return int(float(label[:-1]) * units[label[-1]]) if label[-1] in units else int(label)
+
+
+def ru_maxrss_bytes(who):
+    import resource
+    return resource.getrusage(who).ru_maxrss * 1024
+
+
+# ---------------------------------------------------------------- synthetic data
+
+def synthetic_grid(seed=SEED):
+    """كل مواقع الـ SNPs الممكنة (22 كروموسوم) + أليلات + تكرار أساسي – الـ panel والـ kits بياخدوا منها."""
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    index = np.arange(GRID_SNPS)
+    chrom = 1 + index * 22 // GRID_SNPS
+    within = index - np.searchsorted(chrom, chrom)
+    pairs = np.array(ALLELE_PAIRS, dtype='S1')[rng.integers(0, len(ALLELE_PAIRS), GRID_SNPS)]
+    return {
+        "chrom": chrom,
+        "pos": 10_000 + within * GRID_SPACING + rng.integers(0, GRID_SPACING, GRID_SNPS),
+        "ref": pairs[:, 0],
+        "alt": pairs[:, 1],
+        "p": rng.uniform(0.05, 0.95, GRID_SNPS),
+    }
+
+
+def panel_populations():
+    import qpadm_sweep
+    return list(dict.fromkeys(qpadm_sweep.SOURCE_POOL + qpadm_sweep.RIGHT_POPS + EXTRA_POPULATIONS))
+
+
+def lineage_loadings(pops, pool, right, rng):
+    """نصيب كل population من drift كل مصدر في الـ pool: المصدر 1 على نفسه، أول right pop صفر (outgroup)،
+    والباقي نسب عشوائية – كل right pop قريب من المصادر بدرجات مختلفة فـ f4(target, source; R₀, Rⱼ) بتفرّق بينهم."""
+    import numpy as np
+    loadings = np.zeros((len(pops), len(pool)))
+    for pop in pops:
+        if pop in pool:
+            loadings[pops.index(pop), pool.index(pop)] = 1
+        elif pop not in right[:1]:
+            loadings[pops.index(pop)] = rng.uniform(0, LINEAGE_LOADING_MAX, len(pool))
+    return loadings
+
+
+def panel_layout(grid, panel_snps, seed=SEED):
+    """مواقع الـ panel (على مسافات ثابتة في الـ grid) وتكرار كل population عليها.
+
+    كل population = التكرار الأساسي + drift مشترك مع سلالات المصادر (lineage_loadings) + drift خاص بيها.
+    drift مستقل بس (star tree) بيخلّي كل الـ f4 بتاعة الـ qpAdm صفر والأوزان مش متعرّفة."""
+    import numpy as np
+    import qpadm_sweep
+    rng = np.random.default_rng(seed + 1)
+    idx = np.unique(np.linspace(0, GRID_SNPS - 1, panel_snps).astype(np.int64))
+    pops = panel_populations()
+    pool = [pop for pop in qpadm_sweep.SOURCE_POOL if pop in pops]
+    loadings = lineage_loadings(pops, pool, qpadm_sweep.RIGHT_POPS, rng)
+    lineage = rng.normal(0, LINEAGE_SD, (len(pool), len(idx)))
+    drift = rng.normal(0, DRIFT_SD, (len(pops), len(idx)))
+    freq = np.clip(grid["p"][idx] + loadings @ lineage + drift, 0.01, 0.99)
+    return idx, pops, freq
+
+
+def write_panel(ref_prefix, panel_snps, samples_per_pop, seed=SEED):
+    import numpy as np
+    import genotype_io
+    grid = synthetic_grid(seed)
+    idx, pops, freq = panel_layout(grid, panel_snps, seed)
+    rng = np.random.default_rng(seed + 2)
+    Path(ref_prefix).parent.mkdir(parents=True, exist_ok=True)
+    with open(f"{ref_prefix}.bed", 'wb') as bed:
+        bed.write(genotype_io.BED_MAGIC)
+        for start in range(0, len(idx), WRITE_ROWS):
+            p = np.repeat(freq[:, start:start + WRITE_ROWS], samples_per_pop, axis=0).T
+            dosage = rng.binomial(2, p).astype(np.float32)
+            dosage[rng.random(dosage.shape) < MISSING_RATE / 2] = np.nan
+            bed.write(genotype_io.pack_bed_codes(genotype_io.dosage_codes(dosage)))
+    with open(f"{ref_prefix}.bim", 'w') as bim:
+        for i in idx.tolist():
+            bim.write(f"{grid['chrom'][i]}\trs{i + 1}\t0\t{grid['pos'][i]}\t"
+                      f"{grid['alt'][i].decode()}\t{grid['ref'][i].decode()}\n")
+    with open(f"{ref_prefix}.fam", 'w') as fam:
+        for pop in pops:
+            fam.write("".join(f"{pop}\t{pop}_{i}\t0\t0\t0\t-9\n" for i in range(samples_per_pop)))
+    return {"snps": int(len(idx)), "samples": len(pops) * samples_per_pop, "populations": len(pops)}
+
+
+def kit_genotypes(n_snps, panel_snps, seed=SEED):
+    """(grid index, genotype أليلين) لـ kit: كل SNPs الـ panel + الباقي عشوائي من الـ grid، بترتيب الموقع."""
+    import numpy as np
+    grid = synthetic_grid(seed)
+    panel_idx, pops, freq = panel_layout(grid, panel_snps, seed)
+    rng = np.random.default_rng(seed + n_snps)
+    rest = np.setdiff1d(np.arange(GRID_SNPS), panel_idx, assume_unique=True)
+    extra = rng.choice(rest, max(0, min(n_snps, GRID_SNPS) - len(panel_idx)), replace=False)
+    chosen = np.sort(np.concatenate([panel_idx, extra]))
+
+    p = grid["p"][chosen]
+    in_panel = np.isin(chosen, panel_idx, assume_unique=True)
+    mixed = sum(weight * freq[pops.index(pop)] for pop, weight in KIT_MIXTURE.items())
+    p[in_panel] = mixed[np.searchsorted(panel_idx, chosen[in_panel])]
+    dosage = rng.binomial(2, p)
+    missing = rng.random(len(chosen)) < MISSING_RATE
+    ref, alt = grid["ref"][chosen], grid["alt"][chosen]
+    return {"index": chosen, "chrom": grid["chrom"][chosen], "pos": grid["pos"][chosen], "ref": ref, "alt": alt,
+            "dosage": np.where(missing, -1, dosage)}
+
+
+def _text_lines(kit, start, end, fmt):
+    rows = zip(kit["index"][start:end].tolist(), kit["chrom"][start:end].tolist(), kit["pos"][start:end].tolist(),
+               kit["ref"][start:end].tolist(), kit["alt"][start:end].tolist(), kit["dosage"][start:end].tolist())
+    if fmt == "vcf":
+        gts = {-1: b"./.", 0: b"0/0", 1: b"0/1", 2: b"1/1"}
+        return b"".join(b"%d\t%d\trs%d\t%s\t%s\t.\tPASS\t.\tGT\t%s\n" % (c, pos, i + 1, r, a, gts[d])
+                        for i, c, pos, r, a, d in rows)
+    if fmt == "csv":
+        # AncestryDNA: allele1 و allele2 في عمودين، 0 = no call
+        pairs = {-1: lambda r, a: (b"0", b"0"), 0: lambda r, a: (r, r), 1: lambda r, a: (r, a), 2: lambda r, a: (a, a)}
+        return b"".join(b"rs%d,%d,%d,%s,%s\n" % (i + 1, c, pos, *pairs[d](r, a)) for i, c, pos, r, a, d in rows)
+    genos = {-1: lambda r, a: b"--", 0: lambda r, a: r + r, 1: lambda r, a: r + a, 2: lambda r, a: a + a}
+    return b"".join(b"rs%d\t%d\t%d\t%s\n" % (i + 1, c, pos, genos[d](r, a)) for i, c, pos, r, a, d in rows)
+
+
+HEADERS = {
+    "txt": b"# synthetic kit (benchmark.py)\n# rsid\tchromosome\tposition\tgenotype\n",
+    "csv": b"rsid,chromosome,position,allele1,allele2\n",
+    "vcf": b"##fileformat=VCFv4.2\n##source=benchmark.py\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tKIT\n",
+}
+
+
+def write_kit(path, fmt, n_snps, panel_snps, seed=SEED):
+    kit = kit_genotypes(n_snps, panel_snps, seed)
+    base_fmt = "txt" if fmt in ("gz", "zip") else fmt
+
+    def chunks():
+        yield HEADERS[base_fmt]
+        for start in range(0, len(kit["index"]), WRITE_ROWS):
+            yield _text_lines(kit, start, start + WRITE_ROWS, base_fmt)
+
+    tmp = Path(f"{path}.tmp")
+    if fmt == "gz":
+        with gzip.open(tmp, 'wb') as f:
+            for data in chunks():
+                f.write(data)
+    elif fmt == "zip":
+        with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as zf, zf.open("genome.txt", 'w') as f:
+            for data in chunks():
+                f.write(data)
+    else:
+        with open(tmp, 'wb') as f:
+            for data in chunks():
+                f.write(data)
+    os.replace(tmp, path)
+    return len(kit["index"])
+
+
+# ---------------------------------------------------------------- tool stand-ins
+
+def _arg(args, flag, n=1):
+    i = args.index(flag)
+    return args[i + 1] if n == 1 else args[i + 1:i + 1 + n]
+
+
+def _count_lines(path):
+    with open(path, 'rb') as f:
+        return sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1 << 22), b''))
+
+
+def standin_plink2(args):
+    import numpy as np
+    import genotype_io
+    out = _arg(args, "--out")
+    if "--23file" in args:
+        path, fid, iid = _arg(args, "--23file", 3)
+        state = {}
+        blocks = genotype_io.iter_sorted_genotypes(path, state, work_dir=Path(out).parent)
+        genotype_io.write_bfile(blocks, out, fid, iid)
+        return
+
+    bfile = _arg(args, "--bfile")
+    bim_lines = open(f"{bfile}.bim", 'rb').read().splitlines(keepends=True)
+    rsids = [line.split()[1] for line in bim_lines]
+    keep = np.ones(len(rsids), dtype=bool)
+    if "--extract" in args:
+        wanted = set(open(_arg(args, "--extract"), 'rb').read().split())
+        keep = np.array([r in wanted for r in rsids], dtype=bool)
+
+    if "--indep-pairwise" in args:
+        # pruning تقريبي ثابت: كل SNP رابع من اللي فاضلين
+        kept = [r for i, r in enumerate(rsids) if keep[i] and i % STANDIN_PRUNE_STRIDE == 0]
+        Path(f"{out}.prune.in").write_bytes(b"".join(r + b"\n" for r in kept))
+        return
+
+    n = len(genotype_io.read_fam_ids(bfile))
+    if "--make-bed" in args:
+        rows = np.memmap(f"{bfile}.bed", dtype=np.uint8, mode='r', offset=3).reshape(len(rsids), (n + 3) // 4)
+        with open(f"{out}.bed", 'wb') as bed:
+            bed.write(genotype_io.BED_MAGIC)
+            for start in range(0, len(rows), WRITE_ROWS):
+                bed.write(rows[start:start + WRITE_ROWS][keep[start:start + WRITE_ROWS]].tobytes())
+        Path(f"{out}.bim").write_bytes(b"".join(line for line, k in zip(bim_lines, keep) if k))
+        shutil.copyfile(f"{bfile}.fam", f"{out}.fam")
+        return
+
+    if "--pca" in args:
+        n_pcs = int(_arg(args, "--pca"))
+        dosage = np.concatenate(list(genotype_io.iter_bed_dosages(bfile, n)))[keep].astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            p = np.nanmean(dosage, axis=1) / 2
+            scale = np.sqrt(2 * p * (1 - p))
+            x = np.nan_to_num((dosage - 2 * p[:, None]) / np.where(scale > 0, scale, np.inf)[:, None])
+        values, vectors = np.linalg.eigh(x.T @ x / max(len(x), 1))
+        order = np.argsort(values)[::-1][:n_pcs]
+        vectors, values = vectors[:, order], values[order]
+        if len(order) < n_pcs:
+            vectors = np.pad(vectors, ((0, 0), (0, n_pcs - len(order))))
+            values = np.pad(values, (0, n_pcs - len(order)))
+        with open(f"{out}.eigenvec", 'w') as f:
+            f.write("#FID\tIID\t" + "\t".join(f"PC{i + 1}" for i in range(n_pcs)) + "\n")
+            for (fid, iid), row in zip(genotype_io.read_fam_ids(bfile), vectors):
+                f.write(f"{fid}\t{iid}\t" + "\t".join(f"{v:.6g}" for v in row) + "\n")
+        Path(f"{out}.eigenval").write_text("".join(f"{v:.6g}\n" for v in values))
+        return
+    raise SystemExit(f"stand-in plink2: أمر مش مدعوم: {' '.join(args)}")
+
+
+def standin_admixture(args):
+    import numpy as np
+    positional = [a for a in args if not a.startswith("-")]
+    bed, k = positional[0], int(positional[1])
+    base = bed[:-len(".bed")]
+    if "-P" in args and not Path(f"{base}.{k}.P.in").exists():
+        raise SystemExit(f"stand-in admixture: {base}.{k}.P.in مش موجود")
+    rng = np.random.default_rng(k)
+    np.savetxt(f"{base}.{k}.Q", rng.dirichlet(np.ones(k), size=_count_lines(f"{base}.fam")), fmt="%.6f")
+    if "-P" not in args:
+        np.savetxt(f"{base}.{k}.P", rng.uniform(0.05, 0.95, (_count_lines(f"{base}.bim"), k)), fmt="%.6f")
+
+
+def _par_sections(path):
+    """ملف par (key: value وقوائم تحت key:) → dict."""
+    sections, current = {}, None
+    for line in Path(path).read_text().splitlines():
+        if line.startswith((" ", "\t")) and current:
+            sections[current].append(line.strip())
+        elif ":" in line:
+            current, value = (part.strip() for part in line.split(":", 1))
+            sections[current] = [value] if value else []
+    return sections
+
+
+def standin_qpadm(args):
+    par = _par_sections(_arg(args, "-p"))
+    left, right = par["leftpops"], par["rightpops"]
+    n_sources = len(left) - 1
+    # p-value ثابت لكل موديل (من أسماء الـ populations) عشان الترتيب يبقى نفسه كل مرة
+    seed = zlib.crc32(" ".join(left).encode())
+    p_value = (seed % 1000) / 1000
+    dof = len(right) - n_sources
+    print(f"leftpops: {' '.join(left)}\nrightpops: {' '.join(right)}")
+    print("best coefficients: " + " ".join(f"{1 / n_sources:.3f}" for _ in range(n_sources)))
+    print("std. errors: " + " ".join("0.050" for _ in range(n_sources)))
+    print(f"f4rank: {n_sources - 1} dof: {dof} chisq: {dof * (1 + (seed % 7) / 10):.3f} tail: {p_value:.6g}")
+
+
+def standin_convertf(args):
+    import numpy as np
+    import genotype_io
+    par = {key: values[0] for key, values in _par_sections(_arg(args, "-p")).items() if values}
+    bfile = par["genotypename"][:-len(".bed")]
+    fam_ids = genotype_io.read_fam_ids(bfile)
+    with open(par["genooutfilename"], 'wb') as geno:
+        for dosage in genotype_io.iter_bed_dosages(bfile, len(fam_ids)):
+            rows = np.where(np.isnan(dosage), ord('9'), np.nan_to_num(dosage) + ord('0')).astype(np.uint8)
+            geno.write(b"".join(row.tobytes() + b"\n" for row in rows))
+    with open(f"{bfile}.bim") as bim, open(par["snpoutfilename"], 'w') as snp:
+        for line in bim:
+            chrom, rsid, cm, pos, a1, a2 = line.split()
+            snp.write(f"{rsid}\t{chrom}\t{cm}\t{pos}\t{a1}\t{a2}\n")
+    with open(par["indoutfilename"], 'w') as ind:
+        ind.write("".join(f"{iid}\tU\t{fid}\n" for fid, iid in fam_ids))
+
+
+STANDINS = {"plink2": standin_plink2, "admixture": standin_admixture, "qpAdm": standin_qpadm,
+            "convertf": standin_convertf}
+
+
+def install_tools(bin_dir, force_standins):
+    """shim في bin_dir لكل أداة ناقصة (أو كلهم مع --standins) → {tool: "stand-in" أو مسار الأداة الحقيقية}."""
+    bin_dir = Path(bin_dir)
+    shutil.rmtree(bin_dir, ignore_errors=True)
+    bin_dir.mkdir(parents=True)
+    sources = {}
+    for tool in TOOLS:
+        real = shutil.which(tool)
+        if real and not force_standins:
+            sources[tool] = real
+            continue
+        shim = bin_dir / tool
+        shim.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{Path(__file__).resolve()}" standin {tool} "$@"\n')
+        shim.chmod(0o755)
+        sources[tool] = "stand-in"
+    return sources
+
+
+# ---------------------------------------------------------------- runs (كل واحد في process لوحده)
+
+def child_env(work, panel_snps=None):
+    env = dict(os.environ)
+    if panel_snps:
+        # panel صغير للتجربة → بوابة التطابق (reference_panel.MIN_OVERLAP_SNPS) على قده
+        env.setdefault("MIN_OVERLAP_SNPS", str(min(10_000, panel_snps // 2)))
+    env.update({
+        "PATH": f"{work / 'bin'}{os.pathsep}{env.get('PATH', '')}",
+        "REFERENCE_DIR": str(work / "reference"),
+        "GOVERNOR_DIR": str(work / "governor"),
+        "METRICS_DIR": str(work / "metrics"),
+        "GENOTYPE_STORE_DIR": str(work / "genotype_store"),
+        "UPLOAD_FOLDER": str(work / "uploads"),
+        "DATABASE_URL": f"sqlite:///{work / 'bench.db'}",
+    })
+    return env
+
+
+def run_child(work, command, *args, panel_snps=None):
+    """benchmark.py <command> في process جديد → الـ JSON اللي كتبه."""
+    result = work / f"result_{command}_{os.getpid()}.json"
+    result.unlink(missing_ok=True)
+    cmd = [sys.executable, str(Path(__file__).resolve()), command, "--work", str(work), "--result", str(result), *args]
+    proc = subprocess.run(cmd, env=child_env(work, panel_snps), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if proc.returncode != 0 or not result.exists():
+        raise RuntimeError(f"{command} فشل:\n{proc.stdout[-4000:]}")
+    data = json.loads(result.read_text())
+    result.unlink()
+    return data
+
+
+def child_build_panel(args):
+    import reference_panel
+    ref_prefix = reference_panel.default_ref_prefix()
+    manifest = reference_panel.load_manifest(ref_prefix)
+    if manifest and "f2" in manifest["components"] and not args.rebuild:
+        return {"cached": True, "version": manifest["version"]}
+    start = time.perf_counter()
+    manifest = reference_panel.build_panel(ref_prefix)
+    return {"cached": False, "version": manifest["version"], "wall_seconds": round(time.perf_counter() - start, 3),
+            "peak_rss_bytes": ru_maxrss_bytes(0), "components": list(manifest["components"])}
+
+
+STAGE_FIELDS = ("wall_seconds", "cpu_seconds", "child_cpu_seconds", "max_rss_bytes", "read_bytes", "write_bytes",
+                "queued_seconds", "snps", "samples", "threads")
+
+
+def qpadm_recovery(kit_dir, kit_id):
+    """أحسن موديل في الـ sweep مقابل KIT_MIXTURE – الـ f2 engine لازم يلاقي نفس المصادر والأوزان (stand-in الـ
+    qpAdm binary مابيحسبش حاجة فـ recovered هناك مالوش معنى)."""
+    import qpadm_sweep
+    report = qpadm_sweep.load_report(kit_dir, kit_id)
+    if not report or not report["models"]:
+        return None
+    best = report["models"][0]
+    weights = {s["name"]: s["weight"] for s in best["sources"]}
+    recovered = (qpadm_sweep.passes(best) and set(weights) == set(KIT_MIXTURE)
+                 and all(abs(weights[pop] - w) <= MIXTURE_TOLERANCE for pop, w in KIT_MIXTURE.items()))
+    return {"engine": report["engine"], "best": weights, "p_value": best["p_value"], "recovered": recovered}
+
+
+def child_run_kit(args):
+    import resource
+    import process_dna
+    import stage_metrics
+    kit_path, kit_id = Path(args.kit), args.kit_id
+    start = time.perf_counter()
+    process_dna.run_full_pipeline(kit_path, kit_id, via_23file=args.via_23file)
+    wall = time.perf_counter() - start
+
+    stages, tools = {}, {}
+    for record in stage_metrics.load_records(kit_path.parent, kit_id):
+        if record["type"] == "stage":
+            stages[record["stage"]] = {field: record[field] for field in STAGE_FIELDS if field in record}
+        else:
+            tool = tools.setdefault(record["tool"], {"runs": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0,
+                                                     "max_rss_bytes": 0})
+            tool["runs"] += 1
+            tool["wall_seconds"] = round(tool["wall_seconds"] + record["wall_seconds"], 3)
+            tool["cpu_seconds"] = round(tool["cpu_seconds"] + record["cpu_seconds"], 3)
+            tool["max_rss_bytes"] = max(tool["max_rss_bytes"], record["max_rss_bytes"])
+    return {"wall_seconds": round(wall, 3), "peak_rss_bytes": ru_maxrss_bytes(resource.RUSAGE_SELF),
+            "children_peak_rss_bytes": ru_maxrss_bytes(resource.RUSAGE_CHILDREN), "stages": stages, "tools": tools,
+            "qpadm": qpadm_recovery(kit_path.parent, kit_id)}
+
+
+def child_serve(args):
+    """server الـ app على port عشوائي ببيانات kits مكتملة؛ بيقفل لما الـ parent يقفل الـ stdin."""
+    import logging
+    import resource
+    from werkzeug.serving import make_server
+    import app as webapp
+    import kit_results
+    import process_dna
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    webapp.app.config["WTF_CSRF_ENABLED"] = False
+    webapp.init_db()
+    with webapp.app.app_context():
+        user = webapp.User.query.filter_by(email=BENCH_EMAIL).first()
+        if user is None:
+            user = webapp.User(email=BENCH_EMAIL, name="benchmark",
+                               password_hash=webapp.generate_password_hash(BENCH_PASSWORD))
+            webapp.db.session.add(user)
+            webapp.db.session.commit()
+        kit_ids = []
+        for i in range(args.kits):
+            kit_id = f"BENCH{i:04d}"
+            kit_dir = webapp.UPLOAD_FOLDER / kit_id
+            kit_dir.mkdir(parents=True, exist_ok=True)
+            process_dna.link_kit_results(args.source_dir, args.source_kit, kit_dir, kit_id)
+            kit_results.write_kit_results(kit_dir, kit_id, args.panel_version)
+            if webapp.DNAKit.query.filter_by(kit_id=kit_id).first() is None:
+                webapp.db.session.add(webapp.DNAKit(
+                    user_id=user.id, kit_id=kit_id, original_filename="kit.txt", status='completed', progress=100,
+                    panel_version=args.panel_version, finished_at=datetime.utcnow()))
+            kit_ids.append(kit_id)
+        webapp.db.session.commit()
+
+    server = make_server("127.0.0.1", 0, webapp.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"PORT {server.server_port} {','.join(kit_ids)}", flush=True)
+    sys.stdin.read()
+    server.shutdown()
+    return {"peak_rss_bytes": ru_maxrss_bytes(resource.RUSAGE_SELF)}
+
+
+# ---------------------------------------------------------------- route load
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q / 100 * len(sorted_values)))]
+
+
+def load_route(base_url, cookie, paths, concurrency, n_requests):
+    """n_requests على paths (بالتناوب) من concurrency clients → latency percentiles و rps."""
+    latencies, errors = [], 0
+    lock = threading.Lock()
+
+    def hit(i):
+        nonlocal errors
+        request = urllib.request.Request(base_url + paths[i % len(paths)], headers={"Cookie": cookie})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                response.read()
+                ok = response.status == 200
+        except OSError:
+            ok = False
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            errors += not ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(hit, range(n_requests)))
+    wall = time.perf_counter() - start
+    latencies.sort()
+    return {"concurrency": concurrency, "requests": n_requests, "errors": errors,
+            "rps": round(n_requests / wall, 2) if wall else None,
+            **{f"p{q}_ms": round(percentile(latencies, q) * 1000, 2) for q in (50, 95, 99)},
+            "max_ms": round(latencies[-1] * 1000, 2)}
+
+
+def bench_routes(work, source_dir, source_kit, panel_version, n_kits, concurrency, n_requests):
+    result = work / "result_serve.json"
+    result.unlink(missing_ok=True)
+    cmd = [sys.executable, str(Path(__file__).resolve()), "serve", "--work", str(work), "--result", str(result),
+           "--source-dir", str(source_dir), "--source-kit", source_kit, "--kits", str(n_kits)]
+    if panel_version:
+        cmd += ["--panel-version", panel_version]
+    proc = subprocess.Popen(cmd, env=child_env(work), stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    try:
+        for line in proc.stdout:
+            if line.startswith("PORT "):
+                _, port, kits = line.split()
+                break
+        else:
+            raise RuntimeError("الـ server ما بدأش")
+        base_url = f"http://127.0.0.1:{port}"
+        jar = CookieJar()
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+        opener.open(base_url + "/login", urllib.parse.urlencode(
+            {"email": BENCH_EMAIL, "password": BENCH_PASSWORD}).encode()).read()
+        cookie = "; ".join(f"{c.name}={c.value}" for c in jar)
+
+        routes = {"dashboard": ["/dashboard"], "results": [f"/results/{kit_id}" for kit_id in kits.split(",")]}
+        report = {}
+        for name, paths in routes.items():
+            load_route(base_url, cookie, paths, 1, min(10, n_requests))  # warm-up (cache الـ results والـ templates)
+            report[name] = [load_route(base_url, cookie, paths, c, n_requests) for c in concurrency]
+            log(f"route {name}: " + ", ".join(f"c={r['concurrency']} p95={r['p95_ms']}ms rps={r['rps']}"
+                                              for r in report[name]))
+    finally:
+        proc.stdin.close()
+        proc.wait()
+    report["server_peak_rss_bytes"] = json.loads(result.read_text())["peak_rss_bytes"] if result.exists() else None
+    result.unlink(missing_ok=True)
+    return report
+
+
+# ---------------------------------------------------------------- import time
+
+IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{"ms": (time.perf_counter() - start) * 1000, "modules": sorted(sys.modules)}}))
+"""
+
+
+def _import_top(stderr, module, n=5):
+    """أتقل n import بيعملها module مباشرة من -X importtime → [(الاسم, ms تراكمي), ...]."""
+    children = []
+    for line in stderr.splitlines():
+        parts = line.split("|")
+        if not line.startswith("import time:") or len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        # -X importtime بيزوّد مسافتين لكل مستوى nesting، والـ children بتتكتب قبل الـ module بتاعها
+        name, depth = parts[2].strip(), (len(parts[2]) - len(parts[2].lstrip()) - 1) // 2
+        if depth == 1:
+            children.append((name, round(int(parts[1]) / 1000, 1)))
+        elif depth == 0:
+            if name == module:
+                return sorted(children, key=lambda item: -item[1])[:n]
+            children = []
+    return []
+
+
+def import_module_time(work, module, repeat=IMPORT_REPEAT):
+    """import module في process جديد (repeat مرات، median) + الـ modules الممنوعة اللي اتحملت + side effects."""
+    budget, forbidden = IMPORT_BUDGETS[module]
+    env = child_env(work)
+    # مجلد uploads مش موجود – الـ import لازم مايعملوش (بيتعمل في init_db بس)
+    probe_dir = work / "import_probe_uploads"
+    shutil.rmtree(probe_dir, ignore_errors=True)
+    env.update({"UPLOAD_FOLDER": str(probe_dir), "PRELOAD_REFERENCE": "0"})
+    cwd = Path(__file__).resolve().parent
+    times = []
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, "-c", IMPORT_PROBE.format(module=module)], cwd=cwd, env=env,
+                              capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError(f"import {module} فشل:\n{proc.stderr[-4000:]}")
+        probe = json.loads(proc.stdout.strip().splitlines()[-1])
+        times.append(probe["ms"])
+    trace = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=cwd, env=env,
+                           capture_output=True, text=True)
+    loaded = [name for name in forbidden
+              if any(m == name or m.startswith(name + ".") for m in probe["modules"])]
+    budget_ms = budget * IMPORT_BUDGET_SCALE
+    ms = statistics.median(times)
+    return {"module": module, "ms": round(ms, 1), "budget_ms": budget_ms, "modules": len(probe["modules"]),
+            "forbidden_loaded": loaded, "creates_uploads": probe_dir.exists(),
+            "top": _import_top(trace.stderr, module),
+            "ok": ms <= budget_ms and not loaded and not probe_dir.exists()}
+
+
+def check_imports(work, modules=None, repeat=IMPORT_REPEAT):
+    work = Path(work)
+    work.mkdir(parents=True, exist_ok=True)
+    results = []
+    for module in modules or IMPORT_BUDGETS:
+        entry = import_module_time(work, module, repeat)
+        results.append(entry)
+        problems = [f"أكتر من {entry['budget_ms']:.0f} ms"] if entry["ms"] > entry["budget_ms"] else []
+        problems += [f"حمّل {', '.join(entry['forbidden_loaded'])}"] if entry["forbidden_loaded"] else []
+        problems += ["عمل مجلد الـ uploads"] if entry["creates_uploads"] else []
+        top = ", ".join(f"{name} {ms:.0f}" for name, ms in entry["top"][:3])
+        log(f"import {module}: {entry['ms']:.0f} ms ({entry['modules']} module) – "
+            f"{'؛ '.join(problems) or 'تمام'} [{top}]")
+    return results
+
+
+# ---------------------------------------------------------------- run / compare
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _median_stages(runs):
+    names = {name for run in runs for name in run["stages"]}
+    return {name: {field: statistics.median(run["stages"][name][field] for run in runs if name in run["stages"])
+                   for field in ("wall_seconds", "cpu_seconds", "child_cpu_seconds", "max_rss_bytes")}
+            for name in sorted(names)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=Path(__file__).parent, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args):
+    work = Path(args.work)
+    work.mkdir(parents=True, exist_ok=True)
+    tools = install_tools(work / "bin", args.standins)
+    log(f"الأدوات: {tools}")
+    imports = check_imports(work, repeat=args.import_repeat)
+
+    ref_prefix = work / "reference" / "ref_panel"
+    panel_meta = work / "reference" / "synthetic.json"
+    panel_params = {"seed": SEED, "snps": args.panel_snps, "samples_per_pop": args.samples_per_pop,
+                    "layout": PANEL_LAYOUT}
+    if not panel_meta.exists() or json.loads(panel_meta.read_text())["params"] != panel_params:
+        shutil.rmtree(work / "reference", ignore_errors=True)
+        log(f"panel صناعي: {args.panel_snps} SNP × {args.samples_per_pop} sample/population")
+        info = write_panel(ref_prefix, args.panel_snps, args.samples_per_pop)
+        panel_meta.write_text(json.dumps({"params": panel_params, **info}))
+    panel = {**json.loads(panel_meta.read_text()), **run_child(work, "panel", *(["--rebuild"] if args.rebuild_panel else []))}
+    log(f"panel build: {'cache' if panel['cached'] else str(panel['wall_seconds']) + ' ثانية'}")
+
+    kits_dir, runs_dir = work / "kits", work / "runs"
+    kits_dir.mkdir(exist_ok=True)
+    variants = ["bed"] + (["23file"] if args.via_23file else [])
+    results, route_source = [], None
+    for label in args.sizes.split(","):
+        n_snps = parse_size(label)
+        for fmt in args.formats.split(","):
+            kit_file = kits_dir / f"kit_{label}.{FORMATS[fmt]}"
+            if not kit_file.exists():
+                log(f"توليد kit {label} ({fmt})")
+                write_kit(kit_file, fmt, n_snps, args.panel_snps)
+            for variant in variants:
+                runs = []
+                for repeat in range(args.repeat):
+                    kit_id = f"BK_{label}_{fmt}_{variant}_{repeat}"
+                    run_dir = runs_dir / kit_id
+                    shutil.rmtree(run_dir, ignore_errors=True)
+                    run_dir.mkdir(parents=True)
+                    _link_or_copy(kit_file, run_dir / kit_file.name)
+                    extra = ["--via-23file"] if variant == "23file" else []
+                    runs.append(run_child(work, "kit", "--kit", str(run_dir / kit_file.name), "--kit-id", kit_id, *extra,
+                                          panel_snps=args.panel_snps))
+                    if route_source is None:
+                        route_source = (run_dir, kit_id)
+                    elif not args.keep:
+                        shutil.rmtree(run_dir, ignore_errors=True)
+                entry = {"size": label, "snps": n_snps, "format": fmt, "variant": variant,
+                         "file_bytes": kit_file.stat().st_size,
+                         "wall_seconds": statistics.median(r["wall_seconds"] for r in runs),
+                         "peak_rss_bytes": max(r["peak_rss_bytes"] for r in runs),
+                         "stages": _median_stages(runs), "runs": runs}
+                results.append(entry)
+                log(f"kit {label} {fmt} ({variant}): {entry['wall_seconds']:.2f} ثانية، "
+                    f"peak RSS {entry['peak_rss_bytes'] / 2 ** 20:.0f} MiB")
+                missed = [r["qpadm"] for r in runs if r.get("qpadm") and r["qpadm"]["engine"] == "f2"
+                          and not r["qpadm"]["recovered"]]
+                if missed:
+                    log(f"تحذير: الـ qpAdm sweep مالقاش {KIT_MIXTURE} – أحسن موديل {missed[0]['best']} "
+                        f"(p-value {missed[0]['p_value']})")
+
+    routes = None
+    if route_source and not args.skip_routes:
+        routes = bench_routes(work, route_source[0], route_source[1], panel.get("version"), args.route_kits,
+                              [int(c) for c in args.concurrency.split(",")], args.requests)
+
+    report = {
+        "version": BENCH_VERSION,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "host": {"cpus": os.cpu_count(), "platform": platform.platform(), "python": platform.python_version()},
+        "params": {"seed": SEED, "sizes": args.sizes, "formats": args.formats, "repeat": args.repeat,
+                   "variants": variants, "panel": panel_params},
+        "tools": tools,
+        "panel": panel,
+        "kits": results,
+        "routes": routes,
+        "imports": imports,
+    }
+    out = Path(args.out or work / "results" / f"bench_{datetime.now():%Y%m%d_%H%M%S}.json")
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, ensure_ascii=False, indent=2))
+    log(f"النتيجة: {out}")
+    return report
+
+
+def compare(old_path, new_path):
+    """جدول old → new لكل kit/stage و route (نسبة < 1 = أسرع)."""
+    old, new = (json.loads(Path(p).read_text()) for p in (old_path, new_path))
+    index = {(k["size"], k["format"], k["variant"]): k for k in old["kits"]}
+    rows = [("kit", "stage", "old", "new", "ratio")]
+    for kit in new["kits"]:
+        before = index.get((kit["size"], kit["format"], kit["variant"]))
+        if before is None:
+            continue
+        name = f"{kit['size']}/{kit['format']}/{kit['variant']}"
+        pairs = [("total", before["wall_seconds"], kit["wall_seconds"])]
+        pairs += [(stage, before["stages"][stage]["wall_seconds"], values["wall_seconds"])
+                  for stage, values in kit["stages"].items() if stage in before["stages"]]
+        pairs.append(("peak MiB", before["peak_rss_bytes"] / 2 ** 20, kit["peak_rss_bytes"] / 2 ** 20))
+        rows += [(name, stage, f"{a:.2f}", f"{b:.2f}", f"{b / a:.2f}" if a else "-") for stage, a, b in pairs]
+    before_imports = {entry["module"]: entry for entry in old.get("imports") or []}
+    for entry in new.get("imports") or []:
+        before = before_imports.get(entry["module"])
+        if before:
+            rows.append((f"import {entry['module']}", "ms", f"{before['ms']:.1f}", f"{entry['ms']:.1f}",
+                         f"{entry['ms'] / before['ms']:.2f}"))
+    for route in ("dashboard", "results"):
+        if not (old.get("routes") and new.get("routes")):
+            break
+        levels = {r["concurrency"]: r for r in old["routes"][route]}
+        for level in new["routes"][route]:
+            before = levels.get(level["concurrency"])
+            if before:
+                rows.append((f"/{route} c={level['concurrency']}", "p95 ms", f"{before['p95_ms']:.1f}",
+                             f"{level['p95_ms']:.1f}", f"{level['p95_ms'] / before['p95_ms']:.2f}"))
+    widths = [max(len(row[i]) for row in rows) for i in range(5)]
+    for row in rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "standin":
+        STANDINS[sys.argv[2]](sys.argv[3:])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="DeepAncestry benchmark")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="توليد البيانات + قياس الـ stages والـ routes → JSON")
+    run.add_argument("--work", default=str(BENCH_DIR))
+    run.add_argument("--out")
+    run.add_argument("--sizes", default=",".join(SIZES))
+    run.add_argument("--formats", default=",".join(FORMATS))
+    run.add_argument("--repeat", type=int, default=1)
+    run.add_argument("--panel-snps", type=int, default=100_000)
+    run.add_argument("--samples-per-pop", type=int, default=20)
+    run.add_argument("--standins", action="store_true", help="stand-ins لكل الأدوات حتى لو متثبتة")
+    run.add_argument("--via-23file", action="store_true", help="قياس المسار القديم (clean_and_sort_for_plink) كمان")
+    run.add_argument("--rebuild-panel", action="store_true")
+    run.add_argument("--keep", action="store_true", help="سيب مجلدات التشغيل")
+    run.add_argument("--skip-routes", action="store_true")
+    run.add_argument("--route-kits", type=int, default=ROUTE_KITS)
+    run.add_argument("--concurrency", default=",".join(map(str, ROUTE_CONCURRENCY)))
+    run.add_argument("--requests", type=int, default=ROUTE_REQUESTS)
+    run.add_argument("--import-repeat", type=int, default=IMPORT_REPEAT)
+    imports_parser = sub.add_parser("imports", help="وقت import الـ entry points مقابل IMPORT_BUDGETS (exit 1 لو عدّى)")
+    imports_parser.add_argument("--work", default=str(BENCH_DIR))
+    imports_parser.add_argument("--modules", help="مفصولين بـ , (الافتراضي: كل IMPORT_BUDGETS)")
+    imports_parser.add_argument("--repeat", type=int, default=IMPORT_REPEAT)
+    imports_parser.add_argument("--out")
+    cmp_parser = sub.add_parser("compare", help="مقارنة نتيجتين")
+    cmp_parser.add_argument("old")
+    cmp_parser.add_argument("new")
+    # أوامر داخلية (process لكل قياس)
+    for name in ("panel", "kit", "serve"):
+        child = sub.add_parser(name)
+        child.add_argument("--work", required=True)
+        child.add_argument("--result", required=True)
+        child.add_argument("--rebuild", action="store_true")
+        child.add_argument("--kit")
+        child.add_argument("--kit-id")
+        child.add_argument("--via-23file", action="store_true")
+        child.add_argument("--source-dir")
+        child.add_argument("--source-kit")
+        child.add_argument("--panel-version")
+        child.add_argument("--kits", type=int, default=ROUTE_KITS)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run_benchmark(args)
+    elif args.command == "compare":
+        compare(args.old, args.new)
+    elif args.command == "imports":
+        imports = check_imports(args.work, args.modules.split(",") if args.modules else None, args.repeat)
+        if args.out:
+            Path(args.out).write_text(json.dumps(imports, ensure_ascii=False, indent=2))
+        sys.exit(0 if all(entry["ok"] for entry in imports) else 1)
+    else:
+        handler = {"panel": child_build_panel, "kit": child_run_kit, "serve": child_serve}[args.command]
+        Path(args.result).write_text(json.dumps(handler(args)))
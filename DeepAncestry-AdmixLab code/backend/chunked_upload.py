@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+chunked_upload.py – رفع على أجزاء (init / PUT chunk بـ offset / finalize) مباشرة لمجلد الـ kit
+
+كل chunk بيتكتب في <filename>.part ويدخل على sha256 وعلى الـ sniffer في نفس اللحظة: أول MiB من النص
+(بعد فك gzip/zip لو لازم) بيتعمله parse بنفس parser الـ pipeline، فملف مش DNA بيترفض من أول chunk.
+الـ offset المؤكد = حجم الـ .part على القرص، فالاتصال لو وقع الرفع بيكمل من هناك.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import struct
+import zlib
+from datetime import datetime
+from pathlib import Path
+
+import genotype_io
+
+CHUNK_SIZE = 8 * 1024 * 1024
+SNIFF_BYTES = 1024 * 1024
+MIN_SNIFF_SNPS = 50
+STATE_NAME = ".upload.json"
+PART_SUFFIX = ".part"
+
+# (offset, sha256, sniffer) لكل kit في الـ process ده؛ لو الـ chunk جه لـ worker تاني بيتبني من الـ .part
+_sessions = {}
+
+
+class UploadError(ValueError):
+    def __init__(self, message, status=400, reject=False, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.reject = reject  # الملف نفسه مرفوض – الـ kit بيتمسح
+        self.offset = offset
+
+
+class HeadSniffer:
+    """أول SNIFF_BYTES من النص الخام (من خلال gzip/BGZF/zip) → format وعدد الـ SNPs الصالحة فيهم."""
+
+    def __init__(self):
+        self.raw = bytearray()
+        self.text = bytearray()
+        self.decoders = None
+        self.result = None
+
+    def _start(self):
+        # محتاجين أول bytes عشان نعرف الـ container؛ zip محتاج الـ local header كامل
+        if self.raw[:2] == genotype_io.GZIP_MAGIC:
+            return [(31, zlib.decompressobj(31))], 0, None
+        if self.raw[:4] == genotype_io.ZIP_MAGIC:
+            if len(self.raw) < 30:
+                return None
+            method, = struct.unpack('<H', self.raw[8:10])
+            name_len, extra_len = struct.unpack('<HH', self.raw[26:30])
+            start = 30 + name_len + extra_len
+            if len(self.raw) < start:
+                return None
+            name = bytes(self.raw[30:30 + name_len]).decode('utf-8', errors='replace')
+            if method not in (0, 8):
+                raise UploadError("ضغط zip غير مدعوم (deflate بس)", status=415, reject=True)
+            return [(-15, zlib.decompressobj(-15))] if method == 8 else [], start, name
+        return [], 0, None
+
+    def feed(self, data):
+        if self.result is not None:
+            return self.result
+        if self.decoders is None:
+            self.raw += data
+            started = self._start()
+            if started is None:
+                return None
+            self.decoders, start, member = started
+            if member and member.lower().endswith(genotype_io.PLINK_EXTENSIONS):
+                # zip فيه fileset PLINK – مفيش نص نعمله parse؛ الـ pipeline بيتأكد من الـ .bed/.bim/.fam
+                self.result = {"format": "plink", "snps": None, "ok": True}
+                return self.result
+            data, self.raw = bytes(self.raw[start:]), None
+
+        try:
+            data = self._decode(data)
+            if not self.text and data[:2] == genotype_io.GZIP_MAGIC:
+                # zip جواه .gz
+                self.decoders.append((31, zlib.decompressobj(31)))
+                data = self._decode(data, first=len(self.decoders) - 1)
+        except zlib.error as e:
+            raise UploadError(f"الملف المضغوط تالف: {e}", status=415, reject=True)
+        self.text += data
+        if len(self.text) >= SNIFF_BYTES:
+            self.result = self._evaluate(final=False)
+        return self.result
+
+    def _decode(self, data, first=0):
+        for i in range(first, len(self.decoders)):
+            wbits, decoder = self.decoders[i]
+            out = decoder.decompress(data, SNIFF_BYTES)
+            # gzip متعدد الـ members (BGZF): member خلص والباقي بيبدأ member جديد
+            while wbits == 31 and decoder.eof and decoder.unused_data and len(out) < SNIFF_BYTES:
+                rest = decoder.unused_data
+                decoder = zlib.decompressobj(31)
+                self.decoders[i] = (wbits, decoder)
+                out += decoder.decompress(rest, SNIFF_BYTES - len(out))
+            data = out
+        return data
+
+    def finish(self):
+        if self.result is None:
+            self.result = self._evaluate(final=True)
+        return self.result
+
+    def _evaluate(self, final):
+        text = bytes(self.text[:SNIFF_BYTES])
+        if not final:
+            text = text[:text.rfind(b'\n') + 1]  # آخر سطر ممكن يكون مقطوع
+        fmt = 'vcf' if text.startswith(genotype_io.VCF_MAGIC) else 'text'
+        lines = text.splitlines(keepends=True)
+        state = {'skipped': 0, 'header_skipped': False}
+        if fmt == 'vcf':
+            block = genotype_io.parse_vcf_chunk(lines, state)
+        else:
+            delimiter = b'\t' if b'\t' in text[:2048] else b','
+            block = genotype_io.parse_chunk(lines, delimiter, state)
+        snps = 0 if block is None else len(block.key)
+        ok = snps >= MIN_SNIFF_SNPS or (final and snps > 0)
+        return {"format": fmt, "snps": snps, "skipped": state['skipped'], "ok": ok}
+
+
+def _state_path(kit_dir):
+    return Path(kit_dir) / STATE_NAME
+
+
+def load_state(kit_dir):
+    path = _state_path(kit_dir)
+    if not path.exists():
+        raise UploadError("مفيش رفع شغال للـ kit ده", status=404)
+    return json.loads(path.read_text(encoding='utf-8'))
+
+
+def _save_state(kit_dir, state):
+    path = _state_path(kit_dir)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(state, ensure_ascii=False), encoding='utf-8')
+    os.replace(tmp, path)
+
+
+def part_path(kit_dir, state):
+    return Path(kit_dir) / (state["filename"] + PART_SUFFIX)
+
+
+def init_upload(kit_dir, filename, size):
+    kit_dir = Path(kit_dir)
+    kit_dir.mkdir(parents=True, exist_ok=True)
+    state = {"filename": filename, "size": int(size), "created_at": datetime.utcnow().isoformat(), "sniff": None}
+    part_path(kit_dir, state).touch()
+    _save_state(kit_dir, state)
+    return state
+
+
+def upload_offset(kit_dir):
+    state = load_state(kit_dir)
+    return state, part_path(kit_dir, state).stat().st_size
+
+
+def _session(kit_dir, state, offset):
+    """sha256 + sniffer عند offset؛ لو مش في الذاكرة (restart أو worker تاني) بيتبنوا من الـ .part."""
+    key = str(kit_dir)
+    cached = _sessions.get(key)
+    if cached and cached[0] == offset:
+        return cached
+    digest, sniffer = hashlib.sha256(), HeadSniffer()
+    with open(part_path(kit_dir, state), 'rb') as f:
+        for data in iter(lambda: f.read(genotype_io.READ_SIZE), b''):
+            digest.update(data)
+            sniffer.feed(data)
+    _sessions[key] = (offset, digest, sniffer)
+    return _sessions[key]
+
+
+def write_chunk(kit_dir, offset, stream):
+    """يكتب chunk بيبدأ عند offset (لازم = المؤكد) → {"offset", "sniff"}؛ UploadError لو الـ offset غلط أو الملف مرفوض."""
+    state = load_state(kit_dir)
+    path = part_path(kit_dir, state)
+    with open(path, 'ab') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadError("في chunk تاني بيترفع للـ kit ده دلوقتي", status=409)
+        current = f.tell()
+        if offset != current:
+            raise UploadError(f"الـ offset المتوقع {current}", status=409, offset=current)
+        _, digest, sniffer = _session(kit_dir, state, current)
+
+        written = 0
+        for data in iter(lambda: stream.read(genotype_io.READ_SIZE), b''):
+            if current + written + len(data) > state["size"]:
+                raise UploadError("البيانات أكبر من الحجم المعلن", status=413, reject=True)
+            f.write(data)
+            digest.update(data)
+            written += len(data)
+            if state["sniff"] is None and sniffer.feed(data) is not None:
+                if not sniffer.result["ok"]:
+                    raise UploadError("الملف مش شبه ملف DNA خام (مفيش SNPs صالحة في أوله)", status=415, reject=True)
+                state["sniff"] = sniffer.result
+                _save_state(kit_dir, state)
+        f.flush()
+        os.fsync(f.fileno())
+        _sessions[str(kit_dir)] = (current + written, digest, sniffer)
+        return {"offset": current + written, "sniff": state["sniff"]}
+
+
+def finalize_upload(kit_dir, expected_sha256=None):
+    """الـ .part كامل → اسمه النهائي؛ يرجّع {"path", "sha256", "sniff"}."""
+    state, offset = upload_offset(kit_dir)
+    if offset != state["size"]:
+        raise UploadError(f"الرفع لسه ناقص ({offset} من {state['size']})", status=409, offset=offset)
+    _, digest, sniffer = _session(kit_dir, state, offset)
+    sniff = state["sniff"] or sniffer.finish()
+    if not sniff["ok"]:
+        raise UploadError("الملف مش شبه ملف DNA خام (مفيش SNPs صالحة)", status=415, reject=True)
+    sha256 = digest.hexdigest()
+    if expected_sha256 and expected_sha256.lower() != sha256:
+        raise UploadError("الـ checksum مش مطابق – ارفع الملف تاني", status=422, reject=True)
+
+    final = Path(kit_dir) / state["filename"]
+    os.replace(part_path(kit_dir, state), final)
+    _state_path(kit_dir).unlink()
+    _sessions.pop(str(kit_dir), None)
+    return {"path": final, "sha256": sha256, "sniff": sniff}
+
+
+def discard_session(kit_dir):
+    _sessions.pop(str(kit_dir), None)
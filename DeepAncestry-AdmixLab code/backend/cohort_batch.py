@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+cohort_batch.py – دفعة kits في pass وحدة: merge مع الـ ref_panel و prune و PCA و ADMIXTURE و convertf مرة للدفعة
+
+الـ clean لكل kit لوحده (بالـ stage cache بتاعه + إعادة استخدام نتايج kit مطابق)، بعدين الـ stages
+الجماعية على ملف cohort واحد، والنتايج بتتقسم لمجلد كل kit بنفس أسماء <kit_id>_* اللي app.results بيقراها.
+من غير panel build، الـ PCA و ADMIXTURE unsupervised بيتحسبوا على الدفعة كلها مع الـ ref_panel.
+"""
+
+import os
+import shutil
+from contextlib import ExitStack
+from pathlib import Path
+
+import admixture_runner
+import genotype_io
+import kit_results
+import process_dna
+import reference_panel
+import resource_governor
+import stage_cache
+import stage_metrics
+from process_dna import log
+
+
+def kit_log_path(ctx):
+    return ctx["kit_dir"] / f"{ctx['kit_id']}_process.log"
+
+
+def kit_metrics_path(ctx):
+    return stage_metrics.metrics_path(ctx["kit_dir"], ctx["kit_id"])
+
+
+def merge_cohort(kit_bfiles, ref_bed, out_prefix, ids):
+    """الـ ref_panel (لو موجود) + كل الـ kits → bfile وحد؛ kit وحيد من غير ref بيرجع زي ما هو."""
+    if Path(f"{ref_bed}.bed").exists():
+        # كل kit بيتعمله harmonization على فهرس الـ panel، وبعدين صفوف التقاطع + عمود لكل kit
+        index = reference_panel.load_snp_index(ref_bed)
+        kits = []
+        for kit_bfile, (_, kit_id) in zip(kit_bfiles, ids):
+            panel_idx, g, stats = reference_panel.harmonize_kit(index, kit_bfile)
+            log(f"{kit_id}: {reference_panel.overlap_message(stats)}")
+            reference_panel.check_overlap(stats)
+            kits.append((panel_idx, g))
+        return reference_panel.merge_with_panel(ref_bed, kits, ids, out_prefix)
+
+    filesets = list(kit_bfiles)
+    if len(filesets) == 1:
+        return filesets[0]
+    merge_list = f"{out_prefix}_merge_list.txt"
+    with open(merge_list, "w") as f:
+        f.write("".join(f"{prefix}\n" for prefix in filesets))
+    rest_list = f"{out_prefix}_merge_rest.txt"
+    with open(rest_list, "w") as f:
+        f.write("".join(f"{prefix}\n" for prefix in filesets[1:]))
+    # kits بس من غير panel: مفيش فهرس للـ harmonization، فـ plink هو اللي بيحل الأليلات
+    process_dna.run_cmd(
+        ["plink2", "--pmerge-list", merge_list, "bfile", "--make-bed", "--out", out_prefix, "--allow-extra-chr"],
+        fallback_cmd=["plink", "--bfile", filesets[0], "--merge-list", rest_list, "--make-bed",
+                      "--out", out_prefix, "--allow-no-sex"])
+    return out_prefix
+
+
+def split_eigenvec(cohort_prefix, ctxs):
+    """صف كل kit من eigenvec الدفعة → <kit>_pca.eigenvec (header + صف الـ kit) و eigenval زي ما هو."""
+    rows = {}
+    with open(f"{cohort_prefix}.eigenvec") as f:
+        header = f.readline()
+        id_col = header.split().index("IID")
+        for line in f:
+            parts = line.split()
+            rows[parts[id_col]] = line
+    for ctx in ctxs:
+        with open(f"{ctx['pca_prefix']}.eigenvec", "w") as out:
+            out.write(header + rows[ctx["kit_id"]])
+        shutil.copyfile(f"{cohort_prefix}.eigenval", f"{ctx['pca_prefix']}.eigenval")
+
+
+def split_admixture(outputs, fam_ids, ctxs, keep_p):
+    """صف كل kit من .Q الدفعة (بترتيب الـ .fam) → <kit>.K<k>.Q؛ الـ .P مشترك فبيتنسخ لكل kit."""
+    row_of = {iid: i for i, (_, iid) in enumerate(fam_ids)}
+    produced = {ctx["kit_id"]: [] for ctx in ctxs}
+    for k, (q_file, p_file) in outputs.items():
+        q_rows = Path(q_file).read_text().splitlines()
+        for ctx in ctxs:
+            kit_id, kit_dir = ctx["kit_id"], ctx["kit_dir"]
+            (kit_dir / f"{kit_id}.K{k}.Q").write_text(q_rows[row_of[kit_id]] + "\n")
+            produced[kit_id].append(str(kit_dir / f"{kit_id}.K{k}.Q"))
+            if keep_p and Path(p_file).exists():
+                shutil.copyfile(p_file, kit_dir / f"{kit_id}.K{k}.P")
+    return produced
+
+
+def run_cohort_stages(ctxs, trackers, work_dir):
+    """الـ stages الجماعية (merge → prune → PCA → ADMIXTURE → convertf → qpAdm) لكل الـ kits مع بعض."""
+    first = ctxs[0]
+    panel_pca, p_files, ref_bed = first["panel_pca"], first["p_files"], first["ref_bed"]
+    cohort_prefix = str(work_dir / "cohort")
+    ids = [(ctx["kit_id"], ctx["kit_id"]) for ctx in ctxs]
+    cohort_ctx = {"pruned_prefix": f"{cohort_prefix}_pruned", "threads": first["threads"],
+                  "memory_mb": first["memory_mb"], "eigen_prefix": f"{cohort_prefix}_eigen", "kit_dir": work_dir,
+                  "kit_id": f"cohort({len(ctxs)})", "has_ref": first["has_ref"], "ref_bed": ref_bed,
+                  "exact_prune": first["exact_prune"]}
+
+    def stage(name, func, outputs=None):
+        for ctx in ctxs:
+            trackers[ctx["kit_id"]](name, "start")
+        # حجز وحد للدفعة كلها من الـ governor – cohort_ctx["threads"] هو اللي الأدوات بتاخده
+        min_cores, max_cores, memory_mb = process_dna.STAGE_RESOURCES[name]
+        with resource_governor.allocate(name, cohort_ctx["kit_id"], min_cores, max_cores, memory_mb,
+                                        log=log) as grant:
+            cohort_ctx["threads"], cohort_ctx["memory_mb"] = str(grant["cores"]), grant["memory_mb"]
+            # الـ record بيتكتب في <kit>_metrics.jsonl لكل kit في الدفعة
+            with stage_metrics.measure(name, cohort_ctx["kit_id"], threads=grant["cores"],
+                                       memory_mb=grant["memory_mb"], kits=len(ctxs),
+                                       queued_seconds=round(grant["granted_at"] - grant["since"], 3)) as record:
+                result = func()
+                if outputs:
+                    record.update(stage_metrics.count_outputs(outputs(result)))
+        for ctx in ctxs:
+            trackers[ctx["kit_id"]](name, "done")
+        return result
+
+    log(f"دمج الدفعة ({len(ctxs)} kit) مع ref_panel مرة وحدة")
+    base = cohort_ctx["base_prefix"] = stage(
+        "merge", lambda: merge_cohort([ctx["kit_bfile"] for ctx in ctxs], ref_bed, f"{cohort_prefix}_merged", ids),
+        outputs=process_dna.bfile_paths)
+    stage("prune", lambda: process_dna.stage_prune(cohort_ctx), outputs=lambda result: result["outputs"])
+
+    def pca():
+        if panel_pca is not None:
+            for ctx in ctxs:
+                process_dna.stage_pca(ctx)
+        else:
+            log("PCA للدفعة على المواقع المختارة (مفيش panel build)")
+            process_dna.run_cmd(["plink2", "--bfile", base, "--extract", f"{cohort_ctx['pruned_prefix']}.prune.in",
+                                 "--pca", "30", "--threads", cohort_ctx["threads"],
+                                 "--memory", str(cohort_ctx["memory_mb"]), "--out", f"{cohort_prefix}_pca"])
+            split_eigenvec(f"{cohort_prefix}_pca", ctxs)
+    stage("pca", pca)
+
+    def admixture():
+        ks = admixture_runner.ADMIXTURE_KS
+        if p_files:
+            log(f"Admixture projection (-P) للدفعة لـ K={ks}")
+            aligned = reference_panel.align_cohort(panel_pca, [ctx["kit_bfile"] for ctx in ctxs], ref_bed,
+                                                   f"{cohort_prefix}_panel", ids)
+            outputs = admixture_runner.run_admixture_jobs(aligned, ks, work_dir / "admixture", p_files=p_files,
+                                                          budget=int(cohort_ctx["threads"]))
+            split_admixture(outputs, ids, ctxs, keep_p=False)
+        else:
+            log(f"Admixture كامل (unsupervised) للدفعة لـ K={ks}")
+            outputs = admixture_runner.run_admixture_jobs(base, ks, work_dir / "admixture",
+                                                          budget=int(cohort_ctx["threads"]))
+            split_admixture(outputs, genotype_io.read_fam_ids(base), ctxs, keep_p=True)
+    stage("admixture", admixture)
+
+    if first["f2"] is not None:
+        # كل kit ضد f2 الـ panel – مفيش convertf للدفعة
+        for ctx in ctxs:
+            trackers[ctx["kit_id"]]("qpadm", "start")
+            process_dna.governed("qpadm", ctx, process_dna.stage_qpadm)
+            trackers[ctx["kit_id"]]("qpadm", "done")
+    elif process_dna.eigenstrat_ready(first):
+        # EIGENSTRAT الـ panel من الـ cache + عمود لكل kit في الدفعة
+        stage("convertf", lambda: process_dna.stage_convertf(cohort_ctx, [ctx["kit_bfile"] for ctx in ctxs], ids))
+        # qpAdm sweep لكل kit (الـ kit نفسه target) على ملفات EIGENSTRAT الدفعة
+        for ctx in ctxs:
+            trackers[ctx["kit_id"]]("qpadm", "start")
+            process_dna.governed("qpadm", {**ctx, "eigen_prefix": cohort_ctx["eigen_prefix"]}, process_dna.stage_qpadm)
+            trackers[ctx["kit_id"]]("qpadm", "done")
+
+
+def run_cohort(kits, work_dir, reuse_lookup=None, progress=None):
+    """kits = [(filepath, kit_id)] → {kit_id: summary أو Exception}.
+
+    progress(kit_id, percent, stage, event). لو الـ pass الجماعي فشل، كل kit بيتشغل لوحده بـ run_full_pipeline
+    (الـ clean بتاعه من الـ cache)."""
+    progress = progress or (lambda kit_id, percent, stage, event: None)
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    outcomes, ctxs, trackers, caches, fingerprints = {}, [], {}, {}, {}
+
+    try:
+        for filepath, kit_id in kits:
+            try:
+                ctx = process_dna.kit_context(filepath, kit_id)
+            except Exception as e:
+                outcomes[kit_id] = e
+                continue
+            with process_dna.log_to(kit_log_path(ctx)), stage_metrics.record_to(kit_metrics_path(ctx)):
+                tracker = process_dna.StageProgress(
+                    process_dna.stage_plan(ctx),
+                    lambda percent, stage, event, kit_id=kit_id: progress(kit_id, percent, stage, event))
+                cache = stage_cache.StageCache(ctx["kit_dir"] / f"{kit_id}_stages.json", log=log, on_stage=tracker)
+                try:
+                    fingerprint = process_dna.prepare_kit(ctx, cache)
+                except Exception as e:
+                    log(f"خطأ: {e}")
+                    outcomes[kit_id] = e
+                    continue
+                summary = {"fingerprint": fingerprint, "panel_version": ctx["panel_version"], "reused_from": None}
+                source = reuse_lookup(kit_id, fingerprint, ctx["panel_version"]) if reuse_lookup else None
+                if source is not None:
+                    src_dir, src_kit = source
+                    linked = process_dna.link_kit_results(src_dir, src_kit, ctx["kit_dir"], kit_id)
+                    log(f"نفس بيانات {src_kit} على نفس الـ panel – ربط {len(linked)} ملف نتائج بدل إعادة الحساب")
+                    process_dna.store_relatives(ctx, cache)
+                    kit_results.write_kit_results(ctx["kit_dir"], kit_id, ctx["panel_version"])
+                    tracker.progress(100, "reuse", "done")
+                    outcomes[kit_id] = {**summary, "reused_from": src_kit}
+                    continue
+            ctxs.append(ctx)
+            trackers[kit_id] = tracker
+            caches[kit_id] = cache
+            fingerprints[kit_id] = summary
+
+        if not ctxs:
+            return outcomes
+
+        try:
+            with ExitStack() as stack:
+                for ctx in ctxs:
+                    stack.enter_context(process_dna.log_to(kit_log_path(ctx)))
+                    stack.enter_context(stage_metrics.record_to(kit_metrics_path(ctx)))
+                run_cohort_stages(ctxs, trackers, work_dir)
+                for ctx in ctxs:
+                    # مطابقة الأقارب لكل kit لوحده (المخزن append-only – kits الدفعة بتتطابق مع بعض كمان)
+                    process_dna.store_relatives(ctx, caches[ctx["kit_id"]])
+                    kit_results.write_kit_results(ctx["kit_dir"], ctx["kit_id"], ctx["panel_version"])
+                    outcomes[ctx["kit_id"]] = fingerprints[ctx["kit_id"]]
+                log(f"★ انتهت الدفعة ({len(ctxs)} kit)")
+        except Exception as e:
+            # الدفعة فشلت (مثلاً kit بيكسر الـ merge) – كل kit لوحده عشان الباقيين مايقعوش معاه
+            for ctx in ctxs:
+                kit_id = ctx["kit_id"]
+                with process_dna.log_to(kit_log_path(ctx)):
+                    log(f"فشل الـ pass الجماعي ({e}) – تشغيل الـ kit لوحده")
+                    try:
+                        outcomes[kit_id] = process_dna.run_full_pipeline(
+                            ctx["filepath"], kit_id,
+                            reuse_lookup=(lambda fp, pv, kit_id=kit_id: reuse_lookup(kit_id, fp, pv)) if reuse_lookup else None,
+                            progress=lambda percent, stage, event, kit_id=kit_id: progress(kit_id, percent, stage, event))
+                    except Exception as kit_error:
+                        outcomes[kit_id] = kit_error
+        return outcomes
+    finally:
+        # ملف الدفعة فيه genotypes كل الـ kits – مايفضلش على القرص
+        shutil.rmtree(work_dir, ignore_errors=True)
+        for ctx in ctxs:
+            if ctx["temp_clean"].exists():
+                os.unlink(ctx["temp_clean"])
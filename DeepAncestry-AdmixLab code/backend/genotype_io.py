@@ -0,0 +1,661 @@
+# -*- coding: utf-8 -*-
+"""
+genotype_io.py – Streaming genotype parser (chunks + NumPy columns + sorted runs)
+
+كل chunk يتحول لأعمدة NumPy: key (chrom << 40 | pos) + genotype S2 + rsid.
+الترتيب يتم بـ sorted runs على القرص ثم k-way merge، فالذاكرة محدودة مهما كان حجم الملف.
+المدخلات: نص 23andMe/Ancestry/MyHeritage أو VCF، خام أو .gz/.zip (بدون فك على القرص)،
+و VCF بصيغة BGZF يتقسم على blocks ويتقرأ بالتوازي.
+"""
+
+import gzip
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+import zipfile
+import zlib
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+CHUNK_ROWS = 500_000
+MERGE_BLOCK_ROWS = 200_000
+READ_SIZE = 1 << 22
+
+POS_BITS = 40
+POS_MASK = (1 << POS_BITS) - 1
+
+NO_CALL = b'--'
+NO_CALL_GENOS = {b'II', b'DD', b'00', b'..', b'XX'}
+
+CHROM_CODES = {b'X': 23, b'Y': 24, b'MT': 26, b'M': 26}
+# code -> label كما يكتبها الـ 23file (الفهرس = رقم الكروموسوم)
+CHROM_LABELS = np.array([b''] + [str(i).encode() for i in range(1, 23)] + [b'X', b'Y', b'', b'MT'], dtype='S2')
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZIP_MAGIC = b'PK\x03\x04'
+VCF_MAGIC = b'##fileformat=VCF'
+PLINK_EXTENSIONS = ('.bed', '.bim', '.fam')
+
+# BGZF أصغر من كده مش مستاهل process pool
+PARALLEL_MIN_BYTES = 16 * 1024 * 1024
+
+GenotypeBlock = namedtuple("GenotypeBlock", "key geno rsid")
+RunInfo = namedtuple("RunInfo", "prefix first last presorted rows")
+
+
+def chrom_code(label):
+    label = label.strip().upper().replace(b'CHR', b'')
+    code = CHROM_CODES.get(label, int(label) if label.isdigit() else None)
+    if code is None or not (1 <= code <= 26 and code != 25):
+        return 0
+    return code
+
+
+def normalize_geno(raw):
+    clean = raw.strip().upper().replace(b' ', b'').replace(b'/', b'').replace(b'|', b'')
+    geno = clean[:2] if len(clean) >= 2 else NO_CALL
+    return NO_CALL if geno in NO_CALL_GENOS else geno
+
+
+def vcf_geno(combo):
+    # combo = REF \t ALT \t GT → genotype بحرفين زي الـ 23file (indels/no-call → '--')
+    ref, alt, gt = combo.split(b'\t')
+    alleles = [ref] + alt.split(b',')
+    calls = gt.replace(b'|', b'/').split(b'/')
+    bases = []
+    for call in calls:
+        if not call.isdigit() or int(call) >= len(alleles):
+            return NO_CALL
+        base = alleles[int(call)].upper()
+        if len(base) != 1 or base not in b'ACGT':
+            return NO_CALL
+        bases.append(base)
+    if len(bases) == 1:
+        bases.append(bases[0])
+    return normalize_geno(b''.join(bases[:2]))
+
+
+def _map_unique(column, func, dtype):
+    # القيم المختلفة في العمود قليلة (كروموسومات / genotypes) – نحسبها مرة وحدة لكل قيمة
+    uniq, inverse = np.unique(column, return_inverse=True)
+    return np.array([func(u) for u in uniq], dtype=dtype)[inverse]
+
+
+# ---------------------------------------------------------------- input layer
+
+def _read_head(path, size=64):
+    with open(path, 'rb') as f:
+        return f.read(size)
+
+
+def _zip_member(zf):
+    members = [i for i in zf.infolist() if not i.is_dir() and not i.filename.startswith('__MACOSX/')]
+    if not members:
+        raise ValueError("ملف zip فاضي")
+    return max(members, key=lambda i: i.file_size)
+
+
+@contextmanager
+def open_genotype_stream(path):
+    """stream ثنائي للنص الخام، مهما كان مضغوط gzip/BGZF أو zip."""
+    head = _read_head(path, 4)
+    if head[:2] == GZIP_MAGIC:
+        with gzip.open(path, 'rb') as f:
+            yield f
+    elif head == ZIP_MAGIC:
+        with zipfile.ZipFile(path) as zf:
+            member = _zip_member(zf)
+            with zf.open(member) as raw:
+                if raw.peek(2)[:2] == GZIP_MAGIC:
+                    with gzip.GzipFile(fileobj=raw) as f:
+                        yield f
+                else:
+                    yield raw
+    else:
+        with open(path, 'rb') as f:
+            yield f
+
+
+def is_bgzf(path):
+    head = _read_head(path, 18)
+    return len(head) == 18 and head[:2] == GZIP_MAGIC and head[3] & 4 and head[12:14] == b'BC'
+
+
+def sniff_input_format(path):
+    """'plink' أو 'vcf' أو 'text'."""
+    path = Path(path)
+    if path.suffix.lower() in PLINK_EXTENSIONS:
+        return 'plink'
+    if _read_head(path, 4) == ZIP_MAGIC:
+        with zipfile.ZipFile(path) as zf:
+            if any(n.lower().endswith('.bed') for n in zf.namelist()):
+                return 'plink'
+    with open_genotype_stream(path) as f:
+        head = f.read(len(VCF_MAGIC))
+    return 'vcf' if head == VCF_MAGIC else 'text'
+
+
+def plink_fileset_prefix(path, dest_dir):
+    """prefix جاهز لـ --bfile: الملفات الثلاثة جنب الملف المرفوع أو جوه zip."""
+    path = Path(path)
+    if path.suffix.lower() in PLINK_EXTENSIONS:
+        prefix = path.with_suffix('')
+    else:
+        # .bed لازم يكون على القرص عشان plink – نفك الملفات الثلاثة بس
+        with zipfile.ZipFile(path) as zf:
+            names = {Path(n).suffix.lower(): n for n in zf.namelist() if Path(n).suffix.lower() in PLINK_EXTENSIONS}
+            if len(names) != len(PLINK_EXTENSIONS):
+                return None
+            prefix = Path(dest_dir) / Path(names['.bed']).stem
+            for ext, name in names.items():
+                with zf.open(name) as src, open(f"{prefix}{ext}", 'wb') as dst:
+                    while True:
+                        data = src.read(READ_SIZE)
+                        if not data:
+                            break
+                        dst.write(data)
+    if all(Path(f"{prefix}{ext}").exists() for ext in PLINK_EXTENSIONS):
+        return str(prefix)
+    return None
+
+
+def _iter_line_chunks(pieces, chunk_rows):
+    lines, tail = [], b''
+    for data in pieces:
+        parts = (tail + data).split(b'\n')
+        tail = parts.pop()
+        lines.extend(parts)
+        while len(lines) >= chunk_rows:
+            yield lines[:chunk_rows]
+            lines = lines[chunk_rows:]
+    if tail:
+        lines.append(tail)
+    if lines:
+        yield lines
+
+
+def _iter_file_pieces(f):
+    return iter(lambda: f.read(READ_SIZE), b'')
+
+
+# ---------------------------------------------------------------- parsers
+
+def parse_chunk(lines, delimiter, state):
+    """يحوّل chunk أسطر نص خام لـ GenotypeBlock (بدون ترتيب) ويحدّث state['skipped']."""
+    rows = [line.rstrip(b'\r\n').split(delimiter) for line in lines]
+    rows = [r for r in rows if len(r) >= 4 and r[0].strip()]
+    if not rows:
+        return None
+
+    rsid = np.array([r[0].strip().strip(b'"') for r in rows])
+    if not state['header_skipped']:
+        lowered = np.char.lower(rsid)
+        header = np.flatnonzero((np.char.find(lowered, b'rsid') >= 0) | np.char.startswith(rsid, b'#'))
+        if header.size:
+            state['header_skipped'] = True
+            keep = np.ones(len(rows), dtype=bool)
+            keep[header[0]] = False
+            rows = [r for r, k in zip(rows, keep) if k]
+            rsid = rsid[keep]
+            if not rows:
+                return None
+
+    chrom = np.array([r[1].strip(b' "') for r in rows])
+    pos = np.array([r[2].strip(b' "') for r in rows])
+    # Ancestry: allele1 + allele2 في عمودين منفصلين
+    geno = np.array([
+        r[3].strip(b' "') + r[4].strip(b' "') if len(r) >= 5 and len(r[3].strip(b' "')) == 1 else r[3].strip(b'"')
+        for r in rows
+    ])
+    return _build_block(rsid, chrom, pos, geno, normalize_geno, state)
+
+
+def _gt_field(fmt, sample):
+    keys = fmt.split(b':')
+    if b'GT' not in keys:
+        return b'.'
+    values = sample.split(b':')
+    idx = keys.index(b'GT')
+    return values[idx] if idx < len(values) else b'.'
+
+
+def parse_vcf_chunk(lines, state):
+    """VCF بعينة واحدة (أول عمود بعد FORMAT) → GenotypeBlock."""
+    rows = [line.rstrip(b'\r\n').split(b'\t', 10) for line in lines if line and not line.startswith(b'#')]
+    rows = [r for r in rows if len(r) >= 10]
+    if not rows:
+        return None
+
+    chrom = np.array([r[0] for r in rows])
+    pos = np.array([r[1] for r in rows])
+    ident = np.array([r[2] for r in rows])
+    combo = np.array([
+        b'\t'.join((r[3], r[4], r[9].split(b':', 1)[0] if r[8].startswith(b'GT') else _gt_field(r[8], r[9])))
+        for r in rows
+    ])
+    # ID = '.' → chrom:pos عشان الـ 23file محتاج معرف لكل SNP
+    rsid = np.where(ident == b'.', np.char.add(np.char.add(chrom, b':'), pos), ident)
+    return _build_block(rsid, chrom, pos, combo, vcf_geno, state)
+
+
+def _build_block(rsid, chrom, pos, geno, geno_func, state):
+    pos_ok = np.char.isdigit(pos) & (np.char.str_len(pos) <= 12)
+    codes = _map_unique(chrom, chrom_code, np.int64)
+    valid = pos_ok & (codes > 0)
+    state['skipped'] += int(len(rsid) - np.count_nonzero(valid))
+    if not valid.any():
+        return None
+
+    key = (codes[valid] << POS_BITS) | pos[valid].astype(np.int64)
+    return GenotypeBlock(key, _map_unique(geno[valid], geno_func, 'S2'), rsid[valid])
+
+
+def _parse_lines(line_chunks, fmt, state, delimiter=b'\t'):
+    for lines in line_chunks:
+        if fmt == 'vcf':
+            block = parse_vcf_chunk(lines, state)
+        else:
+            block = parse_chunk(lines, delimiter, state)
+        if block is not None:
+            yield block
+
+
+def iter_genotype_chunks(input_path, state, chunk_rows=CHUNK_ROWS):
+    fmt = sniff_input_format(input_path)
+    if fmt == 'plink':
+        raise ValueError("ملفات PLINK الثنائية مش محتاجة تنظيف")
+    with open_genotype_stream(input_path) as f:
+        sample = f.read(2048)
+        delimiter = b'\t' if b'\t' in sample else b','
+        pieces = _iter_file_pieces(f)
+        yield from _parse_lines(_iter_line_chunks(_chain(sample, pieces), chunk_rows), fmt, state, delimiter)
+
+
+def _chain(first, rest):
+    # نرجع الـ sample المقروء للـ stream بدل seek (الـ zip/gzip seek للخلف بطيء)
+    yield first
+    yield from rest
+
+
+# ---------------------------------------------------------------- BGZF parallel
+
+def _bgzf_blocks(path):
+    offsets = []
+    with open(path, 'rb') as f:
+        offset = 0
+        while True:
+            head = f.read(18)
+            if len(head) < 18:
+                break
+            if head[:2] != GZIP_MAGIC or head[12:14] != b'BC':
+                return None
+            offsets.append(offset)
+            offset += struct.unpack('<H', head[16:18])[0] + 1
+            f.seek(offset)
+    offsets.append(offset)
+    return offsets
+
+
+def _inflate_blocks(f, offsets, first, last):
+    # يفك blocks من first لحد last (exclusive) واحد واحد
+    for i in range(first, last):
+        f.seek(offsets[i])
+        data = f.read(offsets[i + 1] - offsets[i])
+        yield zlib.decompressobj(31).decompress(data)
+
+
+def _iter_bgzf_range(path, offsets, first, last):
+    # كل سطر ملك الـ range اللي فيه أول byte منه
+    n_blocks = len(offsets) - 1
+    with open(path, 'rb') as f:
+        at_line_start = first == 0
+        for i in range(first - 1, -1, -1):
+            prev = next(_inflate_blocks(f, offsets, i, i + 1))
+            if prev:
+                at_line_start = prev.endswith(b'\n')
+                break
+        else:
+            at_line_start = True
+
+        ended = True
+        for data in _inflate_blocks(f, offsets, first, last):
+            if not at_line_start:
+                cut = data.find(b'\n')
+                if cut < 0:
+                    continue
+                data, at_line_start = data[cut + 1:], True
+            if data:
+                ended = data.endswith(b'\n')
+                yield data
+        if not at_line_start:
+            return
+        # نكمل آخر سطر من الـ blocks اللي بعدنا
+        for data in _inflate_blocks(f, offsets, last, n_blocks):
+            if ended:
+                break
+            cut = data.find(b'\n')
+            if cut >= 0:
+                yield data[:cut + 1]
+                break
+            yield data
+
+
+def _spill_bgzf_range(path, offsets, first, last, run_dir, tag, chunk_rows):
+    state = {'skipped': 0, 'header_skipped': True}
+    lines = _iter_line_chunks(_iter_bgzf_range(path, offsets, first, last), chunk_rows)
+    runs = _spill_runs(_parse_lines(lines, 'vcf', state), run_dir, tag)
+    return runs, state['skipped']
+
+
+def _spill_parallel_vcf(path, run_dir, state, chunk_rows, workers):
+    offsets = _bgzf_blocks(path)
+    n_blocks = len(offsets) - 1
+    bounds = np.linspace(0, n_blocks, min(workers, n_blocks) + 1).astype(int)
+    runs = []
+    with ProcessPoolExecutor(max_workers=len(bounds) - 1) as pool:
+        futures = [
+            pool.submit(_spill_bgzf_range, str(path), offsets, int(a), int(b), run_dir, f"p{i:03d}_", chunk_rows)
+            for i, (a, b) in enumerate(zip(bounds[:-1], bounds[1:])) if b > a
+        ]
+        for fut in futures:
+            part, skipped = fut.result()
+            runs.extend(part)
+            state['skipped'] += skipped
+    return runs
+
+
+def _can_parallelize(path, workers):
+    # worker الـ Celery (prefork) daemonic ومينفعش يعمل child processes – نقرأ sequential
+    if multiprocessing.current_process().daemon:
+        return False
+    return (workers > 1 and os.path.getsize(path) >= PARALLEL_MIN_BYTES
+            and is_bgzf(path) and sniff_input_format(path) == 'vcf')
+
+
+# ---------------------------------------------------------------- sorted runs
+
+def _save_run(block, run_dir, name):
+    prefix = Path(run_dir) / name
+    for field, arr in zip(GenotypeBlock._fields, block):
+        np.save(f"{prefix}.{field}.npy", arr)
+    return prefix
+
+
+def _load_run(prefix):
+    return GenotypeBlock(*(np.load(f"{prefix}.{name}.npy", mmap_mode='r') for name in GenotypeBlock._fields))
+
+
+def _spill_runs(blocks, run_dir, tag="run"):
+    runs = []
+    for block in blocks:
+        presorted = bool(np.all(block.key[1:] >= block.key[:-1]))
+        if not presorted:
+            block = _take(block, np.argsort(block.key, kind='stable'))
+        prefix = _save_run(block, run_dir, f"{tag}{len(runs):05d}")
+        runs.append(RunInfo(str(prefix), int(block.key[0]), int(block.key[-1]), presorted, len(block.key)))
+    return runs
+
+
+def _concat(blocks):
+    if len(blocks) == 1:
+        return blocks[0]
+    width = max(b.rsid.dtype.itemsize for b in blocks)
+    return GenotypeBlock(
+        np.concatenate([b.key for b in blocks]),
+        np.concatenate([b.geno for b in blocks]),
+        np.concatenate([b.rsid.astype(f'S{width}') for b in blocks]),
+    )
+
+
+def _take(block, idx):
+    return GenotypeBlock(block.key[idx], block.geno[idx], block.rsid[idx])
+
+
+def _merge_runs(runs, block_rows):
+    # k-way merge على blocks: نطلع فقط الصفوف الأصغر من أقل "حد" محمّل من الـ runs اللي لسه فيها بيانات.
+    # seq = (رقم الـ run, ترتيب الصف) يحافظ على ترتيب الإدخال عند تساوي المفتاح (stable زي sort الأصلي).
+    cursors = [0] * len(runs)
+    frontier = [None] * len(runs)
+    pending, pending_seq = [], []
+    offsets = np.cumsum([0] + [len(r.key) for r in runs])
+
+    def load(i):
+        start, end = cursors[i], min(cursors[i] + block_rows, len(runs[i].key))
+        cursors[i] = end
+        frontier[i] = runs[i].key[end - 1] if end < len(runs[i].key) else None
+        pending.append(GenotypeBlock(*(np.asarray(c[start:end]) for c in runs[i])))
+        pending_seq.append(np.arange(offsets[i] + start, offsets[i] + end))
+
+    for i in range(len(runs)):
+        if len(runs[i].key):
+            load(i)
+
+    while pending:
+        merged, seq = _concat(pending), np.concatenate(pending_seq)
+        open_runs = [f for f in frontier if f is not None]
+        bound = min(open_runs) if open_runs else None
+        order = np.lexsort((seq, merged.key))
+        merged, seq = _take(merged, order), seq[order]
+        cut = len(merged.key) if bound is None else int(np.searchsorted(merged.key, bound, side='left'))
+        if cut:
+            yield _take(merged, slice(0, cut))
+        pending[:], pending_seq[:] = [], []
+        if cut < len(merged.key):
+            pending.append(_take(merged, slice(cut, None)))
+            pending_seq.append(seq[cut:])
+        for i, f in enumerate(frontier):
+            if f is not None and f == bound:
+                load(i)
+
+
+def iter_sorted_genotypes(input_path, state, work_dir=None, chunk_rows=CHUNK_ROWS, block_rows=MERGE_BLOCK_ROWS,
+                          workers=None):
+    """يرجّع blocks مرتبة حسب (chrom, pos) بذاكرة محدودة؛ state فيه valid/skipped."""
+    state.setdefault('header_skipped', False)
+    state.setdefault('skipped', 0)
+    workers = workers or os.cpu_count() or 1
+    with tempfile.TemporaryDirectory(prefix="runs_", dir=work_dir) as run_dir:
+        if _can_parallelize(input_path, workers):
+            runs = _spill_parallel_vcf(input_path, run_dir, state, chunk_rows, workers)
+        else:
+            runs = _spill_runs(iter_genotype_chunks(input_path, state, chunk_rows), run_dir)
+        state['valid'] = sum(r.rows for r in runs)
+
+        in_order = all(r.presorted for r in runs) and all(a.last <= b.first for a, b in zip(runs, runs[1:]))
+        loaded = [_load_run(r.prefix) for r in runs]
+        if in_order:
+            # أغلب ملفات الشركات مرتبة أصلاً – قراءة متتابعة بدون merge
+            for run in loaded:
+                for start in range(0, len(run.key), block_rows):
+                    yield GenotypeBlock(*(np.asarray(c[start:start + block_rows]) for c in run))
+        else:
+            yield from _merge_runs(loaded, block_rows)
+
+
+# ---------------------------------------------------------------- fingerprint
+
+# سجل ثابت لكل SNP (key + genotype بأليلات مرتبة) → نفس الـ hash مهما كان الـ container أو تقسيم الـ blocks
+FINGERPRINT_DTYPE = np.dtype([('key', '<i8'), ('geno', 'S2')])
+
+
+def _sorted_alleles(geno):
+    return bytes(sorted(geno))
+
+
+def update_fingerprint(digest, key, geno):
+    record = np.empty(len(key), dtype=FINGERPRINT_DTYPE)
+    record['key'] = key
+    record['geno'] = _map_unique(geno, _sorted_alleles, 'S2') if len(geno) else geno
+    digest.update(record.tobytes())
+
+
+def fingerprint_blocks(blocks, digest):
+    """يمرر الـ blocks المرتبة زي ما هي ويحدّث الـ sha256 بالـ genotypes المطبّعة."""
+    for block in blocks:
+        update_fingerprint(digest, block.key, block.geno)
+        yield block
+
+
+# ---------------------------------------------------------------- writers
+
+def format_23file_lines(block):
+    """block → سطور rsid\\tchrom\\tpos\\tgeno زي الـ cleaner القديم بالظبط، ماعدا الـ position:
+
+    بيتكتب من الـ key كرقم صحيح، فالأصفار اللي على الشمال بتقع (0077 → 77). الـ cleaner القديم كان بيكتب
+    النص الأصلي؛ plink بيقرا الـ position كرقم في الحالتين فالناتج بعد --make-bed واحد. (+78 / مسافات جوه
+    الرقم مرفوضة في الاتنين – مش isdigit.)"""
+    chrom = CHROM_LABELS[block.key >> POS_BITS]
+    pos = (block.key & POS_MASK).astype('S11')
+    line = np.char.add(np.char.add(block.rsid, b'\t'), chrom)
+    line = np.char.add(np.char.add(line, b'\t'), pos)
+    line = np.char.add(np.char.add(line, b'\t'), block.geno)
+    return b'\n'.join(line.tolist()) + b'\n'
+
+
+def write_23file(blocks, output_path):
+    with open(output_path, 'wb') as out:
+        for block in blocks:
+            out.write(format_23file_lines(block))
+    return output_path
+
+
+# .bed SNP-major بعينة واحدة: byte لكل SNP، الكود في أول bitين (نسبةً لـ A1 = عمود 5 في .bim)
+BED_MAGIC = b'\x6c\x1b\x01'
+BED_HOM_A1, BED_MISSING, BED_HET, BED_HOM_A2 = 0, 1, 2, 3
+MISSING_ALLELE = ord('.')
+ACGT = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+
+def format_bim_lines(block, a1, a2):
+    chrom = CHROM_LABELS[block.key >> POS_BITS]
+    pos = (block.key & POS_MASK).astype('S11')
+    line = np.char.add(np.char.add(chrom, b'\t'), block.rsid)
+    line = np.char.add(np.char.add(line, b'\t0\t'), pos)
+    line = np.char.add(np.char.add(line, b'\t'), a1)
+    line = np.char.add(np.char.add(line, b'\t'), a2)
+    return b'\n'.join(line.tolist()) + b'\n'
+
+
+def write_bfile(blocks, out_prefix, fid, iid):
+    """يكتب .bed/.bim/.fam مباشرة من blocks مرتبة – نفس ناتج plink2 --23file <file> <fid> <iid>."""
+    x_het = y_called = False
+    with open(f"{out_prefix}.bed", 'wb') as bed, open(f"{out_prefix}.bim", 'wb') as bim:
+        bed.write(BED_MAGIC)
+        for block in blocks:
+            alleles = np.frombuffer(block.geno.tobytes(), dtype=np.uint8).reshape(-1, 2)
+            first, second = alleles[:, 0], alleles[:, 1]
+            missing = ~(np.isin(first, ACGT) & np.isin(second, ACGT))
+            het = ~missing & (first != second)
+
+            codes = np.full(len(block.key), BED_HOM_A2, dtype=np.uint8)
+            codes[het] = BED_HET
+            codes[missing] = BED_MISSING
+            bed.write(codes.tobytes())
+
+            a1 = np.where(het, second, MISSING_ALLELE).astype(np.uint8).view('S1')
+            a2 = np.where(missing, MISSING_ALLELE, first).astype(np.uint8).view('S1')
+            bim.write(format_bim_lines(block, a1, a2))
+
+            chrom = block.key >> POS_BITS
+            x_het = x_het or bool(np.any(het & (chrom == 23)))
+            y_called = y_called or bool(np.any(~missing & (chrom == 24)))
+
+    # الجنس زي plink: het على X → أنثى، غير كده calls على Y → ذكر
+    sex = 2 if x_het else 1 if y_called else 0
+    with open(f"{out_prefix}.fam", 'w') as fam:
+        fam.write(f"{fid}\t{iid}\t0\t0\t{sex}\t-9\n")
+    return out_prefix
+
+
+def pack_bed_codes(codes):
+    """(SNPs × samples) أكواد 2-bit → bytes الـ .bed (SNP-major، 4 samples في الـ byte، أول sample في أقل bits)."""
+    n_snps, n_samples = codes.shape
+    padded = np.zeros((n_snps, -(-n_samples // 4) * 4), dtype=np.uint8)
+    padded[:, :n_samples] = codes
+    quads = padded.reshape(n_snps, -1, 4)
+    return (quads[..., 0] | (quads[..., 1] << 2) | (quads[..., 2] << 4) | (quads[..., 3] << 6)).tobytes()
+
+
+def dosage_codes(dosage):
+    """عدد نسخ A1 (NaN = missing) → أكواد الـ .bed."""
+    codes = np.full(dosage.shape, BED_MISSING, dtype=np.uint8)
+    codes[dosage == 2] = BED_HOM_A1
+    codes[dosage == 1] = BED_HET
+    codes[dosage == 0] = BED_HOM_A2
+    return codes
+
+
+def write_cohort_dosage_bfile(out_prefix, dosage, bim_prefix, ids):
+    """كذا عينة (dosage = SNPs × samples، نسخ A1 و NaN = missing) على SNPs ملف .bim موجود؛ ids = [(fid, iid)]."""
+    dosage = np.asarray(dosage).reshape(len(dosage), len(ids))
+    with open(f"{out_prefix}.bed", 'wb') as bed:
+        bed.write(BED_MAGIC + pack_bed_codes(dosage_codes(dosage)))
+    shutil.copyfile(f"{bim_prefix}.bim", f"{out_prefix}.bim")
+    with open(f"{out_prefix}.fam", 'w') as fam:
+        fam.write("".join(f"{fid}\t{iid}\t0\t0\t0\t-9\n" for fid, iid in ids))
+    return out_prefix
+
+
+def write_dosage_bfile(out_prefix, dosage, bim_prefix, fid, iid):
+    """عينة وحدة على SNPs ملف .bim موجود (نفس الترتيب والأليلات)؛ dosage = نسخ A1 و NaN = missing."""
+    return write_cohort_dosage_bfile(out_prefix, dosage, bim_prefix, [(fid, iid)])
+
+
+# ---------------------------------------------------------------- readers
+
+# كود الـ 2-bit → عدد نسخ A1 (NaN = missing)
+BED_DOSAGE = np.array([2.0, np.nan, 1.0, 0.0], dtype=np.float32)
+_BED_BYTE_DOSAGE = BED_DOSAGE[(np.arange(256)[:, None] >> (2 * np.arange(4))) & 3]
+
+Bim = namedtuple("Bim", "key rsid a1 a2")
+
+
+def read_bim(prefix):
+    """.bim → أعمدة NumPy؛ key بنفس ترميز الـ blocks (chrom << 40 | pos)، 0 للكروموسومات غير المدعومة."""
+    rows = [line.split() for line in open(f"{prefix}.bim", 'rb') if line.strip()]
+    chrom = np.array([r[0] for r in rows]) if rows else np.array([], dtype='S2')
+    pos = np.array([int(r[3]) for r in rows], dtype=np.int64)
+    codes = _map_unique(chrom, chrom_code, np.int64) if rows else np.array([], dtype=np.int64)
+    key = np.where(codes > 0, (codes << POS_BITS) | pos, 0)
+    return Bim(key, np.array([r[1] for r in rows]), np.array([r[4] for r in rows]), np.array([r[5] for r in rows]))
+
+
+def read_fam_ids(prefix):
+    return [tuple(line.split()[:2]) for line in open(f"{prefix}.fam") if line.strip()]
+
+
+def iter_bed_dosages(prefix, n_samples, block_snps=1024):
+    """يقرأ .bed (SNP-major) blocks → مصفوفة (SNPs × samples) float32 بعدد نسخ A1."""
+    bytes_per_snp = (n_samples + 3) // 4
+    with open(f"{prefix}.bed", 'rb') as f:
+        if f.read(3) != BED_MAGIC:
+            raise ValueError(f"{prefix}.bed مش SNP-major PLINK bed")
+        while True:
+            data = f.read(block_snps * bytes_per_snp)
+            if not data:
+                break
+            packed = np.frombuffer(data, dtype=np.uint8).reshape(-1, bytes_per_snp)
+            yield _BED_BYTE_DOSAGE[packed].reshape(len(packed), -1)[:, :n_samples]
+
+
+def fingerprint_bfile(prefix, digest):
+    """نفس fingerprint_blocks لـ kit مرفوع كـ PLINK ثنائي (أول عينة)."""
+    bim = read_bim(prefix)
+    dosage = np.concatenate(list(iter_bed_dosages(prefix, len(read_fam_ids(prefix)))))[:, 0]
+    first = np.where(dosage == 0, bim.a2, bim.a1).astype('S1')
+    second = np.where(dosage == 2, bim.a1, bim.a2).astype('S1')
+    geno = np.char.add(first, second)
+    snv = (np.char.str_len(bim.a1) == 1) & (np.char.str_len(bim.a2) == 1)
+    called = ~np.isnan(dosage) & snv & np.isin(first.view(np.uint8), ACGT) & np.isin(second.view(np.uint8), ACGT)
+    geno[~called] = NO_CALL
+
+    order = np.argsort(bim.key, kind='stable')
+    order = order[bim.key[order] > 0]
+    update_fingerprint(digest, bim.key[order], geno[order])
+    return digest
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn.conf.py – gunicorn -c gunicorn.conf.py app:app (من جوه backend/)
+
+preload_app: app.py بيتعمله import مرة في الـ master، ومصفوفة الـ panel بتتحمّل قبل الـ fork (preload.web)،
+فالـ workers بيورثوا الاتنين copy-on-write بدل ما كل worker يعمل import ويقرا الـ panel لوحده.
+"""
+
+import os
+
+import settings
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('GUNICORN_WORKERS', 0)) or (os.cpu_count() or 1) + 1
+# threads: الـ SSE (/stream) بيفضل فاتح طول المعالجة
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+preload_app = True
+
+
+def on_starting(server):
+    if settings.PRELOAD_REFERENCE:
+        import preload
+        preload.web()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+kit_results.py – نتيجة الـ kit المجمّعة (<kit>_results.json) + LRU cache للـ routes
+
+الـ pipeline بيكتب الملف ده مرة في الآخر: PC vector الـ kit، الـ eigenvalues، Q لكل K، p-value الـ qpAdm
+والـ distances. app.results و app.dashboard بيقروه من cache في الذاكرة بدل ما يمسحوا الـ eigenvec
+(ممكن يبقى فيه 17k صف مرجعي) ويعيدوا parse كل ملف في كل زيارة.
+"""
+
+import json
+import os
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+import population_engine
+import qpadm_sweep
+
+RESULTS_VERSION = 3
+RESULTS_CACHE_SIZE = 512
+N_PCS = 30
+N_DISTANCES = 9
+N_QPADM_MODELS = 10
+RESULT_KS = [5, 8, 10, 13, 20]
+QPADM_PENDING = "جاري..."
+
+# demo_refs (مثال صادق – أضفت كنعاني – كمل الباقي زي فينيقي, أنباطي).
+# Super Power Add: أوروبا, شرق أفريقيا, حميري أكسومي, ساساني فارسي (تقريبي بناءً على بيانات جينية معروفة)
+DEMO_REFS = {
+    "أوروبي شمالي": np.array([0.055, -0.035, 0.015] + [0.0]*27),
+    "أوروبي جنوبي": np.array([0.045, -0.015, -0.025] + [0.0]*27),
+    "أوروبي شرقي": np.array([0.035, -0.025, 0.025] + [0.0]*27),
+    "إفريقي شرقي": np.array([0.000, 0.065, -0.010] + [0.0]*27),
+    "حميري أكسومي": np.array([0.010, 0.050, -0.015] + [0.0]*27),  # تقريبي لأكسوم/حمير قديم
+    "ساساني فارسي": np.array([0.020, 0.010, -0.010] + [0.0]*27),  # تقريبي لفارسي ساساني
+    "كنعاني": np.array([0.030, 0.010, -0.020] + [0.0]*27),
+    "فينيقي": np.array([0.035, 0.015, -0.015] + [0.0]*27),
+    "أنباطي": np.array([0.028, 0.008, -0.018] + [0.0]*27),
+}
+
+
+def results_path(kit_dir, kit_id):
+    return Path(kit_dir) / f"{kit_id}_results.json"
+
+
+def best_qpadm_model(models):
+    # الموديلات مرتبة بـ qpadm_sweep.rank_models (أبسط موديل بيعدّي الأول)
+    return models[0] if models else None
+
+
+def read_pc_values(eigenvec_path, kit_id):
+    # صف الـ kit بس (IID = kit_id)؛ 30 قيمة أو أصفار لو الملف ناقص
+    if eigenvec_path.exists():
+        try:
+            with open(eigenvec_path, 'r', encoding='utf-8', errors='ignore') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) >= 2 and parts[1] == kit_id:
+                        if len(parts) >= N_PCS + 2:
+                            return [float(x) for x in parts[2:N_PCS + 2]]
+                        break
+        except ValueError:
+            pass
+    return [0.0] * N_PCS
+
+
+def read_eigenval(eigenval_path):
+    if eigenval_path.exists():
+        try:
+            with open(eigenval_path, 'r') as f:
+                vals = [float(line.strip()) for line in f if line.strip()]
+            return vals[:N_PCS] + [0.0] * (N_PCS - len(vals))
+        except ValueError:
+            pass
+    return [0.0] * N_PCS
+
+
+def read_admixture(kit_dir, kit_id):
+    admixture = {}
+    for k in RESULT_KS:
+        qfile = Path(kit_dir) / f"{kit_id}.K{k}.Q"
+        if qfile.exists():
+            try:
+                with open(qfile) as f:
+                    values = [float(x) for x in f.readline().split()]
+                admixture[str(k)] = [round(v * 100, 1) for v in values]
+            except ValueError:
+                pass
+    return admixture
+
+
+def compute_distances(pc_values, populations=None):
+    """{الاسم: تشابه %}: أقرب populations في مصفوفة الـ panel (cosine)، أو الـ demo_refs لو مش متبنية."""
+    if populations is not None and any(pc_values):
+        target = population_engine.scale_target(populations, pc_values)
+        top = population_engine.nearest(populations, target, k=N_DISTANCES, metric="cosine")[0]
+        return {name: round((1 - dist) * 100, 1) for name, dist, _ in top}
+
+    user_vec = np.array(pc_values[:15])
+    distances = {}
+    for name, ref in DEMO_REFS.items():
+        ref_vec = np.asarray(ref[:15], dtype=np.float64)
+        norms = np.linalg.norm(user_vec) * np.linalg.norm(ref_vec)
+        # متجه أصفار (الـ PCA لسه ماخلصش) → مفيش اتجاه، التشابه 0
+        distances[name] = round(float(user_vec @ ref_vec / norms) * 100, 1) if norms else 0
+    return distances
+
+
+def build_kit_results(kit_dir, kit_id, panel_version=None):
+    """النتيجة المجمّعة من ملفات الـ pipeline الخام (من غير كتابة)."""
+    kit_dir = Path(kit_dir)
+    qpAdm_path = kit_dir / f"{kit_id}_qpAdm.out"
+    pc_values = read_pc_values(kit_dir / f"{kit_id}_pca.eigenvec", kit_id)
+    populations = population_engine.load_populations()
+    if populations is not None and populations["version"] != panel_version:
+        populations = None  # الـ kit اتحسب على panel تاني – إحداثياته مش في نفس الفضاء
+    distances = compute_distances(pc_values, populations)
+    report = qpadm_sweep.load_report(kit_dir, kit_id)
+    models = report["models"][:N_QPADM_MODELS] if report else []
+    best = best_qpadm_model(models)
+    p_value = best["p_value"] if best else None
+    return {
+        "version": RESULTS_VERSION,
+        "kit_id": kit_id,
+        "panel_version": panel_version,
+        "pc_values": pc_values,
+        "pc_variance": read_eigenval(kit_dir / f"{kit_id}_pca.eigenval"),
+        "admixture": read_admixture(kit_dir, kit_id),
+        "qpAdm_content": qpAdm_path.read_text(encoding='utf-8', errors='replace') if qpAdm_path.exists() else QPADM_PENDING,
+        "p_value": p_value,
+        "is_honest": best is not None and qpadm_sweep.passes(best),
+        "qpadm_models": models,
+        "distances": distances,
+        "best_match": max(distances, key=distances.get, default="غير متوفر") if distances else "غير متوفر",
+    }
+
+
+def write_kit_results(kit_dir, kit_id, panel_version=None):
+    results = build_kit_results(kit_dir, kit_id, panel_version)
+    path = results_path(kit_dir, kit_id)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(results, ensure_ascii=False), encoding='utf-8')
+    os.replace(tmp, path)
+    return results
+
+
+@lru_cache(maxsize=RESULTS_CACHE_SIZE)
+def _read_results(path, mtime_ns, size):
+    # mtime/size جزء من الـ key: أي إعادة كتابة للملف = entry جديد، والقديم بيخرج بالـ LRU
+    return json.loads(Path(path).read_text(encoding='utf-8'))
+
+
+def load_kit_results(kit_dir, kit_id, panel_version=None):
+    """النتيجة المجمّعة من الـ cache؛ بتتبني من جديد لو الملف مش موجود أو من إصدار/panel تاني.
+    None لو مجلد الـ kit نفسه مش موجود (اتمسح) – الـ caller يعرضه كـ kit من غير نتائج/404."""
+    path = results_path(kit_dir, kit_id)
+    if path.exists():
+        st = path.stat()
+        results = _read_results(str(path), st.st_mtime_ns, st.st_size)
+        if results.get("version") == RESULTS_VERSION and results.get("panel_version") == panel_version:
+            return results
+    if not Path(kit_dir).exists():
+        return None
+    write_kit_results(kit_dir, kit_id, panel_version)
+    st = path.stat()
+    return _read_results(str(path), st.st_mtime_ns, st.st_size)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+models.py – جداول الـ DB (User / DNAKit) مشتركة بين الـ web (app.py) والـ worker (tasks.py)
+
+db = SQLAlchemy() من غير app: app.py بيربطه بالـ Flask app بتاعه، والـ worker بيربطه بـ db_app()
+(Flask app فاضي فيه إعدادات الـ DB بس) – فالـ worker مابيحمّلش الـ routes ولا الـ forms.
+"""
+
+from datetime import datetime
+
+from flask import Flask
+from flask_login import UserMixin
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, text
+
+import settings
+
+db = SQLAlchemy()
+
+
+def configure(flask_app):
+    flask_app.config['SQLALCHEMY_DATABASE_URI'] = settings.DATABASE_PATH
+    flask_app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(flask_app)
+    return flask_app
+
+
+_db_app = None
+
+
+def db_app():
+    """Flask app للـ DB بس (app context للـ tasks) – بيتعمل مرة لكل process."""
+    global _db_app
+    if _db_app is None:
+        _db_app = configure(Flask("tasks"))
+    return _db_app
+
+
+class User(db.Model, UserMixin):
+    id = db.Column(db.Integer, primary_key=True)
+    email = db.Column(db.String(255), unique=True, nullable=False)
+    name = db.Column(db.String(255), nullable=False)
+    password_hash = db.Column(db.String(255), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_login = db.Column(db.DateTime)
+
+class DNAKit(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    kit_id = db.Column(db.String(255), unique=True, nullable=False)
+    original_filename = db.Column(db.String(255))
+    status = db.Column(db.String(50), default='queued')
+    progress = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    error_message = db.Column(db.Text)
+    # sha256 للـ genotypes المطبّعة والمرتبة + إصدار الـ panel – لإعادة استخدام نتائج رفع مكرر
+    fingerprint = db.Column(db.String(64), index=True)
+    panel_version = db.Column(db.String(64))
+
+    # قايمة kits المستخدم (user_id, created_at) والـ reaper (created_at) من غير scan للجدول كله
+    __table_args__ = (
+        db.Index('ix_dna_kit_user_id_created_at', 'user_id', 'created_at'),
+        db.Index('ix_dna_kit_created_at', 'created_at'),
+    )
+
+def upgrade_db():
+    # create_all مش بيضيف أعمدة لجداول موجودة – نضيف الناقص (SQLite ALTER TABLE بسيط)
+    inspector = inspect(db.engine)
+    for model in (User, DNAKit):
+        table = model.__table__
+        existing = {col["name"] for col in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                col_type = column.type.compile(db.engine.dialect)
+                db.session.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}"))
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    db.session.commit()
+
+def init_db(flask_app):
+    # مجلد الـ uploads بيتعمل هنا (مرة عند التشغيل) مش عند الـ import
+    settings.UPLOAD_FOLDER.mkdir(parents=True, exist_ok=True)
+    with flask_app.app_context():
+        db.create_all()
+        upgrade_db()
+
+def find_reusable_kit(fingerprint, panel_version, exclude_kit_id=None):
+    """(kit_dir, kit_id) لـ kit مكتمل بنفس الـ fingerprint ونفس الـ panel، أو None."""
+    query = DNAKit.query.filter_by(fingerprint=fingerprint, panel_version=panel_version, status='completed')
+    if exclude_kit_id:
+        query = query.filter(DNAKit.kit_id != exclude_kit_id)
+    kit = query.order_by(DNAKit.finished_at.desc()).first()
+    if kit is None or not (settings.UPLOAD_FOLDER / kit.kit_id).exists():
+        return None
+    return settings.UPLOAD_FOLDER / kit.kit_id, kit.kit_id
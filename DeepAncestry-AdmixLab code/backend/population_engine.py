@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+population_engine.py – أقرب populations ونمذجة الخلطات (Vahaduo-style) على مصفوفة مراجع memmapped
+
+المصفوفة (populations.npy) بتتبني مع الـ panel (reference_panel.build_populations): متوسطات الـ populations
+ثم كل sample، بإحداثيات scaled. بتتحمّل mmap مرة لكل worker، وكل الحسابات batched بـ NumPy:
+مسافة كل المراجع لكذا target في ضربة مصفوفات وحدة، و fit آلاف التوليفات من المصادر مع بعض.
+"""
+
+import json
+from itertools import combinations
+from math import comb
+
+import numpy as np
+
+import reference_panel
+
+METRICS = ("euclidean", "cosine")
+KINDS = ("population", "sample")
+MAX_COMBINATIONS = 50_000
+FIT_ITERATIONS = 400
+
+_loaded = {}
+
+
+def load_populations(ref_prefix=None):
+    """مصفوفة مراجع الـ panel الحالي (cache لكل worker) أو None لو مش متبنية."""
+    ref_prefix = ref_prefix or reference_panel.default_ref_prefix()
+    manifest = reference_panel.load_manifest(ref_prefix)
+    if not manifest or "populations" not in manifest["components"]:
+        return None
+    out_dir = reference_panel.panel_dir(ref_prefix, manifest["version"])
+    key = str(out_dir)
+    if key not in _loaded:
+        # mmap: الصفحات بتتقرأ عند أول استخدام وبتتشارك بين الـ workers على نفس الجهاز
+        matrix = np.load(out_dir / "populations.npy", mmap_mode='r')
+        names = json.loads((out_dir / "populations.json").read_text(encoding='utf-8'))
+        n_pops = len(names["populations"])
+        with np.load(out_dir / "pca.npz") as pca:
+            eigenval = pca["eigenval"][:matrix.shape[1]]
+        _loaded[key] = {
+            "version": manifest["version"],
+            "matrix": matrix,
+            "names": np.array(names["populations"] + names["samples"]),
+            "sizes": names["sizes"],
+            "ranges": {"population": (0, n_pops), "sample": (n_pops, matrix.shape[0])},
+            "sq_norms": np.einsum('ij,ij->i', matrix, matrix, dtype=np.float64),
+            "scale": np.sqrt(np.clip(eigenval, 0, None)),
+        }
+    return _loaded[key]
+
+
+def scale_target(pops, pc_values):
+    """PCs الـ kit (نفس صيغة الـ eigenvec) → إحداثيات scaled زي المصفوفة."""
+    targets = np.atleast_2d(np.asarray(pc_values, dtype=np.float64))
+    dims = len(pops["scale"])
+    if targets.shape[1] < dims:
+        targets = np.pad(targets, ((0, 0), (0, dims - targets.shape[1])))
+    return targets[:, :dims] * pops["scale"]
+
+
+def distance_matrix(pops, targets, metric="euclidean", kind="population"):
+    """(targets × مراجع) في ضربة وحدة: ‖t‖² + ‖m‖² − 2·t·mᵀ أو 1 − cos."""
+    if metric not in METRICS:
+        raise ValueError(f"metric لازم يكون واحد من {METRICS}")
+    start, end = pops["ranges"][kind]
+    matrix = np.asarray(pops["matrix"][start:end], dtype=np.float64)
+    sq_norms = pops["sq_norms"][start:end]
+    dots = targets @ matrix.T
+    t_sq = np.einsum('ij,ij->i', targets, targets)[:, None]
+    if metric == "euclidean":
+        return np.sqrt(np.clip(t_sq + sq_norms[None, :] - 2 * dots, 0, None))
+    denom = np.sqrt(t_sq * sq_norms[None, :])
+    return 1 - np.divide(dots, denom, out=np.zeros_like(dots), where=denom > 0)
+
+
+def nearest(pops, targets, k=10, metric="euclidean", kind="population"):
+    """أقرب k مرجع لكل target → [[(الاسم, المسافة, الفهرس في المصفوفة), ...], ...]."""
+    dist = distance_matrix(pops, targets, metric, kind)
+    k = max(1, min(k, dist.shape[1]))
+    top = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    order = np.take_along_axis(dist, top, axis=1).argsort(axis=1, kind='stable')
+    top = np.take_along_axis(top, order, axis=1)
+    offset = pops["ranges"][kind][0]
+    return [[(str(pops["names"][offset + i]), float(dist[row, i]), int(offset + i)) for i in top[row]]
+            for row in range(len(top))]
+
+
+# ---------------------------------------------------------------- mixtures
+
+def fit_mixture(pops, target, source_idx):
+    """fit دقيق: target ≈ Σ wᵢ·مصدرᵢ بـ wᵢ ≥ 0 و Σ wᵢ = 1 (NNLS + صف قيد بوزن كبير) → (w, distance)."""
+    # lazy: app.py بيعمل import للـ module ده، و scipy مش لازمة غير للـ mixtures
+    from scipy.optimize import nnls
+
+    target = np.asarray(target, dtype=np.float64).ravel()
+    sources = np.asarray(pops["matrix"][np.asarray(source_idx)], dtype=np.float64)
+    penalty = 1e3 * max(1.0, float(np.abs(sources).max(initial=0)))
+    a = np.vstack([sources.T, np.full(len(sources), penalty)])
+    b = np.append(target, penalty)
+    weights, _ = nnls(a, b)
+    if weights.sum() > 0:
+        weights /= weights.sum()
+    return weights, float(np.linalg.norm(weights @ sources - target))
+
+
+def _project_simplex(v):
+    # إسقاط كل صف على {w ≥ 0, Σw = 1} (Duchi et al.) – batched
+    u = -np.sort(-v, axis=1)
+    css = np.cumsum(u, axis=1) - 1
+    ind = np.arange(1, v.shape[1] + 1)
+    rho = (u - css / ind > 0).sum(axis=1) - 1
+    theta = css[np.arange(len(v)), rho] / (rho + 1)
+    return np.clip(v - theta[:, None], 0, None)
+
+
+def score_combinations(pops, target, combos, iterations=FIT_ITERATIONS):
+    """كل التوليفات (C × s فهارس) مع بعض: FISTA على الـ simplex بمصفوفات Gram (C × s × s)
+    → (أوزان C × s, distance لكل توليفة)."""
+    target = np.asarray(target, dtype=np.float64).ravel()
+    combos = np.asarray(combos)
+    x = pops["matrix"][combos].astype(np.float64)                     # C × s × D
+    gram = x @ x.transpose(0, 2, 1)                                    # C × s × s
+    rhs = x @ target                                                   # C × s
+    lipschitz = np.clip(np.linalg.eigvalsh(gram)[:, -1], 1e-12, None)[:, None]
+
+    n, s = combos.shape
+    w = np.full((n, s), 1.0 / s)
+    y, t = w.copy(), 1.0
+    for _ in range(iterations):
+        grad = np.einsum('cij,cj->ci', gram, y) - rhs
+        w_next = _project_simplex(y - grad / lipschitz)
+        t_next = (1 + np.sqrt(1 + 4 * t * t)) / 2
+        y = w_next + ((t - 1) / t_next) * (w_next - w)
+        w, t = w_next, t_next
+
+    # ‖Σwᵢxᵢ − t‖² = wᵀGw − 2wᵀb + ‖t‖²
+    sq = np.einsum('ci,cij,cj->c', w, gram, w) - 2 * np.einsum('ci,ci->c', w, rhs) + target @ target
+    return w, np.sqrt(np.clip(sq, 0, None))
+
+
+def best_mixtures(pops, target, source_idx, size=3, top=10):
+    """كل توليفات size من المصادر → أحسن top موديل (مرتبين بالـ distance، مع fit دقيق للأحسن)."""
+    source_idx = np.asarray(source_idx)
+    size = max(1, min(size, len(source_idx)))
+    if comb(len(source_idx), size) > MAX_COMBINATIONS:
+        raise ValueError(f"عدد التوليفات أكبر من {MAX_COMBINATIONS} – قلل المصادر أو الحجم")
+    combos = source_idx[np.array(list(combinations(range(len(source_idx)), size)))]
+    _, distances = score_combinations(pops, target, combos)
+
+    models = []
+    for c in np.argsort(distances, kind='stable')[:top]:
+        weights, distance = fit_mixture(pops, target, combos[c])
+        models.append({"distance": distance,
+                       "sources": [{"name": str(pops["names"][i]), "weight": float(w)}
+                                   for i, w in sorted(zip(combos[c], weights), key=lambda item: -item[1])]})
+    return sorted(models, key=lambda m: m["distance"])
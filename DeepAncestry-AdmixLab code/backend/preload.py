@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+preload.py – تحميل الـ pipeline ومصفوفات الـ panel مرة في الـ parent قبل الـ fork
+
+gunicorn (preload_app + on_starting في gunicorn.conf.py) و celery prefork (worker_init في tasks.py) بيعملوا
+fork للـ workers من process واحد. اللي يتحمّل هنا قبل الـ fork بيتورث copy-on-write: الـ modules التقيلة
+(scipy / الـ pipeline) مابتتعملهاش import في كل child، ومصفوفات الـ numpy (loadings الـ PCA، فهرس SNPs،
+f2، prune.in) بتفضل صفحات مشتركة طول ما محدش بيكتب فيها. gc.freeze في الآخر بيطلّع الـ objects دي من
+الـ GC، فالـ collector في الـ children مابيلمسش headers بتاعتها ومابينسخش صفحاتها.
+
+كل loader بيرجع None لو الـ component مش متبني – الـ preload مابيبنيش حاجة تقيلة (EIGENSTRAT بيتحمل بس لو
+موجود)، فـ worker على node من غير panel بيقوم عادي.
+"""
+
+import gc
+import importlib
+import time
+from pathlib import Path
+
+# modules الـ web (app.py) اللي بتتعمل lazy: الـ mixtures (scipy.optimize)
+WEB_MODULES = ["scipy.optimize"]
+# الـ worker: الـ pipeline كله + scipy.special بتاع p-value الـ qpAdm
+WORKER_MODULES = WEB_MODULES + ["scipy.special", "process_dna", "cohort_batch", "admixture_runner"]
+
+
+def log(msg):
+    print(f"[*] {msg}")
+
+
+def import_modules(names):
+    for name in names:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            log(f"preload: {name} مش متاح ({e})")
+
+
+def reference_data(ref_prefix=None, worker=True):
+    """مصفوفات الـ panel الحالي في caches الـ modules (_loaded) → أسامي اللي اتحمّل."""
+    import population_engine
+    import qpadm_sweep
+    import reference_panel
+
+    ref_prefix = ref_prefix or reference_panel.default_ref_prefix()
+    loaded = []
+    if population_engine.load_populations(ref_prefix) is not None:
+        loaded.append("populations")
+    if not worker or not Path(f"{ref_prefix}.bed").exists():
+        return loaded
+
+    reference_panel.load_snp_index(ref_prefix)
+    loaded.append("snp_index")
+    for name, loader in (("pca", reference_panel.load_pca), ("prune", reference_panel.load_prune),
+                         ("f2", qpadm_sweep.load_f2)):
+        if loader(ref_prefix) is not None:
+            loaded.append(name)
+    populations = qpadm_sweep.SOURCE_POOL + qpadm_sweep.RIGHT_POPS
+    if (reference_panel.eigenstrat_dir(ref_prefix, populations) / "eigenstrat.json").exists():
+        reference_panel.load_eigenstrat(ref_prefix, populations)
+        loaded.append("eigenstrat")
+    return loaded
+
+
+def _preload(modules, worker):
+    start = time.perf_counter()
+    import_modules(modules)
+    try:
+        loaded = reference_data(worker=worker)
+    except (OSError, ValueError) as e:
+        # panel بايظ/ناقص: الـ worker يقوم عادي والـ loaders يحاولوا تاني عند أول kit
+        log(f"preload: فشل تحميل الـ panel ({e})")
+        loaded = []
+    gc.freeze()
+    log(f"preload: {', '.join(loaded) or 'مفيش panel'} في {time.perf_counter() - start:.1f} ثانية")
+    return loaded
+
+
+def web():
+    """الـ gunicorn master: مصفوفة الـ populations (nearest / mixtures) + scipy.optimize."""
+    return _preload(WEB_MODULES, worker=False)
+
+
+def worker():
+    """الـ celery parent: الـ pipeline + كل مصفوفات الـ panel اللي الـ stages بتقراها."""
+    return _preload(WORKER_MODULES, worker=True)
@@ -4,192 +4,568 @@
 process_dna_plink2_super.py – Super Honest Power + PLINK2 + Threads + Safe Merge
 """
 
+import argparse
+import hashlib
+import json
 import subprocess
 import sys
-import csv
 import os
+import re
+import shutil
+from contextlib import contextmanager
+from datetime import datetime
 from pathlib import Path
 
-REFERENCE_PANEL_PREFIX = "ref_panel"
+import admixture_runner
+import genotype_io
+import kit_results
+import qpadm_sweep
+import reference_panel
+import relatives
+import resource_governor
+import stage_cache
+import stage_metrics
+
 QPADM_PATH = "qpAdm"
 CONVERTF_PATH = "convertf"
 
+# EXACT_PRUNE=1: plink2 --indep-pairwise على الـ merge كله لكل kit (مراجعة) بدل prune.in الـ panel
+EXACT_PRUNE = os.getenv('EXACT_PRUNE') == '1'
+
+STAGES = ("clean", "bed", "merge", "prune", "pca", "admixture", "convertf", "qpadm", "relatives")
+# وزن كل stage من الـ progress (تقريب لنسبة وقته من التشغيل الكامل)
+STAGE_WEIGHTS = {"clean": 10, "bed": 3, "merge": 10, "prune": 7, "pca": 5, "admixture": 45, "convertf": 5, "qpadm": 15,
+                 "relatives": 2}
+# (أقل cores، أكتر cores – None = كل الفاضي، RAM بالـ MB) اللي كل stage بيطلبه من resource_governor
+STAGE_RESOURCES = {"clean": (1, 4, 2048), "bed": (1, 1, 1024), "merge": (1, 1, 4096), "prune": (1, None, 4096),
+                   "pca": (1, None, 4096), "admixture": (1, None, 8192), "convertf": (1, 1, 2048),
+                   "qpadm": (1, None, 2048), "relatives": (1, None, 2048)}
+
+_log_files = []
+
 def log(msg):
     print(f"[*] {msg}")
+    for f in _log_files:
+        f.write(f"[{datetime.now():%Y-%m-%d %H:%M:%S}] {msg}\n")
+        f.flush()
+
+@contextmanager
+def log_to(path):
+    """كل رسائل log() جوه الـ with بتتكتب كمان في path (سجل الـ kit اللي صفحة النتائج بتعرضه)."""
+    f = open(path, 'a', encoding='utf-8')
+    _log_files.append(f)
+    try:
+        yield
+    finally:
+        _log_files.remove(f)
+        f.close()
 
 def run_cmd(cmd, fallback_cmd=None):
+    # كل تشغيل (حتى الفاشل) بيتسجل في <kit>_metrics.jsonl بوقته و RSS و exit status
     try:
-        subprocess.run(cmd, check=True)
+        stage_metrics.run_tool(cmd)
     except subprocess.CalledProcessError as e:
         log(f"خطأ في: {' '.join(cmd)}")
         if fallback_cmd:
             log("جاري تجربة الإصدار القديم (plink 1.9)...")
-            subprocess.run(fallback_cmd, check=True)
+            stage_metrics.run_tool(fallback_cmd)
         else:
             raise e
 
-def clean_and_sort_for_plink(input_path, output_path):
+def clean_and_sort_for_plink(input_path, output_path, digest=None):
     log(f"تنظيف وترتيب: {input_path}")
     try:
-        data_rows = []
-        skipped = 0
-        with open(input_path, 'r', encoding='utf-8', errors='ignore') as f:
-            sample = f.read(2048)
-            f.seek(0)
-            delimiter = '\t' if '\t' in sample else ','
-            reader = csv.reader(f, delimiter=delimiter)
-            header_skipped = False
-            for row in reader:
-                if len(row) < 4 or not row[0].strip():
-                    continue
-                if not header_skipped and ('rsid' in row[0].lower() or row[0].startswith('#')):
-                    header_skipped = True
-                    continue
-
-                rsid = row[0].strip()
-                chrom_raw = row[1].strip().upper().replace('CHR', '')
-                pos_str = row[2].strip()
-                if not pos_str.isdigit():
-                    skipped += 1
-                    continue
-
-                geno_raw = row[3].strip().upper()
-                geno_clean = geno_raw.replace(' ', '').replace('/', '').replace('|', '')
-                geno = geno_clean[:2] if len(geno_clean) >= 2 else '--'
-                if geno in {'II', 'DD', '00', '..', 'XX'}:
-                    geno = '--'
-
-                chr_map = {'X': 23, 'Y': 24, 'MT': 26, 'M': 26}
-                chr_num = chr_map.get(chrom_raw, int(chrom_raw) if chrom_raw.isdigit() else None)
-                if chr_num is None or not (1 <= chr_num <= 26 and chr_num != 25):
-                    skipped += 1
-                    continue
-
-                chrom_out = 'X' if chr_num == 23 else 'Y' if chr_num == 24 else 'MT' if chr_num == 26 else str(chr_num)
-
-                data_rows.append((chr_num, int(pos_str), rsid, chrom_out, pos_str, geno))
-
-        data_rows.sort(key=lambda x: (x[0], x[1]))
-
-        with open(output_path, 'w', encoding='utf-8', newline='') as f:
-            for r in data_rows:
-                f.write(f"{r[2]}\t{r[3]}\t{r[4]}\t{r[5]}\n")
-
-        log(f"تم التنظيف: {len(data_rows)} SNP صالح (تم تخطي {skipped})")
+        # Streaming: chunks + أعمدة NumPy + sorted runs على القرص (ذاكرة محدودة مهما كان حجم الملف)
+        state = {}
+        blocks = genotype_io.iter_sorted_genotypes(input_path, state, work_dir=Path(output_path).parent)
+        if digest is not None:
+            blocks = genotype_io.fingerprint_blocks(blocks, digest)
+        genotype_io.write_23file(blocks, output_path)
+
+        log(f"تم التنظيف: {state['valid']} SNP صالح (تم تخطي {state['skipped']})")
+        return True
+    except Exception as e:
+        log(f"خطأ في التنظيف: {e}")
+        return False
+
+def clean_to_bed(input_path, out_prefix, kit_id, digest=None, workers=None):
+    log(f"تنظيف وكتابة BED مباشرة: {input_path}")
+    try:
+        # نفس الـ streaming بتاع clean_and_sort_for_plink بس بيكتب .bed/.bim/.fam بدل النص
+        state = {}
+        blocks = genotype_io.iter_sorted_genotypes(input_path, state, work_dir=Path(out_prefix).parent,
+                                                   workers=workers)
+        if digest is not None:
+            blocks = genotype_io.fingerprint_blocks(blocks, digest)
+        genotype_io.write_bfile(blocks, out_prefix, kit_id, kit_id)
+
+        log(f"تم التنظيف: {state['valid']} SNP صالح (تم تخطي {state['skipped']})")
         return True
     except Exception as e:
         log(f"خطأ في التنظيف: {e}")
         return False
 
-def run_full_pipeline(filepath, kit_id):
+def bfile_paths(prefix):
+    return [f"{prefix}{ext}" for ext in genotype_io.PLINK_EXTENSIONS]
+
+def stage_clean(ctx):
+    # .txt/.csv/.vcf (خام أو .gz/.zip) → BED مباشرة؛ PLINK الثنائي يتخطى التنظيف
+    # fingerprint = sha256 للـ genotypes المطبّعة والمرتبة (نفس الـ kit كـ .txt أو .zip → نفس القيمة)
+    filepath, digest = ctx["filepath"], hashlib.sha256()
+    if genotype_io.sniff_input_format(filepath) == 'plink':
+        log("ملف PLINK ثنائي – تخطي التنظيف")
+        kit_bfile = genotype_io.plink_fileset_prefix(filepath, ctx["kit_dir"])
+        if kit_bfile is None:
+            raise ValueError("لازم .bed و .bim و .fam مع بعض")
+        genotype_io.fingerprint_bfile(kit_bfile, digest)
+        return {"kit_bfile": kit_bfile, "fingerprint": digest.hexdigest(), "outputs": bfile_paths(kit_bfile)}
+
+    if ctx["via_23file"]:
+        # المسار القديم (للمقارنة): نص مؤقت + plink2 --23file في stage الـ bed
+        if not clean_and_sort_for_plink(filepath, ctx["temp_clean"], digest):
+            raise RuntimeError("فشل التنظيف")
+        return {"kit_bfile": None, "fingerprint": digest.hexdigest(), "outputs": [str(ctx["temp_clean"])]}
+
+    if not clean_to_bed(filepath, ctx["out_prefix"], ctx["kit_id"], digest, workers=int(ctx["threads"])):
+        raise RuntimeError("فشل التنظيف")
+    return {"kit_bfile": ctx["out_prefix"], "fingerprint": digest.hexdigest(), "outputs": bfile_paths(ctx["out_prefix"])}
+
+def stage_bed(ctx):
+    log("تحويل إلى BED بـ plink2")
+    run_cmd([
+        "plink2", "--23file", str(ctx["temp_clean"]), ctx["kit_id"], ctx["kit_id"],
+        "--out", ctx["out_prefix"], "--make-bed", "--allow-no-sex", "--allow-extra-chr",
+        "--threads", ctx["threads"], "--memory", str(ctx["memory_mb"])
+    ])
+    return {"kit_bfile": ctx["out_prefix"], "outputs": bfile_paths(ctx["out_prefix"])}
+
+def full_merge_needed(ctx):
+    # الـ .bed المدموج (panel كله + الـ kit) بيقراه بس plink2 (prune/PCA) والـ ADMIXTURE الكامل؛ لما prune.in
+    # والـ PCA وملفات .P الـ panel متبنيين كل stage بيقرا الـ kit لوحده، والـ prune محتاج .bim التقاطع بس
+    return not (ctx["panel_pca"] is not None and ctx["p_files"] and not ctx["exact_prune"]
+                and reference_panel.load_prune(ctx["ref_bed"]) is not None)
+
+def stage_merge(ctx):
+    ref_bed, merged_prefix = ctx["ref_bed"], ctx["merged_prefix"]
+    if not Path(f"{ref_bed}.bed").exists():
+        log("تحذير: ref_panel مش موجود")
+        return {"base_prefix": ctx["kit_bfile"], "outputs": []}
+
+    # harmonization على فهرس SNPs الـ panel قبل الـ merge: strand flips و A/T و C/G والأليلات المختلفة
+    # بتتحل هنا، فالـ merge مابيفشلش ومابيتعادش بـ plink 1.9، وبيقرا صفوف التقاطع بس من الـ panel
+    panel_idx, g, stats = reference_panel.harmonize_kit(reference_panel.load_snp_index(ref_bed), ctx["kit_bfile"])
+    log(reference_panel.overlap_message(stats))
+    reference_panel.check_overlap(stats)
+    if not full_merge_needed(ctx):
+        n_rows = reference_panel.write_overlap_bim(ref_bed, [(panel_idx, g)], merged_prefix)
+        log(f"مكونات الـ panel متبنية – .bim التقاطع بس ({n_rows} SNP) من غير merge الـ genotypes")
+        return {"base_prefix": merged_prefix, "overlap": stats, "outputs": [f"{merged_prefix}.bim"]}
+    log("دمج مع ref_panel (17k شخص) على SNPs التقاطع")
+    reference_panel.merge_with_panel(ref_bed, [(panel_idx, g)], [(ctx["kit_id"], ctx["kit_id"])], merged_prefix)
+    return {"base_prefix": merged_prefix, "overlap": stats, "outputs": bfile_paths(merged_prefix)}
+
+def stage_prune(ctx):
+    prune_in = f"{ctx['pruned_prefix']}.prune.in"
+    panel_prune = reference_panel.load_prune(ctx["ref_bed"]) if ctx["has_ref"] else None
+    if panel_prune is not None and not ctx["exact_prune"]:
+        # prune.in الـ panel محسوب مرة لكل version – الـ kit بياخد تقاطعه مع SNPs الـ merge بس
+        kept = reference_panel.intersect_prune(panel_prune, ctx["base_prefix"], prune_in)
+        log(f"Pruning من الـ panel: {kept} SNP من prune.in الـ panel موجودة في الـ merge")
+        return {"outputs": [prune_in]}
+
+    log("Pruning كامل بـ plink2" if panel_prune is not None else "Pruning سريع")
+    run_cmd([
+        "plink2", "--bfile", ctx["base_prefix"],
+        *reference_panel.PRUNE_ARGS,
+        "--threads", ctx["threads"], "--memory", str(ctx["memory_mb"]),
+        "--out", ctx["pruned_prefix"]
+    ])
+    if panel_prune is not None:
+        # وضع المراجعة: نقارن الحساب الكامل بتقاطع prune.in الـ panel
+        cached = ctx["pruned_prefix"] + ".panel.prune.in"
+        reference_panel.intersect_prune(panel_prune, ctx["base_prefix"], cached)
+        exact, approx = (set(open(path, 'rb').read().split()) for path in (prune_in, cached))
+        union = len(exact | approx) or 1
+        log(f"مراجعة الـ pruning: {len(exact)} SNP (كامل) مقابل {len(approx)} (من الـ panel)، "
+            f"تطابق {100 * len(exact & approx) / union:.1f}%")
+        os.unlink(cached)
+    return {"outputs": [prune_in]}
+
+def stage_pca(ctx):
+    # نفس الملفات اللي app.results و app.dashboard بيقروها
+    pca_prefix, panel_pca, kit_id = ctx["pca_prefix"], ctx["panel_pca"], ctx["kit_id"]
+    if panel_pca is not None:
+        log(f"PCA projection على محاور الـ panel ({panel_pca['version'][:12]})")
+        pcs, n_used = reference_panel.project_kit(panel_pca, ctx["kit_bfile"])
+        reference_panel.write_projection(pca_prefix, kit_id, kit_id, pcs, panel_pca["eigenval"])
+        log(f"تم الـ projection على {n_used} SNP")
+    else:
+        log("PCA على المواقع المختارة (مفيش panel build – شغّل reference_panel.py build)")
+        run_cmd([
+            "plink2", "--bfile", ctx["base_prefix"],
+            "--extract", f"{ctx['pruned_prefix']}.prune.in",
+            "--pca", "30",
+            "--threads", ctx["threads"], "--memory", str(ctx["memory_mb"]),
+            "--out", pca_prefix
+        ])
+    return {"outputs": [f"{pca_prefix}.eigenvec", f"{pca_prefix}.eigenval"]}
+
+def stage_admixture(ctx):
+    # كل الـ K مع بعض بالـ cores اللي الـ governor منحها؛ النتائج <kit>.K<k>.Q اللي app.results بيقراها
+    kit_id, kit_dir, p_files = ctx["kit_id"], ctx["kit_dir"], ctx["p_files"]
+    ks = admixture_runner.ADMIXTURE_KS
+    admixture_dir = kit_dir / f"{kit_id}_admixture"
+    if p_files:
+        log(f"Admixture projection (-P) على .P الـ panel لـ K={ks}")
+        aligned_prefix = f"{ctx['out_prefix']}_panel"
+        n_aligned = reference_panel.align_kit(ctx["panel_pca"], ctx["kit_bfile"], ctx["ref_bed"], aligned_prefix, kit_id)
+        log(f"الـ kit على SNPs الـ panel: {n_aligned} SNP")
+        outputs = admixture_runner.run_admixture_jobs(aligned_prefix, ks, admixture_dir, p_files=p_files,
+                                                     budget=int(ctx["threads"]))
+    else:
+        log(f"Admixture كامل (unsupervised) لـ K={ks}")
+        outputs = admixture_runner.run_admixture_jobs(ctx["base_prefix"], ks, admixture_dir, budget=int(ctx["threads"]))
+        # .Q فيه صف لكل فرد في الـ merge – صف الـ kit بس (app.results بيقرا أول سطر)
+        kit_row = [iid for _, iid in genotype_io.read_fam_ids(ctx["base_prefix"])].index(kit_id)
+        for q_file, _ in outputs.values():
+            Path(q_file).write_text(Path(q_file).read_text().splitlines()[kit_row] + "\n")
+
+    produced = []
+    for k, (q_file, p_file) in outputs.items():
+        os.replace(q_file, kit_dir / f"{kit_id}.K{k}.Q")
+        produced.append(str(kit_dir / f"{kit_id}.K{k}.Q"))
+        if not p_files and p_file.exists():
+            os.replace(p_file, kit_dir / f"{kit_id}.K{k}.P")
+            produced.append(str(kit_dir / f"{kit_id}.K{k}.P"))
+    return {"outputs": produced}
+
+def qpadm_populations():
+    return qpadm_sweep.SOURCE_POOL + qpadm_sweep.RIGHT_POPS
+
+def stage_convertf(ctx, kit_bfiles=None, ids=None):
+    eigen_prefix = ctx["eigen_prefix"]
+    if ctx["has_ref"]:
+        # EIGENSTRAT الـ panel محفوظ مرة لكل version – الـ kit (أو الدفعة) بيتضاف كأعمدة بس
+        log("تحضير qpAdm: EIGENSTRAT الـ panel (cache) + عمود الـ kit")
+        eigen = reference_panel.load_eigenstrat(ctx["ref_bed"], qpadm_populations())
+        kit_bfiles = kit_bfiles or [ctx["kit_bfile"]]
+        ids = ids or [(ctx["kit_id"], ctx["kit_id"])]
+        return {"outputs": reference_panel.write_eigenstrat_overlay(eigen, kit_bfiles, ids, eigen_prefix)}
+
+    log("تحضير qpAdm (convertf)")
+    base_prefix = ctx["base_prefix"]
+    # ملفات الـ par جوه مجلد الـ kit مش الـ cwd – عشان الـ kits اللي شغالة مع بعض ماتكتبش فوق بعض
+    par_convert = ctx["kit_dir"] / f"{ctx['kit_id']}_convert.par"
+    with open(par_convert, "w") as par:
+        par.write(f"genotypename: {base_prefix}.bed\n")
+        par.write(f"snpname: {base_prefix}.bim\n")
+        par.write(f"indivname: {base_prefix}.fam\n")
+        par.write("outputformat: EIGENSTRAT\n")
+        par.write(f"genooutfilename: {eigen_prefix}.geno\n")
+        par.write(f"snpoutfilename: {eigen_prefix}.snp\n")
+        par.write(f"indoutfilename: {eigen_prefix}.ind\n")
+
+    stage_metrics.run_tool([CONVERTF_PATH, "-p", str(par_convert)])
+    return {"outputs": [f"{eigen_prefix}.{ext}" for ext in ("geno", "snp", "ind")]}
+
+def stage_qpadm(ctx):
+    kit_id, kit_dir = ctx["kit_id"], ctx["kit_dir"]
+    models = qpadm_sweep.candidate_models(qpadm_sweep.SOURCE_POOL, qpadm_sweep.RIGHT_POPS)
+    if ctx["f2"] is not None:
+        log(f"qpAdm sweep على f2 الـ panel ({len(models)} موديل)")
+        report = qpadm_sweep.sweep_f2(ctx["f2"], ctx["kit_bfile"], kit_id, workers=int(ctx["threads"]))
+    else:
+        log(f"qpAdm sweep ({len(models)} موديل، كل واحد في مجلد معزول)")
+        work_dir = kit_dir / f"{kit_id}_qpadm"
+        shutil.rmtree(work_dir, ignore_errors=True)
+        report = qpadm_sweep.sweep_qpadm(QPADM_PATH, ctx["eigen_prefix"], kit_id, work_dir,
+                                           workers=int(ctx["threads"]))
+    if report["missing"]:
+        log(f"populations مش موجودة في الـ panel: {', '.join(report['missing'])}")
+    if report["models"]:
+        best = report["models"][0]
+        log(f"أحسن موديل: {' + '.join(s['name'] for s in best['sources'])} (p-value {best['p_value']})")
+    # <kit>_qpadm.json (structured) هو اللي kit_results بيقراه، و <kit>_qpAdm.out جدول للعرض
+    return {"outputs": qpadm_sweep.write_report(kit_dir, kit_id, report)}
+
+def stage_relatives(ctx):
+    # الـ kit في مخزن الـ genotypes (SNPs الـ panel) + مطابقة مع كل الـ kits اللي قبله
+    kit_id = ctx["kit_id"]
+    log("مطابقة الأقارب مع مخزن الـ kits")
+    report = relatives.add_and_match(ctx["ref_bed"], ctx["panel_version"], kit_id, ctx["kit_bfile"],
+                                     workers=int(ctx["threads"]))
+    log(f"{kit_id}: {len(report['matches'])} قريب من {report['compared']} kit في المخزن")
+    path = ctx["kit_dir"] / f"{kit_id}_relatives.json"
+    path.write_text(json.dumps(report, ensure_ascii=False), encoding='utf-8')
+    return {"outputs": [str(path)]}
+
+def store_relatives(ctx, cache):
+    """stage الـ relatives (لو في panel)؛ مشترك بين run_full_pipeline و cohort_batch، و kits الـ reuse كمان."""
+    if ctx["has_ref"]:
+        cache.run("relatives", lambda: governed("relatives", ctx, stage_relatives), inputs=bfile_paths(ctx["kit_bfile"]),
+                  params={"panel": ctx["panel_version"], "store": relatives.STORE_VERSION})
+
+def result_artifacts(kit_id):
+    # الملفات اللي app.results / app.dashboard / download_coords بيقروها
+    names = [f"{kit_id}_pca.eigenvec", f"{kit_id}_pca.eigenval", f"{kit_id}_qpAdm.out", f"{kit_id}_qpadm.json",
+             f"{kit_id}_G25_scaled.eigenvec"]
+    for k in admixture_runner.ADMIXTURE_KS:
+        names += [f"{kit_id}.K{k}.Q", f"{kit_id}.K{k}.P"]
+    return names
+
+def relabel_eigenvec(src, dst, src_kit, dst_kit):
+    # عمودين FID/IID بس (صف الـ kit)؛ الـ header والـ PCs زي ما هما
+    with open(src, encoding='utf-8') as f, open(dst, 'w', encoding='utf-8') as out:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if not line.startswith("#"):
+                fields[:2] = [dst_kit if field == src_kit else field for field in fields[:2]]
+            out.write("\t".join(fields) + "\n")
+
+def link_qpadm_report(src_dir, src_kit, dst_dir, dst_kit):
+    """<kit>_qpadm.json بالـ target الجديد + مخرجات الموديلات في <dst_kit>_qpadm (الـ output نسبي لمجلد الـ kit)
+    والجدول من الـ report نفسه (write_report). الـ qpadm.out الخام فيه الـ target ومسارات الـ EIGENSTRAT –
+    الـ kit_id بيتبدل ككلمة كاملة بس (مش جزء من id تاني)."""
+    report = qpadm_sweep.load_report(src_dir, src_kit)
+    if report is None:
+        return []
+    if report["target"] == src_kit:
+        report["target"] = dst_kit
+    work_dir = Path(dst_dir) / f"{dst_kit}_qpadm"
+    shutil.rmtree(work_dir, ignore_errors=True)
+    kit_token = re.compile(rf"(?<![A-Za-z0-9]){re.escape(src_kit)}(?![A-Za-z0-9])")
+    for model in report["models"]:
+        if "error" in model:
+            model["error"] = kit_token.sub(dst_kit, model["error"])
+        if "output" not in model:
+            continue
+        src_out = Path(src_dir) / model["output"]
+        if not src_out.exists():
+            del model["output"]
+            continue
+        output = Path(work_dir.name, *Path(model["output"]).parts[1:])
+        (Path(dst_dir) / output).parent.mkdir(parents=True, exist_ok=True)
+        text = src_out.read_text(encoding='utf-8', errors='replace')
+        (Path(dst_dir) / output).write_text(kit_token.sub(dst_kit, text), encoding='utf-8')
+        model["output"] = str(output)
+    return qpadm_sweep.write_report(dst_dir, dst_kit, report)
+
+def link_kit_results(src_dir, src_kit, dst_dir, dst_kit):
+    """نتايج kit مكتمل بنفس الـ fingerprint → مجلد الـ kit الجديد بأسماء الـ kit الجديد.
+    الملفات اللي فيها الـ kit_id (صف الـ PCA، target الـ qpAdm) بتتكتب تاني بالحقول دي بس – الباقي hard link."""
+    qpadm_names = {f"{src_kit}_qpAdm.out", f"{src_kit}_qpadm.json"}
+    linked = link_qpadm_report(src_dir, src_kit, dst_dir, dst_kit)
+    for src_name, dst_name in zip(result_artifacts(src_kit), result_artifacts(dst_kit)):
+        src, dst = Path(src_dir) / src_name, Path(dst_dir) / dst_name
+        if src_name in qpadm_names or not src.exists():
+            continue
+        if dst.exists():
+            dst.unlink()
+        if src_name.endswith(".eigenvec"):
+            relabel_eigenvec(src, dst, src_kit, dst_kit)
+        else:
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copyfile(src, dst)
+        linked.append(str(dst))
+    return linked
+
+def tool_available(path):
+    return os.path.exists(path) or shutil.which(path) is not None
+
+def eigenstrat_ready(ctx):
+    # مع ref_panel الـ EIGENSTRAT بيتكتب من غير convertf
+    return tool_available(QPADM_PATH) and (ctx["has_ref"] or tool_available(CONVERTF_PATH))
+
+def stage_plan(ctx):
+    # الـ stages اللي هتتنفذ فعلاً – الـ progress بيتحسب على أوزانها بس
+    plan = ["clean"]
+    if ctx["via_23file"] and genotype_io.sniff_input_format(ctx["filepath"]) != 'plink':
+        plan.append("bed")
+    plan += ["merge", "prune", "pca", "admixture"]
+    if ctx["f2"] is not None:
+        plan.append("qpadm")
+    elif eigenstrat_ready(ctx):
+        plan += ["convertf", "qpadm"]
+    if ctx["has_ref"]:
+        plan.append("relatives")
+    return plan
+
+class StageProgress:
+    """on_stage الـ StageCache → progress(percent, stage, event) بنسبة أوزان الـ stages اللي خلصت."""
+
+    def __init__(self, plan, progress):
+        self.weights = {name: STAGE_WEIGHTS[name] for name in plan}
+        self.total = sum(self.weights.values())
+        self.finished = set()
+        self.progress = progress
+
+    def percent(self):
+        return int(100 * sum(self.weights[name] for name in self.finished) / self.total)
+
+    def __call__(self, name, event):
+        if event in ("done", "cached", "skipped"):
+            self.finished.add(name)
+        self.progress(self.percent(), name, event)
+
+def kit_context(filepath, kit_id, via_23file=False, exact_prune=EXACT_PRUNE):
+    """مسارات الـ kit + حالة الـ panel الحالي (مشتركة بين run_full_pipeline و cohort_batch)."""
     filepath = Path(filepath).resolve()
     if not filepath.exists():
-        print("الملف غير موجود!")
-        sys.exit(1)
+        raise FileNotFoundError(f"الملف غير موجود: {filepath}")
 
     kit_dir = filepath.parent
-    temp_clean = kit_dir / f"sorted_temp_{kit_id}.txt"
     out_prefix = str(kit_dir / kit_id)
-    merged_prefix = f"{out_prefix}_merged"
-    pruned_prefix = f"{out_prefix}_pruned"
-    results_dir = kit_dir / f"{kit_id}_results"
-    results_dir.mkdir(exist_ok=True)
+    ctx = {
+        "filepath": filepath,
+        "kit_id": kit_id,
+        "kit_dir": kit_dir,
+        "via_23file": via_23file,
+        "temp_clean": kit_dir / f"sorted_temp_{kit_id}.txt",
+        "out_prefix": out_prefix,
+        "merged_prefix": f"{out_prefix}_merged",
+        "pruned_prefix": f"{out_prefix}_pruned",
+        "pca_prefix": str(kit_dir / f"{kit_id}_pca"),
+        "eigen_prefix": str(kit_dir / f"{kit_id}_eigen"),
+        "threads": str(os.cpu_count() or 4),
+        "memory_mb": resource_governor.node_memory_mb(),
+        "ref_bed": reference_panel.default_ref_prefix(),
+        "exact_prune": exact_prune,
+    }
+    has_ref = ctx["has_ref"] = Path(f"{ctx['ref_bed']}.bed").exists()
+    ctx["panel_version"] = reference_panel.panel_version(ctx["ref_bed"]) if has_ref else None
+    ctx["panel_pca"] = reference_panel.load_pca(ctx["ref_bed"])
+    ctx["p_files"] = reference_panel.admixture_p_files(ctx["ref_bed"]) if ctx["panel_pca"] is not None else {}
+    ctx["f2"] = qpadm_sweep.load_f2(ctx["ref_bed"]) if has_ref else None
+    return ctx
 
-    threads = str(os.cpu_count() or 4)
+def governed(name, ctx, func):
+    """func(ctx) جوه حجز من resource_governor؛ ctx["threads"] و ctx["memory_mb"] = اللي اتمنح فعلاً.
+    بيتنادى من جوه cache.run، فالـ stage اللي نتيجته في الـ cache مابيحجزش حاجة ومابيتقاسش."""
+    min_cores, max_cores, memory_mb = STAGE_RESOURCES[name]
+    with resource_governor.allocate(name, ctx["kit_id"], min_cores, max_cores, memory_mb, log=log) as grant:
+        ctx["threads"], ctx["memory_mb"] = str(grant["cores"]), grant["memory_mb"]
+        with stage_metrics.measure(name, ctx["kit_id"], threads=grant["cores"], memory_mb=grant["memory_mb"],
+                                   queued_seconds=round(grant["granted_at"] - grant["since"], 3)) as record:
+            result = func(ctx)
+            record.update(stage_metrics.count_outputs(result["outputs"]))
+        return result
 
-    try:
-        if clean_and_sort_for_plink(filepath, temp_clean):
-            log("تحويل إلى BED بـ plink2")
-            run_cmd([
-                "plink2", "--23file", str(temp_clean),
-                "--out", out_prefix, "--make-bed", "--allow-no-sex", "--allow-extra-chr"
-            ])
-
-            ref_bed = str(Path(__file__).parent / "reference" / REFERENCE_PANEL_PREFIX)
-            if Path(f"{ref_bed}.bed").exists():
-                log("دمج حقيقي مع ref_panel (17k شخص)")
-                merge_cmd = [
-                    "plink2", "--bfile", out_prefix,
-                    "--bmerge", ref_bed, "--make-bed",
-                    "--out", merged_prefix, "--allow-no-sex", "--merge-mode", "6"
-                ]
-                merge_fallback = [
-                    "plink", "--bfile", out_prefix,
-                    "--bmerge", ref_bed, "--make-bed",
-                    "--out", merged_prefix, "--allow-no-sex", "--merge-mode", "6"
-                ]
-                run_cmd(merge_cmd, fallback_cmd=merge_fallback)
-                base_prefix = merged_prefix
+def prepare_kit(ctx, cache):
+    """clean (+ bed في المسار القديم) → ctx["kit_bfile"]؛ يرجّع الـ fingerprint."""
+    result = cache.run("clean", lambda: governed("clean", ctx, stage_clean), inputs=[ctx["filepath"]],
+                       params={"via_23file": ctx["via_23file"], "kit_id": ctx["kit_id"]})
+    ctx["kit_bfile"] = result["kit_bfile"]
+    if ctx["kit_bfile"] is None:
+        ctx["kit_bfile"] = cache.run("bed", lambda: governed("bed", ctx, stage_bed), inputs=[ctx["temp_clean"]],
+                                     params={"kit_id": ctx["kit_id"]}, tools=["plink2"])["kit_bfile"]
+    return result["fingerprint"]
+
+def run_full_pipeline(filepath, kit_id, via_23file=False, force=(), skip=(), reuse_lookup=None, progress=None,
+                      exact_prune=EXACT_PRUNE):
+    """يرجّع {"fingerprint", "panel_version", "reused_from"}؛
+    reuse_lookup(fingerprint, panel_version) → (kit_dir, kit_id) لـ kit مكتمل بنفس البيانات أو None.
+    progress(percent, stage, event) بيتنادى مع بداية ونهاية كل stage."""
+    ctx = kit_context(filepath, kit_id, via_23file, exact_prune)
+    kit_dir, panel_version = ctx["kit_dir"], ctx["panel_version"]
+
+    # clean → bed → merge → prune → PCA → ADMIXTURE → convertf → qpAdm؛ كل stage بيتنفذ بس لو مدخلاته اتغيرت
+    tracker = StageProgress(stage_plan(ctx), progress or (lambda percent, stage, event: None))
+    cache = stage_cache.StageCache(kit_dir / f"{kit_id}_stages.json", force=force, skip=skip, log=log,
+                                   on_stage=tracker)
+    # <kit>_metrics.jsonl: record لكل stage اتنفذ ولكل أداة اتشغلت (stage_metrics)
+    with stage_metrics.record_to(stage_metrics.metrics_path(kit_dir, kit_id)):
+        try:
+            fingerprint = prepare_kit(ctx, cache)
+            summary = {"fingerprint": fingerprint, "panel_version": panel_version, "reused_from": None}
+            source = reuse_lookup(fingerprint, panel_version) if reuse_lookup else None
+            if source is not None:
+                src_dir, src_kit = source
+                linked = link_kit_results(src_dir, src_kit, kit_dir, kit_id)
+                log(f"نفس بيانات {src_kit} على نفس الـ panel – ربط {len(linked)} ملف نتائج بدل إعادة الحساب")
+                summary["reused_from"] = src_kit
+                store_relatives(ctx, cache)
+                kit_results.write_kit_results(kit_dir, kit_id, panel_version)
+                tracker.progress(100, "reuse", "done")
+                return summary
+
+            ctx["base_prefix"] = cache.run("merge", lambda: governed("merge", ctx, stage_merge),
+                                           inputs=bfile_paths(ctx["kit_bfile"]),
+                                           params={"panel": panel_version, "harmonize": 1,
+                                                   "genotypes": full_merge_needed(ctx)})["base_prefix"]
+
+            panel_prune = (ctx["has_ref"] and not ctx["exact_prune"]
+                           and reference_panel.load_prune(ctx["ref_bed"]) is not None)
+            # تقاطع prune.in الـ panel بيقرا الـ .bim بس (ممكن يبقى الملف الوحيد اللي الـ merge كتبه)
+            prune_inputs = [f"{ctx['base_prefix']}.bim"] if panel_prune else bfile_paths(ctx["base_prefix"])
+            cache.run("prune", lambda: governed("prune", ctx, stage_prune), inputs=prune_inputs,
+                      params={"args": reference_panel.PRUNE_ARGS, "source": "panel" if panel_prune else "plink2",
+                              "panel": panel_version}, tools=[] if panel_prune else ["plink2"])
+
+            if ctx["panel_pca"] is not None:
+                pca_inputs = bfile_paths(ctx["kit_bfile"])
             else:
-                log("تحذير: ref_panel مش موجود")
-                base_prefix = out_prefix
-
-            log("Pruning سريع")
-            run_cmd([
-                "plink2", "--bfile", base_prefix,
-                "--indep-pairwise", "50", "5", "0.2",
-                "--maf", "0.05", "--geno", "0.1",
-                "--threads", threads,
-                "--out", pruned_prefix
-            ])
-
-            log("PCA على المواقع المختارة")
-            run_cmd([
-                "plink2", "--bfile", base_prefix,
-                "--extract", f"{pruned_prefix}.prune.in",
-                "--pca", "30",
-                "--threads", threads,
-                "--out", str(results_dir / f"{kit_id}_PCA_30")
-            ])
-
-            merged_bed = f"{base_prefix}.bed"
-            log("Admixture")
-            for k in [5, 8, 10, 13]:
-                subprocess.run([
-                    "admixture", "--cv", "--acceleration", merged_bed, str(k)
-                ], check=True)
-                for ext in [".Q", ".P"]:
-                    src = f"{merged_bed}.{k}{ext}"
-                    if Path(src).exists():
-                        os.rename(src, str(results_dir / f"{kit_id}_K{k}{ext}"))
-
-            if os.path.exists(CONVERTF_PATH) and os.path.exists(QPADM_PATH):
-                log("تحضير qpAdm")
-                eigen_prefix = f"{kit_id}_eigen"
-                with open("par_convert.txt", "w") as par:
-                    par.write(f"genotypename: {base_prefix}.bed\n")
-                    par.write(f"snpname: {base_prefix}.bim\n")
-                    par.write(f"indivname: {base_prefix}.fam\n")
-                    par.write("outputformat: EIGENSTRAT\n")
-                    par.write(f"genooutfilename: {eigen_prefix}.geno\n")
-                    par.write(f"snpoutfilename: {eigen_prefix}.snp\n")
-                    par.write(f"indoutfilename: {eigen_prefix}.ind\n")
-
-                subprocess.run([CONVERTF_PATH, "-p", "par_convert.txt"], check=True)
-
-                log("تشغيل qpAdm")
-                par_qpadm = f"{kit_id}_qpadm.par"
-                with open(par_qpadm, "w") as p:
-                    p.write(f"leftpops:\n  {kit_id}\n  Natufian\n  Anatolian_N\n  Iran_N\n  Levant_BA\n")
-                    p.write("rightpops:\n  Mbuti\n  Ami\n  Onge\n  Papuan\n")
-                    p.write("details: YES\nallsnps: NO\n")
-
-                with open(str(results_dir / f"{kit_id}_qpAdm.txt"), "w") as outf:
-                    subprocess.run([QPADM_PATH, "-p", par_qpadm], stdout=outf, check=True)
-
-            log(f"★ انتهى كل شيء! النتائج في: {results_dir}")
+                pca_inputs = bfile_paths(ctx["base_prefix"]) + [f"{ctx['pruned_prefix']}.prune.in"]
+            cache.run("pca", lambda: governed("pca", ctx, stage_pca), inputs=pca_inputs,
+                      params={"panel": panel_version if ctx["panel_pca"] is not None else None, "n_pcs": 30},
+                      tools=["plink2"])
 
-    except Exception as e:
-        log(f"خطأ: {e}")
-    finally:
-        if temp_clean.exists():
-            temp_clean.unlink()
-        for tmp in ["par_convert.txt", f"{kit_id}_qpadm.par"]:
-            if Path(tmp).exists():
-                Path(tmp).unlink()
+            admixture_inputs = bfile_paths(ctx["kit_bfile"] if ctx["p_files"] else ctx["base_prefix"])
+            cache.run("admixture", lambda: governed("admixture", ctx, stage_admixture), inputs=admixture_inputs,
+                      params={"ks": admixture_runner.ADMIXTURE_KS, "p_files": ctx["p_files"], "panel": panel_version},
+                      tools=[admixture_runner.ADMIXTURE_PATH])
+
+            if ctx["f2"] is not None:
+                # f2 الـ panel محسوبة – الـ kit بس ضدها، من غير convertf للـ panel كله
+                cache.run("qpadm", lambda: governed("qpadm", ctx, stage_qpadm), inputs=bfile_paths(ctx["kit_bfile"]),
+                          params={"engine": "f2", "panel": panel_version, **qpadm_sweep.sweep_params()})
+            elif eigenstrat_ready(ctx):
+                if ctx["has_ref"]:
+                    cache.run("convertf", lambda: governed("convertf", ctx, stage_convertf),
+                              inputs=bfile_paths(ctx["kit_bfile"]),
+                              params={"panel": panel_version, "populations": qpadm_populations()})
+                else:
+                    cache.run("convertf", lambda: governed("convertf", ctx, stage_convertf),
+                              inputs=bfile_paths(ctx["base_prefix"]),
+                              tools=[CONVERTF_PATH])
+                eigen_files = [f"{ctx['eigen_prefix']}.{ext}" for ext in ("geno", "snp", "ind")]
+                cache.run("qpadm", lambda: governed("qpadm", ctx, stage_qpadm), inputs=eigen_files,
+                          params={"engine": "qpAdm", **qpadm_sweep.sweep_params()}, tools=[QPADM_PATH])
+
+            store_relatives(ctx, cache)
+
+            # نتيجة مجمّعة وحدة (PCs + Q + p-value + distances) – app.results و app.dashboard بيقروها بس
+            kit_results.write_kit_results(kit_dir, kit_id, panel_version)
+            log(f"★ انتهى كل شيء! النتائج في: {kit_dir}")
+            return summary
+
+        except Exception as e:
+            # الـ stages اللي خلصت محفوظة في <kit>_stages.json – إعادة التشغيل بتكمل من الـ stage اللي فشل
+            log(f"خطأ: {e}")
+            raise
+        finally:
+            if ctx["temp_clean"].exists():
+                ctx["temp_clean"].unlink()
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("الاستخدام: python3 process_dna_plink2_super.py <مسار_الملف> <kit_id>")
+    parser = argparse.ArgumentParser(description="DeepAncestry pipeline: تنظيف → PLINK → PCA → ADMIXTURE → qpAdm")
+    parser.add_argument("filepath", help="مسار_الملف")
+    parser.add_argument("kit_id")
+    parser.add_argument("--via-23file", action="store_true",
+                        help="المسار القديم: نص مؤقت + plink2 --23file بدل كتابة BED مباشرة")
+    parser.add_argument("--force", action="append", default=[], choices=STAGES + ("all",), metavar="STAGE",
+                        help="تشغيل الـ stage حتى لو في الـ cache (ممكن تتكرر، أو all)")
+    parser.add_argument("--exact-prune", action="store_true", default=EXACT_PRUNE,
+                        help="Pruning كامل بـ plink2 على الـ merge (مراجعة) بدل prune.in الـ panel")
+    parser.add_argument("--skip", action="append", default=[], choices=STAGES, metavar="STAGE",
+                        help="تخطي الـ stage واستخدام آخر نتيجة محفوظة ليه")
+    args = parser.parse_args()
+    try:
+        run_full_pipeline(args.filepath, args.kit_id, via_23file=args.via_23file, force=args.force, skip=args.skip,
+                          exact_prune=args.exact_prune)
+    except FileNotFoundError as e:
+        log(str(e))
+        sys.exit(1)
+    except Exception:
         sys.exit(1)
-    run_full_pipeline(sys.argv[1], sys.argv[2])
\ No newline at end of file
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+qpadm_sweep.py – qpAdm لكل توليفات المصادر (2–4 way) من pool قابل للتعديل، مرتبة في نتيجة structured
+
+الـ panel build بيحسب f2 لكل زوج populations في كل jackknife block مرة وحدة (reference_panel.build_f2)؛
+الـ kit بيتحسب له f2 ضد populations الموديلات بس، وكل موديل = f4 rank test (chisq/p-value) + أوزان + jackknife SE
+في NumPy، والموديلات بتتقيّم بالتوازي. لو الـ f2 مش متبني، كل موديل بيتشغل بـ qpAdm (ADMIXTOOLS) في مجلد
+معزول جوه مجلد الـ kit. النتيجة <kit>_qpadm.json (الموديلات مرتبة) – kit_results بيقرا منها بدل regex على الـ .out.
+"""
+
+import json
+import os
+import re
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
+from pathlib import Path
+
+import numpy as np
+
+import reference_panel
+import stage_metrics
+
+REPORT_VERSION = 1
+DEFAULT_SOURCE_POOL = ["Natufian", "Anatolian_N", "Iran_N", "Levant_BA"]
+DEFAULT_RIGHT_POPS = ["Mbuti", "Ami", "Onge", "Papuan"]
+SOURCE_POOL = [p for p in os.getenv('QPADM_SOURCE_POOL', ",".join(DEFAULT_SOURCE_POOL)).split(",") if p]
+RIGHT_POPS = [p for p in os.getenv('QPADM_RIGHT_POPS', ",".join(DEFAULT_RIGHT_POPS)).split(",") if p]
+MIN_SOURCES = int(os.getenv('QPADM_MIN_SOURCES', 2))
+MAX_SOURCES = int(os.getenv('QPADM_MAX_SOURCES', 4))
+SWEEP_WORKERS = int(os.getenv('QPADM_SWEEP_WORKERS', 0)) or os.cpu_count() or 4
+FIT_ITERATIONS = 20
+COVARIANCE_FUDGE = 1e-4
+P_THRESHOLD = 0.05
+
+_loaded = {}
+
+
+def sweep_params():
+    # كل اللي بيغيّر الموديلات – جزء من key الـ stage cache
+    return {"pool": SOURCE_POOL, "right": RIGHT_POPS, "sizes": [MIN_SOURCES, MAX_SOURCES]}
+
+
+def candidate_models(pool, right):
+    """كل توليفات MIN..MAX مصدر من الـ pool؛ الـ rank test محتاج rights ≥ عدد المصادر + 1."""
+    max_sources = min(MAX_SOURCES, len(right) - 1, len(pool))
+    return [list(sources) for size in range(MIN_SOURCES, max_sources + 1) for sources in combinations(pool, size)]
+
+
+def load_f2(ref_prefix=None):
+    """f2 blocks الـ panel الحالي (mmap، cache لكل worker) أو None لو مش متبنية."""
+    ref_prefix = ref_prefix or reference_panel.default_ref_prefix()
+    manifest = reference_panel.load_manifest(ref_prefix)
+    if not manifest or "f2" not in manifest["components"]:
+        return None
+    out_dir = reference_panel.panel_dir(ref_prefix, manifest["version"])
+    key = str(out_dir)
+    if key not in _loaded:
+        meta = json.loads((out_dir / "f2_populations.json").read_text(encoding='utf-8'))
+        with np.load(out_dir / "f2_snps.npz") as data:
+            f2 = {name: data[name] for name in data.files}
+        # نفس حقول pca اللي reference_panel.match_kit محتاجها
+        order = np.argsort(f2["key"], kind='stable')
+        f2["order"], f2["sorted_key"] = order, f2["key"][order]
+        f2.update({
+            "version": manifest["version"],
+            "populations": meta["populations"],
+            "index": {name: i for i, name in enumerate(meta["populations"])},
+            "block_sizes": np.asarray(meta["block_sizes"], dtype=np.float64),
+            "freq": np.load(out_dir / "f2_freq.npy", mmap_mode='r'),
+            "counts": np.load(out_dir / "f2_counts.npy", mmap_mode='r'),
+            "blocks": np.load(out_dir / "f2_blocks.npy", mmap_mode='r'),
+        })
+        _loaded[key] = f2
+    return _loaded[key]
+
+
+# ---------------------------------------------------------------- f2 / f4
+
+def kit_f2(f2, kit_bfile, pop_idx):
+    """f2(kit, pop) لكل block → (مجموع على الـ SNPs, عدد الـ SNPs) كل واحد (blocks × pops)."""
+    panel_idx, g = reference_panel.match_kit(f2, kit_bfile)
+    block = f2["block"][panel_idx]
+    keep = ~np.isnan(g) & (block >= 0)
+    panel_idx, block, pk = panel_idx[keep], block[keep], g[keep] / 2
+    hk = pk * (1 - pk)  # فرد diploid وحد: n = 2 → p(1−p)/(n−1)
+    n_blocks = len(f2["block_sizes"])
+    sums = np.zeros((n_blocks, len(pop_idx)))
+    counts = np.zeros((n_blocks, len(pop_idx)))
+    for col, pop in enumerate(pop_idx):
+        pa = f2["freq"][pop][panel_idx].astype(np.float64)
+        na = f2["counts"][pop][panel_idx].astype(np.float64)
+        present = ~np.isnan(pa)
+        value = (pk - pa) ** 2 - hk - pa * (1 - pa) / np.maximum(na - 1, 1)
+        sums[:, col] = np.bincount(block[present], value[present], minlength=n_blocks)
+        counts[:, col] = np.bincount(block[present], minlength=n_blocks)
+    return sums, counts
+
+
+def jackknife_f2(f2, sums, counts, pop_idx):
+    """الـ kit (index 0) + populations الموديلات → (f2 كامل n × n, f2 leave-one-block-out blocks × n × n)."""
+    idx = np.asarray(pop_idx)
+    ref = np.asarray(f2["blocks"][:, idx][:, :, idx], dtype=np.float64)
+    n_blocks, n = ref.shape[0], len(idx) + 1
+    values = np.zeros((n_blocks, n, n))
+    weights = np.zeros((n_blocks, n, n))
+    values[:, 1:, 1:] = np.nan_to_num(ref)
+    weights[:, 1:, 1:] = np.where(np.isnan(ref), 0, f2["block_sizes"][:, None, None])
+    kit_values = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+    values[:, 0, 1:] = values[:, 1:, 0] = kit_values
+    weights[:, 0, 1:] = weights[:, 1:, 0] = counts
+
+    total = weights.sum(axis=0)
+    weighted = (weights * values).sum(axis=0)
+    full = np.divide(weighted, total, out=np.zeros_like(weighted), where=total > 0)
+    rest = total[None] - weights
+    loo = np.divide(weighted[None] - weights * values, rest, out=np.broadcast_to(full, rest.shape).copy(),
+                    where=rest > 0)
+    return full, loo
+
+
+def f4_matrix(f2, target, sources, right):
+    """X[i, j] = f4(target, sourceᵢ; right₀, rightⱼ) من f2 (…, n, n): لو target = Σ wᵢ·sourceᵢ يبقى wᵀX = 0."""
+    s, r0, r = np.asarray(sources), right[0], np.asarray(right[1:])
+    return (f2[..., target, r][..., None, :] + f2[..., s, r0][..., :, None]
+            - f2[..., target, r0][..., None, None] - f2[..., s[:, None], r[None, :]]) / 2
+
+
+# ---------------------------------------------------------------- fit
+
+def _gls(design, y, q_inv):
+    lhs = design.T @ q_inv @ design
+    return np.linalg.lstsq(lhs, design.T @ q_inv @ y, rcond=None)[0]
+
+
+def fit_rank(x, q_inv, rank, iterations=FIT_ITERATIONS):
+    """أقرب مصفوفة rank r لـ X (k × m) بالـ GLS (chisq = eᵀQ⁻¹e) بـ alternating least squares → (A, chisq)."""
+    k, m = x.shape
+    y = x.ravel()
+    if rank == 0:
+        return np.zeros((k, 0)), float(y @ q_inv @ y)
+    a = np.linalg.svd(x, full_matrices=False)[0][:, :rank]
+    for _ in range(iterations):
+        # vec(AB) row-major = (A ⊗ I_m)·vec(B) = (I_k ⊗ Bᵀ)·vec(A)
+        b = _gls(np.kron(a, np.eye(m)), y, q_inv).reshape(rank, m)
+        a = _gls(np.kron(np.eye(k), b.T), y, q_inv).reshape(k, rank)
+    e = y - (a @ b).ravel()
+    return a, float(e @ q_inv @ e)
+
+
+def _null_weights(a):
+    # الأوزان ⟂ أعمدة A (فـ wᵀ·AB = 0) و Σw = 1
+    k = a.shape[0]
+    if a.shape[1] == 0:
+        return np.ones(k)
+    w = np.linalg.svd(a, full_matrices=True)[0][:, -1]
+    return w / w.sum()
+
+
+def fit_model(full, loo, target, sources, right):
+    """موديل qpAdm وحد على f2 jackknife: target = Σ wᵢ·sourceᵢ، rank(X) = k − 1."""
+    x = f4_matrix(full, target, sources, right)
+    x_loo = f4_matrix(loo, target, sources, right)
+    k, m = x.shape
+    n_blocks = len(x_loo)
+    flat = x_loo.reshape(n_blocks, -1)
+    centered = flat - flat.mean(axis=0)
+    q = (n_blocks - 1) / n_blocks * centered.T @ centered
+    q += np.eye(len(q)) * COVARIANCE_FUDGE * np.trace(q) / len(q)
+    q_inv = np.linalg.pinv(q)
+
+    a, chisq = fit_rank(x, q_inv, k - 1)
+    weights = _null_weights(a)
+    # jackknife الأوزان: الـ null vector بتاع X لكل block (SVD batched – أرخص من ALS لكل block)
+    u = np.linalg.svd(x_loo, full_matrices=True)[0][:, :, -1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w_loo = u / u.sum(axis=1, keepdims=True)
+    w_loo = w_loo[np.isfinite(w_loo).all(axis=1)]
+    se = np.sqrt((len(w_loo) - 1) / max(len(w_loo), 1) * ((w_loo - w_loo.mean(axis=0)) ** 2).sum(axis=0))
+    dof = (k - (k - 1)) * (m - (k - 1))
+    return weights, se, chisq, dof
+
+
+def model_entry(sources, weights, se, chisq, dof, p_value):
+    weights, se = np.asarray(weights, dtype=np.float64), np.asarray(se, dtype=np.float64)
+    return {
+        "sources": [{"name": name, "weight": float(w), "se": float(e) if np.isfinite(e) else None}
+                    for name, w, e in zip(sources, weights, se)],
+        "chisq": float(chisq) if chisq is not None else None,
+        "dof": int(dof) if dof is not None else None,
+        "p_value": float(p_value) if p_value is not None else None,
+        "feasible": bool(len(weights) == len(sources) and np.all((weights >= 0) & (weights <= 1))),
+    }
+
+
+def passes(model):
+    return model["feasible"] and model["p_value"] is not None and model["p_value"] > P_THRESHOLD
+
+
+def rank_models(models):
+    # الموديلات اللي بتعدّي (feasible و p > P_THRESHOLD) الأول، وبينهم الأقل مصادر: مصدر زيادة بوزن ~0 بيعدّي
+    # دايماً لو الأصغر عدّى فالأبسط هو الإجابة (زي qpAdm). بعدين feasible، وجوه كل مجموعة الأعلى p-value
+    return sorted(models, key=lambda m: (not passes(m), not m["feasible"], len(m["sources"]) if passes(m) else 0,
+                                         -(m["p_value"] if m["p_value"] is not None else -1)))
+
+
+def sweep_f2(f2, kit_bfile, kit_id, pool=None, right=None, workers=None):
+    """كل موديلات الـ pool على f2 الـ panel → report (الموديلات مرتبة)."""
+    pool, right = pool or SOURCE_POOL, right or RIGHT_POPS
+    missing = [pop for pop in pool + right if pop not in f2["index"]]
+    pool = [pop for pop in pool if pop in f2["index"]]
+    right = [pop for pop in right if pop in f2["index"]]
+    models = candidate_models(pool, right)
+    report = {"engine": "f2", "target": kit_id, "right": right, "missing": missing, "models": []}
+    if not models:
+        return report
+
+    names = pool + right
+    position = {name: i + 1 for i, name in enumerate(names)}  # 0 = الـ kit
+    pop_idx = [f2["index"][name] for name in names]
+    full, loo = jackknife_f2(f2, *kit_f2(f2, kit_bfile, pop_idx), pop_idx)
+    right_pos = [position[name] for name in right]
+    # p-value = chi2.sf(chisq, dof) = Q(dof/2, chisq/2) – scipy.special بس (scipy.stats ~1 ثانية import)،
+    # وبتتحمل هنا مش عند import الـ module (الـ worker بيحمّلها في preload)
+    from scipy.special import gammaincc
+
+    def evaluate(sources):
+        weights, se, chisq, dof = fit_model(full, loo, 0, [position[name] for name in sources], right_pos)
+        return model_entry(sources, weights, se, chisq, dof, gammaincc(dof / 2, chisq / 2))
+
+    # الـ linalg بتاع NumPy بيسيب الـ GIL – الموديلات بتتقيّم بالتوازي في threads
+    with ThreadPoolExecutor(max_workers=workers or SWEEP_WORKERS) as pool_exec:
+        report["models"] = rank_models(list(pool_exec.map(evaluate, models)))
+    return report
+
+
+# ---------------------------------------------------------------- ADMIXTOOLS
+
+def _floats_after(label, text):
+    match = re.search(rf"{label}\s*((?:[-+\d.eE]+\s*)+)", text)
+    return [float(v) for v in match.group(1).split()] if match else []
+
+
+def parse_qpadm_output(text, n_sources):
+    """stdout الـ qpAdm → (أوزان, SE, chisq, dof, p-value) من سطر f4rank بتاع rank k − 1."""
+    weights = _floats_after(r"best coefficients:", text)[:n_sources]
+    se = _floats_after(r"std\. errors:", text)[:n_sources]
+    rank = re.search(rf"f4rank:\s*{n_sources - 1}\s+dof:\s*(\d+)\s+chisq:\s*([-\d.eE+]+)\s+tail:\s*([-\d.eE+]+)", text)
+    if rank:
+        return weights, se, float(rank.group(2)), int(rank.group(1)), float(rank.group(3))
+    # إصدارات قديمة بتطبع p-value بس
+    match = re.search(r"p-value\s+([\d.eE+-]+)", text, re.IGNORECASE)
+    return weights, se, None, None, float(match.group(1)) if match else None
+
+
+def run_qpadm_model(qpadm_path, eigen_prefix, target, sources, right, model_dir):
+    """موديل وحد في مجلد معزول (الـ par والـ stdout جواه) → model entry."""
+    model_dir = Path(model_dir)
+    model_dir.mkdir(parents=True, exist_ok=True)
+    par = model_dir / "qpadm.par"
+    with open(par, "w") as p:
+        p.write(f"genotypename: {eigen_prefix}.geno\nsnpname: {eigen_prefix}.snp\nindivname: {eigen_prefix}.ind\n")
+        p.write("leftpops:\n" + "".join(f"  {pop}\n" for pop in [target] + sources))
+        p.write("rightpops:\n" + "".join(f"  {pop}\n" for pop in right))
+        p.write("details: YES\nallsnps: NO\n")
+    with open(model_dir / "qpadm.out", "w") as outf:
+        stage_metrics.run_tool([qpadm_path, "-p", str(par)], stdout=outf, cwd=model_dir)
+    text = (model_dir / "qpadm.out").read_text(encoding='utf-8', errors='replace')
+    weights, se, chisq, dof, p_value = parse_qpadm_output(text, len(sources))
+    se = se + [float('nan')] * (len(weights) - len(se))
+    # مسار نسبي لمجلد الـ kit (الـ json بيتربط لـ kits تانية بنفس البيانات)
+    output = Path(model_dir.parent.name) / model_dir.name / "qpadm.out"
+    return {**model_entry(sources, weights, se, chisq, dof, p_value), "output": str(output)}
+
+
+def sweep_qpadm(qpadm_path, eigen_prefix, kit_id, work_dir, pool=None, right=None, workers=None):
+    """نفس الـ sweep بالـ qpAdm binary: كل موديل process لوحده في work_dir/model_XXX."""
+    pool, right = pool or SOURCE_POOL, right or RIGHT_POPS
+    models = candidate_models(pool, right)
+    work_dir = Path(work_dir)
+
+    def evaluate(item):
+        i, sources = item
+        try:
+            return run_qpadm_model(qpadm_path, eigen_prefix, kit_id, sources, right, work_dir / f"model_{i:03d}")
+        except subprocess.CalledProcessError as e:
+            return {**model_entry(sources, [], [], None, None, None), "error": str(e)}
+
+    # الشغل في processes الـ qpAdm نفسها – الـ threads بتستناها بس
+    with ThreadPoolExecutor(max_workers=workers or SWEEP_WORKERS) as pool_exec:
+        results = list(pool_exec.map(evaluate, enumerate(models)))
+    return {"engine": "qpAdm", "target": kit_id, "right": right, "missing": [], "models": rank_models(results)}
+
+
+# ---------------------------------------------------------------- report
+
+def report_path(kit_dir, kit_id):
+    return Path(kit_dir) / f"{kit_id}_qpadm.json"
+
+
+def format_report(report):
+    """جدول نصي للموديلات (<kit>_qpAdm.out اللي صفحة النتائج بتعرضه)."""
+    lines = [f"qpAdm sweep ({report['engine']}) – target: {report['target']}",
+             f"right: {' '.join(report['right'])}"]
+    if report["missing"]:
+        lines.append(f"populations مش موجودة في الـ panel: {' '.join(report['missing'])}")
+    lines.append(f"{len(report['models'])} موديل (اللي بيعدّي الأول بالأقل مصادر، بعدين feasible، بعدين p-value)\n")
+    for rank, model in enumerate(report["models"], 1):
+        p_value = f"{model['p_value']:.6g}" if model["p_value"] is not None else "—"
+        parts = [f"{s['name']} {s['weight']:.3f}" + (f"±{s['se']:.3f}" if s["se"] is not None else "")
+                 for s in model["sources"]] or [s for s in model.get("error", "فشل").splitlines()[:1]]
+        flag = "✓" if passes(model) else " "
+        lines.append(f"{rank:3d} {flag} p-value {p_value:>10}  " + "  ".join(parts))
+    return "\n".join(lines) + "\n"
+
+
+def write_report(kit_dir, kit_id, report):
+    """<kit>_qpadm.json (structured) + <kit>_qpAdm.out (جدول) → المسارين."""
+    path = report_path(kit_dir, kit_id)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps({"version": REPORT_VERSION, **report}, ensure_ascii=False, indent=1), encoding='utf-8')
+    os.replace(tmp, path)
+    text_path = Path(kit_dir) / f"{kit_id}_qpAdm.out"
+    text_path.write_text(format_report(report), encoding='utf-8')
+    return [str(path), str(text_path)]
+
+
+def load_report(kit_dir, kit_id):
+    path = report_path(kit_dir, kit_id)
+    if not path.exists():
+        return None
+    report = json.loads(path.read_text(encoding='utf-8'))
+    return report if report.get("version") == REPORT_VERSION else None
@@ -0,0 +1,695 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+reference_panel.py – Panel build مرة وحدة (PCA loadings + allele freqs) بإصدار = hash الـ ref_panel
+
+الاستخدام: python3 reference_panel.py build [--ref reference/ref_panel]
+كل kit بعد كده بيتعمله projection على محاور الـ panel بدل PCA كامل على 17k شخص،
+و ADMIXTURE -P على .P الـ panel بدل fit كامل لكل K، و qpAdm على f2 blocks الـ panel بدل convertf لكل kit.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+import admixture_runner
+import genotype_io
+import stage_metrics
+
+REFERENCE_DIR = Path(os.getenv('REFERENCE_DIR') or Path(__file__).parent / "reference")
+REFERENCE_PANEL_PREFIX = "ref_panel"
+N_PCS = 30
+PRUNE_ARGS = ["--indep-pairwise", "50", "5", "0.2", "--maf", "0.05", "--geno", "0.1"]
+F2_BLOCK_BP = 5_000_000
+# بوابة جودة قبل الـ merge: SNPs الـ kit اللي اتطابقت مع الـ panel بعد الـ harmonization
+MIN_OVERLAP_SNPS = int(os.getenv('MIN_OVERLAP_SNPS', 10_000))
+MIN_OVERLAP_FRACTION = float(os.getenv('MIN_OVERLAP_FRACTION', 0.05))
+_COMPLEMENT = bytes.maketrans(b'ACGTacgt', b'TGCAtgca')
+
+_loaded = {}
+
+
+def log(msg):
+    print(f"[*] {msg}")
+
+
+def default_ref_prefix():
+    return str(REFERENCE_DIR / REFERENCE_PANEL_PREFIX)
+
+
+def _stat_signature(ref_prefix):
+    return [[os.path.getsize(f"{ref_prefix}{ext}"), int(os.path.getmtime(f"{ref_prefix}{ext}"))]
+            for ext in genotype_io.PLINK_EXTENSIONS]
+
+
+def panel_version(ref_prefix):
+    """sha256 للـ .bed/.bim/.fam – محفوظ جنب الـ panel وبيتحسب تاني بس لو الملفات اتغيرت."""
+    cache_path = Path(f"{ref_prefix}.version.json")
+    signature = _stat_signature(ref_prefix)
+    if cache_path.exists():
+        cached = json.loads(cache_path.read_text())
+        if cached.get("signature") == signature:
+            return cached["version"]
+
+    digest = hashlib.sha256()
+    for ext in genotype_io.PLINK_EXTENSIONS:
+        with open(f"{ref_prefix}{ext}", 'rb') as f:
+            for data in iter(lambda: f.read(genotype_io.READ_SIZE), b''):
+                digest.update(data)
+    version = digest.hexdigest()
+    # tmp + os.replace: kit تاني بيقرا الملف في نفس الوقت مايشوفش JSON نصه مكتوب
+    tmp = cache_path.with_name(f"{cache_path.name}.tmp{os.getpid()}")
+    tmp.write_text(json.dumps({"signature": signature, "version": version}))
+    os.replace(tmp, cache_path)
+    return version
+
+
+def panel_dir(ref_prefix, version=None):
+    version = version or panel_version(ref_prefix)
+    return Path(ref_prefix).parent / f"panel_{version[:12]}"
+
+
+def load_manifest(ref_prefix):
+    if not Path(f"{ref_prefix}.bed").exists():
+        return None
+    manifest_path = panel_dir(ref_prefix) / "manifest.json"
+    if not manifest_path.exists():
+        return None
+    return json.loads(manifest_path.read_text())
+
+
+def _save_manifest(out_dir, manifest):
+    (Path(out_dir) / "manifest.json").write_text(json.dumps(manifest, indent=2))
+
+
+def _build_once(out_dir, marker, build):
+    """build(مجلد) في مجلد مؤقت + rename: لو اتنين kits بنوه في نفس الوقت، واحد بس بيكسب والتاني بيستخدمه."""
+    out_dir = Path(out_dir)
+    if (out_dir / marker).exists():
+        return out_dir
+    tmp = out_dir.with_name(f"{out_dir.name}.tmp{os.getpid()}")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    build(tmp)
+    if out_dir.exists() and not (out_dir / marker).exists():
+        # مجلد قديم من غير الـ marker (build اتقطع أو اتمسح جزء منه) – os.rename مابيكتبش فوق مجلد مش فاضي
+        shutil.rmtree(out_dir, ignore_errors=True)
+    try:
+        os.rename(tmp, out_dir)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return out_dir
+
+
+# ---------------------------------------------------------------- SNP index / harmonization
+
+def build_snp_index(ref_prefix, out_dir):
+    """rsID + key (chrom/pos) + الأليلات لكل SNP في الـ panel (بترتيب الـ .bim) + ترتيب الـ key، كـ .npy للـ mmap."""
+    bim = genotype_io.read_bim(ref_prefix)
+    order = np.argsort(bim.key, kind='stable')
+    arrays = {"key": bim.key, "rsid": bim.rsid, "a1": bim.a1, "a2": bim.a2, "order": order, "sorted_key": bim.key[order]}
+    for name, values in arrays.items():
+        np.save(Path(out_dir) / f"{name}.npy", values)
+    log(f"فهرس SNPs الـ panel: {len(bim.key)} SNP")
+
+
+def load_snp_index(ref_prefix):
+    """فهرس SNPs الـ panel الحالي (mmap؛ بيتبني أول مرة بس) – نفس حقول pca اللي match_kit محتاجها."""
+    out_dir = panel_dir(ref_prefix) / "snp_index"
+    key = str(out_dir)
+    if key not in _loaded:
+        _build_once(out_dir, "sorted_key.npy", lambda tmp: build_snp_index(ref_prefix, tmp))
+        _loaded[key] = {name: np.load(out_dir / f"{name}.npy", mmap_mode='r')
+                        for name in ("key", "rsid", "a1", "a2", "order", "sorted_key")}
+    return _loaded[key]
+
+
+def complement(alleles):
+    return np.char.translate(alleles, _COMPLEMENT)
+
+
+def _declared_fit(allele, a1, a2):
+    return (allele == b'.') | (allele == b'0') | (allele == a1) | (allele == a2)
+
+
+# ---------------------------------------------------------------- pruning / QC
+
+def build_prune(ref_prefix, out_dir, threads=None):
+    """LD pruning (PRUNE_ARGS) على الـ panel لوحده + MAF و missingness لكل SNP – مرة لكل version.
+    kit زيادة نادراً ما بيغيّر نتيجة الـ pruning، فالـ kits بتاخد تقاطعها مع prune.in ده بدل plink2 لكل kit."""
+    threads = str(threads or os.cpu_count() or 4)
+    out_dir = Path(out_dir)
+    log("Pruning للـ panel")
+    stage_metrics.run_tool(["plink2", "--bfile", ref_prefix, *PRUNE_ARGS, "--threads", threads,
+                            "--out", str(out_dir / "prune")])
+
+    fam_ids = genotype_io.read_fam_ids(ref_prefix)
+    bim = genotype_io.read_bim(ref_prefix)
+    maf = np.zeros(len(bim.key), dtype=np.float32)
+    missing = np.zeros(len(bim.key), dtype=np.float32)
+    start = 0
+    for dosage in genotype_io.iter_bed_dosages(ref_prefix, len(fam_ids)):
+        end = start + len(dosage)
+        called = np.count_nonzero(~np.isnan(dosage), axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            freq = np.nansum(dosage, axis=1) / (2 * called)
+        maf[start:end] = np.nan_to_num(np.minimum(freq, 1 - freq))
+        missing[start:end] = 1 - called / len(fam_ids)
+        start = end
+    np.savez(out_dir / "qc.npz", rsid=bim.rsid, key=bim.key, maf=maf, missing=missing)
+    n_pruned = sum(1 for line in open(out_dir / "prune.prune.in") if line.strip())
+    log(f"prune.in الـ panel: {n_pruned} SNP من {len(bim.key)}")
+    return {"args": PRUNE_ARGS, "n_snps": int(len(bim.key)), "n_pruned": n_pruned,
+            "files": ["prune.prune.in", "qc.npz"]}
+
+
+def load_prune(ref_prefix):
+    """SNPs prune.in الـ panel الحالي (IDs مرتبة، cache لكل worker) أو None لو الـ component مش متبني
+    أو اتبنى بـ PRUNE_ARGS تانية."""
+    manifest = load_manifest(ref_prefix)
+    if not manifest or manifest["components"].get("prune", {}).get("args") != PRUNE_ARGS:
+        return None
+    path = panel_dir(ref_prefix, manifest["version"]) / "prune.prune.in"
+    if path not in _loaded:
+        _loaded[path] = np.unique(np.array(open(path, 'rb').read().split()))
+    return _loaded[path]
+
+
+def load_qc(ref_prefix):
+    """جداول MAF و missingness الـ panel ({"rsid", "key", "maf", "missing"}) أو None."""
+    manifest = load_manifest(ref_prefix)
+    if not manifest or "prune" not in manifest["components"]:
+        return None
+    with np.load(panel_dir(ref_prefix, manifest["version"]) / "qc.npz") as data:
+        return {name: data[name] for name in data.files}
+
+
+def intersect_prune(prune_ids, bfile, out_path):
+    """SNPs الـ bfile (الـ merge = SNPs الـ kit المشتركة مع الـ panel) اللي في prune.in الـ panel → out_path."""
+    rsid = genotype_io.read_bim(bfile).rsid
+    kept = rsid[np.isin(rsid, prune_ids)]
+    with open(out_path, 'wb') as f:
+        f.write(b"".join(r + b"\n" for r in kept.tolist()))
+    return len(kept)
+
+
+# ---------------------------------------------------------------- PCA
+
+def read_eigenvec(path, fam_ids, n_pcs):
+    """eigenvectors plink2 بترتيب الـ .fam → مصفوفة (samples × n_pcs)."""
+    vectors = {}
+    with open(path) as f:
+        header = f.readline().split()
+        id_col = header.index("IID")
+        for line in f:
+            parts = line.split()
+            vectors[parts[id_col]] = [float(x) for x in parts[id_col + 1:id_col + 1 + n_pcs]]
+    return np.array([vectors[iid] for _, iid in fam_ids], dtype=np.float64)
+
+
+def build_pca(ref_prefix, out_dir, n_pcs=N_PCS, threads=None):
+    threads = str(threads or os.cpu_count() or 4)
+    out_dir = Path(out_dir)
+    pruned = out_dir / "ref_pruned"
+
+    stage_metrics.run_tool(["plink2", "--bfile", ref_prefix, "--extract", str(out_dir / "prune.prune.in"),
+                            "--make-bed", "--threads", threads, "--out", str(pruned)])
+
+    log(f"PCA {n_pcs} على الـ panel (مرة وحدة)")
+    stage_metrics.run_tool(["plink2", "--bfile", str(pruned), "--pca", str(n_pcs), "--threads", threads,
+                            "--out", str(out_dir / "pca")])
+
+    fam_ids = genotype_io.read_fam_ids(pruned)
+    eigenvec = read_eigenvec(out_dir / "pca.eigenvec", fam_ids, n_pcs)
+    eigenval = np.loadtxt(out_dir / "pca.eigenval", ndmin=1)[:n_pcs]
+
+    # loadings: L = Xᵀv / ‖Xᵀv‖² → x_ref · L يرجّع نفس الـ eigenvector بالظبط، و x_kit · L هو الـ projection
+    bim = genotype_io.read_bim(pruned)
+    freq = np.zeros(len(bim.key), dtype=np.float64)
+    xtv = np.zeros((len(bim.key), n_pcs), dtype=np.float64)
+    start = 0
+    for dosage in genotype_io.iter_bed_dosages(pruned, len(fam_ids)):
+        end = start + len(dosage)
+        p = np.nanmean(dosage, axis=1) / 2
+        scale = np.sqrt(2 * p * (1 - p))
+        x = (dosage - 2 * p[:, None]) / np.where(scale > 0, scale, np.inf)[:, None]
+        xtv[start:end] = np.nan_to_num(x) @ eigenvec
+        freq[start:end] = p
+        start = end
+    loadings = xtv / (xtv ** 2).sum(axis=0)
+
+    np.savez(out_dir / "pca.npz", key=bim.key, rsid=bim.rsid, a1=bim.a1, a2=bim.a2,
+             freq=freq, loadings=loadings.astype(np.float32), eigenval=eigenval)
+    return {"n_pcs": n_pcs, "n_snps": int(len(bim.key)), "n_samples": len(fam_ids),
+            "files": ["pca.npz", "pca.eigenvec", "pca.eigenval", "ref_pruned.bed"]}
+
+
+def load_pca(ref_prefix):
+    """loadings الـ panel الحالي (cache لكل worker) أو None لو الـ build مش موجود."""
+    manifest = load_manifest(ref_prefix)
+    if not manifest or "pca" not in manifest["components"]:
+        return None
+    path = panel_dir(ref_prefix, manifest["version"]) / "pca.npz"
+    if path not in _loaded:
+        with np.load(path) as data:
+            pca = {name: data[name] for name in data.files}
+        order = np.argsort(pca["key"], kind='stable')
+        pca["order"], pca["sorted_key"] = order, pca["key"][order]
+        pca["version"] = manifest["version"]
+        _loaded[path] = pca
+    return _loaded[path]
+
+
+def panel_a1_dosage(bim, dosage, a1, a2):
+    """يحوّل dosage الـ kit (نسخ A1 بتاعه) لعدد نسخ A1 بتاع الـ panel؛ NaN لو الأليلات مش متطابقة."""
+    known = lambda allele: (allele == a1) | (allele == a2)
+    counts = dosage * (bim.a1 == a1) + (2 - dosage) * (bim.a2 == a1)
+    ok = (known(bim.a1) | (dosage == 0)) & (known(bim.a2) | (dosage == 2))
+    return np.where(ok, counts, np.nan)
+
+
+def harmonize_kit(panel, kit_bfile):
+    """SNPs الـ kit على نفس مواقع الـ panel → (فهرسها في الـ panel, عدد نسخ A1 بتاع الـ panel, إحصائيات).
+
+    الأليلات بتتقارن مباشرة وبعد الـ complement (strand flip)؛ SNPs الـ A/T و C/G بتتشال (الـ strand
+    مش معروف) وأي أليلات مش متطابقة بتبقى NaN."""
+    bim = genotype_io.read_bim(kit_bfile)
+    dosage = np.concatenate(list(genotype_io.iter_bed_dosages(kit_bfile, 1)))[:, 0]
+
+    idx = np.searchsorted(panel["sorted_key"], bim.key).clip(max=len(panel["sorted_key"]) - 1)
+    matched = (panel["sorted_key"][idx] == bim.key) & (bim.key > 0)
+    panel_idx = np.asarray(panel["order"][idx[matched]])
+    kit = genotype_io.Bim(*(col[matched] for col in bim))
+    d = dosage[matched]
+    a1, a2 = np.asarray(panel["a1"][panel_idx]), np.asarray(panel["a2"][panel_idx])
+
+    flipped_kit = kit._replace(a1=complement(kit.a1), a2=complement(kit.a2))
+    # كل أليل معلن في الـ .bim الـ kit (مش '.' أو '0') لازم يبقى من أليلات الـ panel – مش بس اللي في الـ genotype
+    fits = lambda k: _declared_fit(k.a1, a1, a2) & _declared_fit(k.a2, a1, a2)
+    ambiguous = complement(a1) == a2
+    direct_ok, flip_ok = fits(kit), ~fits(kit) & fits(flipped_kit) & ~ambiguous
+    g = np.where(direct_ok & ~ambiguous, panel_a1_dosage(kit, d, a1, a2),
+                 np.where(flip_ok, panel_a1_dosage(flipped_kit, d, a1, a2), np.nan))
+
+    called = ~np.isnan(d)
+    n_kit = int(np.count_nonzero(~np.isnan(dosage) & (bim.key > 0)))
+    used = int(np.count_nonzero(~np.isnan(g)))
+    stats = {
+        "kit_snps": n_kit,
+        "overlap": int(np.count_nonzero(called)),
+        "used": used,
+        "flipped": int(np.count_nonzero(flip_ok & called)),
+        "ambiguous": int(np.count_nonzero(ambiguous & called)),
+        "mismatch": int(np.count_nonzero(called & ~ambiguous & ~direct_ok & ~flip_ok)),
+        "overlap_pct": round(100 * used / n_kit, 1) if n_kit else 0.0,
+    }
+    return panel_idx, g, stats
+
+
+def match_kit(pca, kit_bfile):
+    """SNPs الـ kit المشتركة مع الـ panel → (فهرسها في الـ panel, عدد نسخ A1 بتاع الـ panel)."""
+    panel_idx, g, _ = harmonize_kit(pca, kit_bfile)
+    return panel_idx, g
+
+
+def overlap_message(stats):
+    return (f"تطابق مع الـ panel: {stats['used']} SNP ({stats['overlap_pct']}% من {stats['kit_snps']})، "
+            f"strand flip {stats['flipped']}، A/T و C/G متشالة {stats['ambiguous']}، أليلات مختلفة {stats['mismatch']}")
+
+
+def check_overlap(stats):
+    """بوابة جودة قبل الـ merge: kit مش على نفس الـ build أو ملف ناقص بيفشل هنا بدل ما يكمل بنتايج فاضية."""
+    if stats["used"] < MIN_OVERLAP_SNPS or stats["used"] < MIN_OVERLAP_FRACTION * stats["kit_snps"]:
+        raise ValueError(f"تطابق ضعيف مع الـ panel: {stats['used']} SNP ({stats['overlap_pct']}%) – "
+                         f"الحد الأدنى {MIN_OVERLAP_SNPS} SNP و {MIN_OVERLAP_FRACTION:.0%}")
+
+
+def overlap_rows(kits):
+    """صفوف الـ panel اللي ليها call متطابق عند kit واحد على الأقل (kits = [(panel_idx, dosage)])."""
+    return np.unique(np.concatenate([idx[~np.isnan(g)] for idx, g in kits]))
+
+
+def write_overlap_bim(ref_prefix, kits, out_prefix):
+    """.bim الـ merge لوحده (نفس صفوف merge_with_panel) من غير .bed – كفاية لـ intersect_prune
+    لما الـ PCA والـ ADMIXTURE بيشتغلوا على مكونات الـ panel ومحدش محتاج الـ genotypes المدموجة."""
+    bim_lines = open(f"{ref_prefix}.bim", 'rb').readlines()
+    rows = overlap_rows(kits)
+    with open(f"{out_prefix}.bim", 'wb') as bim:
+        bim.writelines(bim_lines[r] for r in rows)
+    return len(rows)
+
+
+def merge_with_panel(ref_prefix, kits, ids, out_prefix, block_snps=8192):
+    """الـ ref_panel على SNPs تقاطعه مع الـ kits بس + عمود لكل kit (kits = [(panel_idx, dosage)] من harmonize_kit).
+
+    bytes صفوف الـ ref بتتنسخ من memmap زي ما هي؛ بس آخر byte (لو عدد الـ samples مش مضاعف 4) بيتعاد pack
+    مع أكواد الـ kits. الأليلات نفس الـ panel فمفيش merge ممكن يفشل."""
+    rows = overlap_rows(kits)
+    dosage = np.full((len(rows), len(kits)), np.nan, dtype=np.float32)
+    for col, (idx, g) in enumerate(kits):
+        called = ~np.isnan(g)
+        dosage[np.searchsorted(rows, idx[called]), col] = g[called]
+    codes = genotype_io.dosage_codes(dosage)
+
+    fam_lines = [line for line in open(f"{ref_prefix}.fam") if line.strip()]
+    bim_lines = open(f"{ref_prefix}.bim", 'rb').readlines()
+    n_ref = len(fam_lines)
+    full, rest = divmod(n_ref, 4)
+    ref_bed = np.memmap(f"{ref_prefix}.bed", dtype=np.uint8, mode='r', offset=len(genotype_io.BED_MAGIC),
+                        shape=(len(bim_lines), (n_ref + 3) // 4))
+    with open(f"{out_prefix}.bed", 'wb') as bed:
+        bed.write(genotype_io.BED_MAGIC)
+        for start in range(0, len(rows), block_snps):
+            chunk = ref_bed[rows[start:start + block_snps]]
+            tail = codes[start:start + block_snps]
+            if rest:
+                tail = np.hstack([(chunk[:, full, None] >> (2 * np.arange(rest))) & 3, tail])
+            packed = np.frombuffer(genotype_io.pack_bed_codes(tail), dtype=np.uint8).reshape(len(chunk), -1)
+            bed.write(np.hstack([chunk[:, :full], packed]).tobytes())
+    del ref_bed
+    with open(f"{out_prefix}.bim", 'wb') as bim:
+        bim.writelines(bim_lines[r] for r in rows)
+    with open(f"{out_prefix}.fam", 'w') as fam:
+        fam.writelines(fam_lines)
+        fam.write("".join(f"{fid}\t{iid}\t0\t0\t0\t-9\n" for fid, iid in ids))
+    return out_prefix
+
+
+def project_kit(pca, kit_bfile):
+    panel_idx, g = match_kit(pca, kit_bfile)
+    p = pca["freq"][panel_idx]
+    scale = np.sqrt(2 * p * (1 - p))
+    used = ~np.isnan(g) & (scale > 0)
+    x = (g[used] - 2 * p[used]) / scale[used]
+    if not used.any():
+        raise ValueError("مفيش SNPs مشتركة مع الـ panel للـ projection")
+
+    # SNPs ناقصة عند الـ kit → نعوّض بنسبة المستخدم من الـ panel
+    pcs = x @ pca["loadings"][panel_idx[used]].astype(np.float64) * (len(pca["key"]) / used.sum())
+    return pcs, int(used.sum())
+
+
+def align_kit(pca, kit_bfile, ref_prefix, out_prefix, kit_id):
+    """الـ kit على SNPs الـ panel المختارة بنفس الترتيب والأليلات (ADMIXTURE -P محتاج كده)."""
+    panel_idx, g = match_kit(pca, kit_bfile)
+    dosage = np.full(len(pca["key"]), np.nan)
+    dosage[panel_idx] = g
+    pruned = panel_dir(ref_prefix, pca["version"]) / "ref_pruned"
+    genotype_io.write_dosage_bfile(out_prefix, dosage, pruned, kit_id, kit_id)
+    return int(np.count_nonzero(~np.isnan(dosage)))
+
+
+def align_cohort(pca, kit_bfiles, ref_prefix, out_prefix, ids):
+    """زي align_kit لكذا kit في ملف وحد (ADMIXTURE -P مرة للدفعة)؛ ids = [(fid, iid)] بنفس ترتيب kit_bfiles."""
+    dosage = np.full((len(pca["key"]), len(kit_bfiles)), np.nan, dtype=np.float32)
+    for col, kit_bfile in enumerate(kit_bfiles):
+        panel_idx, g = match_kit(pca, kit_bfile)
+        dosage[panel_idx, col] = g
+    pruned = panel_dir(ref_prefix, pca["version"]) / "ref_pruned"
+    genotype_io.write_cohort_dosage_bfile(out_prefix, dosage, pruned, ids)
+    return out_prefix
+
+
+def write_projection(out_prefix, fid, iid, pcs, eigenval):
+    # نفس صيغة plink2 --pca عشان app.results و app.dashboard
+    with open(f"{out_prefix}.eigenvec", 'w') as f:
+        f.write("#FID\tIID\t" + "\t".join(f"PC{i + 1}" for i in range(len(pcs))) + "\n")
+        f.write(f"{fid}\t{iid}\t" + "\t".join(f"{v:.6g}" for v in pcs) + "\n")
+    with open(f"{out_prefix}.eigenval", 'w') as f:
+        f.write("".join(f"{v:.6g}\n" for v in eigenval))
+
+
+# ---------------------------------------------------------------- populations
+
+def build_populations(out_dir, n_pcs=N_PCS):
+    """مصفوفة المراجع للـ population_engine: متوسط كل population (FID في الـ .fam) ثم كل sample،
+    بإحداثيات scaled (PC × √eigenval) زي G25 – نفس فضاء الـ projection بتاع الـ kits."""
+    out_dir = Path(out_dir)
+    fam_ids = genotype_io.read_fam_ids(out_dir / "ref_pruned")
+    eigenvec = read_eigenvec(out_dir / "pca.eigenvec", fam_ids, n_pcs)
+    eigenval = np.loadtxt(out_dir / "pca.eigenval", ndmin=1)[:n_pcs]
+    scaled = eigenvec * np.sqrt(np.clip(eigenval, 0, None))
+
+    labels = np.array([fid for fid, _ in fam_ids])
+    pops, inverse, sizes = np.unique(labels, return_inverse=True, return_counts=True)
+    means = np.zeros((len(pops), scaled.shape[1]))
+    np.add.at(means, inverse, scaled)
+    means /= sizes[:, None]
+
+    np.save(out_dir / "populations.npy", np.vstack([means, scaled]).astype(np.float32))
+    names = {"populations": pops.tolist(), "sizes": sizes.tolist(), "samples": [iid for _, iid in fam_ids],
+             "sample_population": labels.tolist()}
+    (out_dir / "populations.json").write_text(json.dumps(names, ensure_ascii=False))
+    log(f"مصفوفة المراجع: {len(pops)} population + {len(fam_ids)} sample")
+    return {"n_populations": len(pops), "n_samples": len(fam_ids), "n_pcs": int(scaled.shape[1]),
+            "files": ["populations.npy", "populations.json"]}
+
+
+# ---------------------------------------------------------------- f2 blocks (qpAdm)
+
+def jackknife_blocks(key, block_bp=F2_BLOCK_BP):
+    """رقم block لكل SNP: block جديد مع كل كروموسوم وكل block_bp؛ -1 للـ SNPs من غير موقع."""
+    valid = key > 0
+    label = (key >> 40) * (1 << 24) + (key & ((1 << 40) - 1)) // block_bp
+    block = np.full(len(key), -1, dtype=np.int32)
+    block[valid] = np.unique(label[valid], return_inverse=True)[1]
+    return block
+
+
+def block_f2(p, n):
+    """f2 لكل زوج populations (صفوف p) على SNPs الـ block: متوسط (pa−pb)² − ha − hb على الـ SNPs الموجودة
+    عند الاتنين، h = p(1−p)/(n−1) تصحيح حجم العينة (n = عدد الـ haplotypes) → (f2, عدد الـ SNPs)."""
+    present = ~np.isnan(p)
+    p = np.where(present, p, 0).astype(np.float64)
+    h = np.where(present, p * (1 - p) / np.maximum(n.astype(np.float64) - 1, 1), 0)
+    m = present.astype(np.float64)
+    u = p * p - h
+    # Σ mₐm_b((pa−pb)² − ha − hb) = uₐ·m_b + mₐ·u_b − 2 pₐ·p_b
+    num = u @ m.T + m @ u.T - 2 * p @ p.T
+    counts = m @ m.T
+    return np.divide(num, counts, out=np.full_like(num, np.nan), where=counts > 0), counts
+
+
+def build_f2(ref_prefix, out_dir, block_bp=F2_BLOCK_BP):
+    """تكرار A1 لكل population (FID في الـ .fam) على كل SNPs الـ ref_panel + f2 لكل زوج populations في كل
+    jackknife block. qpadm_sweep بيحسب f2 الـ kit بس ضد populations الموديلات ويبني عليهم."""
+    out_dir = Path(out_dir)
+    fam_ids = genotype_io.read_fam_ids(ref_prefix)
+    bim = genotype_io.read_bim(ref_prefix)
+    labels = np.array([fid for fid, _ in fam_ids])
+    pops, inverse, sizes = np.unique(labels, return_inverse=True, return_counts=True)
+    members = np.argsort(inverse, kind='stable')
+    starts = np.searchsorted(inverse[members], np.arange(len(pops)))
+    n_pops, n_snps = len(pops), len(bim.key)
+
+    log(f"تكرار الأليلات لـ {n_pops} population على {n_snps} SNP")
+    # population × SNP: صف الـ population متصل على القرص فالـ kit بيقرا بس صفوف populations الموديلات
+    freq = np.lib.format.open_memmap(out_dir / "f2_freq.npy", mode='w+', dtype=np.float32, shape=(n_pops, n_snps))
+    counts = np.lib.format.open_memmap(out_dir / "f2_counts.npy", mode='w+', dtype=np.uint16, shape=(n_pops, n_snps))
+    start = 0
+    for dosage in genotype_io.iter_bed_dosages(ref_prefix, len(fam_ids)):
+        end = start + len(dosage)
+        dosage = dosage[:, members]
+        alleles = np.add.reduceat(np.nan_to_num(dosage), starts, axis=1, dtype=np.float64)
+        haplotypes = 2 * np.add.reduceat(~np.isnan(dosage), starts, axis=1, dtype=np.int64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            freq[:, start:end] = (alleles / haplotypes).T
+        counts[:, start:end] = np.minimum(haplotypes, np.iinfo(np.uint16).max).T
+        start = end
+
+    block = jackknife_blocks(bim.key, block_bp)
+    n_blocks = int(block.max()) + 1
+    log(f"f2 لكل زوج populations في {n_blocks} jackknife block")
+    f2 = np.lib.format.open_memmap(out_dir / "f2_blocks.npy", mode='w+', dtype=np.float32,
+                                   shape=(n_blocks, n_pops, n_pops))
+    in_order = np.argsort(block, kind='stable')
+    bounds = np.searchsorted(block[in_order], np.arange(n_blocks + 1))
+    for b in range(n_blocks):
+        idx = in_order[bounds[b]:bounds[b + 1]]
+        f2[b] = block_f2(freq[:, idx], counts[:, idx])[0]
+    freq.flush(), counts.flush(), f2.flush()
+
+    np.savez(out_dir / "f2_snps.npz", key=bim.key, a1=bim.a1, a2=bim.a2, block=block)
+    meta = {"populations": pops.tolist(), "sizes": sizes.tolist(), "block_sizes": np.diff(bounds).tolist()}
+    (out_dir / "f2_populations.json").write_text(json.dumps(meta, ensure_ascii=False))
+    return {"n_populations": n_pops, "n_snps": n_snps, "n_blocks": n_blocks, "block_bp": block_bp,
+            "files": ["f2_freq.npy", "f2_counts.npy", "f2_blocks.npy", "f2_snps.npz", "f2_populations.json"]}
+
+
+# ---------------------------------------------------------------- EIGENSTRAT (qpAdm binary)
+
+EIGEN_MISSING = ord('9')
+
+
+def eigenstrat_dir(ref_prefix, populations, version=None):
+    # الـ cache لكل (panel version, populations الموديلات): تغيير الـ pool = نسخة تانية
+    digest = hashlib.sha256("\n".join(sorted(populations)).encode()).hexdigest()[:8]
+    return panel_dir(ref_prefix, version) / f"eigenstrat_{digest}"
+
+
+def build_eigenstrat(ref_prefix, out_dir, populations):
+    """أفراد populations الموديلات بس من الـ ref_panel → ref.geno/.snp/.ind (EIGENSTRAT، سطر ثابت الطول لكل SNP)
+    + snps.npz للـ matching. qpAdm مابيقراش غير الـ populations اللي في الـ par، فالباقي مالوش لازمة."""
+    out_dir = Path(out_dir)
+    fam_ids = genotype_io.read_fam_ids(ref_prefix)
+    wanted = set(populations)
+    columns = np.array([i for i, (fid, _) in enumerate(fam_ids) if fid in wanted], dtype=np.int64)
+    with open(out_dir / "ref.ind", "w") as ind:
+        ind.write("".join(f"{fam_ids[i][1]}\tU\t{fam_ids[i][0]}\n" for i in columns))
+    with open(f"{ref_prefix}.bim") as bim, open(out_dir / "ref.snp", "w") as snp:
+        for line in bim:
+            chrom, rsid, cm, pos, a1, a2 = line.split()
+            snp.write(f"{rsid}\t{chrom}\t{cm}\t{pos}\t{a1}\t{a2}\n")
+
+    # قيمة الـ .geno = عدد نسخ الأليل الأول في الـ .snp (A1) زي convertf، و 9 = missing
+    with open(out_dir / "ref.geno", "wb") as geno:
+        for dosage in genotype_io.iter_bed_dosages(ref_prefix, len(fam_ids)):
+            rows = np.full((len(dosage), len(columns) + 1), ord('\n'), dtype=np.uint8)
+            sub = dosage[:, columns]
+            rows[:, :-1] = np.where(np.isnan(sub), EIGEN_MISSING, np.nan_to_num(sub) + ord('0'))
+            geno.write(rows.tobytes())
+    bim = genotype_io.read_bim(ref_prefix)
+    np.savez(out_dir / "snps.npz", key=bim.key, a1=bim.a1, a2=bim.a2)
+    (out_dir / "eigenstrat.json").write_text(json.dumps(
+        {"populations": sorted(wanted), "n_samples": int(len(columns)), "n_snps": int(len(bim.key))}))
+    log(f"EIGENSTRAT الـ panel: {len(columns)} فرد من {len(wanted)} population على {len(bim.key)} SNP")
+    return out_dir
+
+
+def load_eigenstrat(ref_prefix, populations):
+    """EIGENSTRAT الـ panel لـ populations دي (بيتبني أول مرة بس) أو None لو مفيش ref_panel."""
+    if not Path(f"{ref_prefix}.bed").exists():
+        return None
+    out_dir = eigenstrat_dir(ref_prefix, populations)
+    key = str(out_dir)
+    if key not in _loaded:
+        _build_once(out_dir, "eigenstrat.json", lambda tmp: build_eigenstrat(ref_prefix, tmp, populations))
+        meta = json.loads((out_dir / "eigenstrat.json").read_text())
+        with np.load(out_dir / "snps.npz") as data:
+            eigen = {name: data[name] for name in data.files}
+        order = np.argsort(eigen["key"], kind='stable')
+        eigen.update(order=order, sorted_key=eigen["key"][order], dir=out_dir, **meta)
+        _loaded[key] = eigen
+    return _loaded[key]
+
+
+def write_eigenstrat_overlay(eigen, kit_bfiles, ids, out_prefix, block_snps=65536):
+    """الـ panel + أعمدة الـ kits: .snp symlink للـ cache، .ind = الـ panel + سطر لكل kit، و .geno
+    بنسخ أسطر الـ cache (memmap، طول ثابت) وإضافة عمود كل kit – من غير convertf على الـ merge كله."""
+    ref_dir, n_ref, n_snps = eigen["dir"], eigen["n_samples"], eigen["n_snps"]
+    snp_path = Path(f"{out_prefix}.snp")
+    if snp_path.exists() or snp_path.is_symlink():
+        snp_path.unlink()
+    try:
+        os.symlink(ref_dir / "ref.snp", snp_path)
+    except OSError:
+        shutil.copyfile(ref_dir / "ref.snp", snp_path)
+    with open(f"{out_prefix}.ind", "w") as ind:
+        ind.write((ref_dir / "ref.ind").read_text())
+        ind.write("".join(f"{iid}\tU\t{iid}\n" for _, iid in ids))
+
+    kits = np.full((n_snps, len(kit_bfiles)), EIGEN_MISSING, dtype=np.uint8)
+    for col, kit_bfile in enumerate(kit_bfiles):
+        panel_idx, g = match_kit(eigen, kit_bfile)
+        called = ~np.isnan(g)
+        kits[panel_idx[called], col] = g[called].astype(np.uint8) + ord('0')
+
+    ref = np.memmap(ref_dir / "ref.geno", dtype=np.uint8, mode='r', shape=(n_snps, n_ref + 1))
+    width = n_ref + len(kit_bfiles) + 1
+    with open(f"{out_prefix}.geno", "wb") as geno:
+        for start in range(0, n_snps, block_snps):
+            end = min(start + block_snps, n_snps)
+            rows = np.empty((end - start, width), dtype=np.uint8)
+            rows[:, :n_ref] = ref[start:end, :n_ref]
+            rows[:, n_ref:-1] = kits[start:end]
+            rows[:, -1] = ord('\n')
+            geno.write(rows.tobytes())
+    del ref
+    return [f"{out_prefix}.{ext}" for ext in ("geno", "snp", "ind")]
+
+
+# ---------------------------------------------------------------- ADMIXTURE
+
+def build_admixture(out_dir, ks=admixture_runner.ADMIXTURE_KS, threads=None):
+    log(f"ADMIXTURE على الـ panel لـ K={ks} (مرة وحدة)")
+    out_dir = Path(out_dir)
+    outputs = admixture_runner.run_admixture_jobs(str(out_dir / "ref_pruned"), ks, out_dir / "admixture_work",
+                                                  budget=threads)
+    files = []
+    for k, (q_file, p_file) in outputs.items():
+        for src, ext in ((p_file, "P"), (q_file, "Q")):
+            shutil.move(str(src), str(out_dir / f"admixture.K{k}.{ext}"))
+            files.append(f"admixture.K{k}.{ext}")
+    shutil.rmtree(out_dir / "admixture_work", ignore_errors=True)
+    return {"ks": list(ks), "files": files}
+
+
+def admixture_p_files(ref_prefix):
+    """{K: مسار .P} للـ panel الحالي، أو {} لو مش متبني."""
+    manifest = load_manifest(ref_prefix)
+    if not manifest or "admixture" not in manifest["components"]:
+        return {}
+    out_dir = panel_dir(ref_prefix, manifest["version"])
+    return {k: str(out_dir / f"admixture.K{k}.P") for k in manifest["components"]["admixture"]["ks"]}
+
+
+# ---------------------------------------------------------------- build
+
+def build_panel(ref_prefix, threads=None):
+    version = panel_version(ref_prefix)
+    out_dir = panel_dir(ref_prefix, version)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    log(f"Panel build: {ref_prefix} (version {version[:12]})")
+
+    manifest = {"version": version, "ref_prefix": str(ref_prefix), "built_at": datetime.utcnow().isoformat(),
+                "components": {}}
+    manifest["components"]["prune"] = build_prune(ref_prefix, out_dir, threads=threads)
+    manifest["components"]["pca"] = build_pca(ref_prefix, out_dir, threads=threads)
+    manifest["components"]["populations"] = build_populations(out_dir)
+    manifest["components"]["admixture"] = build_admixture(out_dir, threads=threads)
+    manifest["components"]["f2"] = build_f2(ref_prefix, out_dir)
+    _save_manifest(out_dir, manifest)
+    log(f"★ الـ panel جاهز: {out_dir}")
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DeepAncestry reference panel build")
+    parser.add_argument("command", choices=["build", "populations", "f2", "prune", "version"])
+    parser.add_argument("--ref", default=default_ref_prefix(), help="prefix الـ ref_panel (بدون .bed)")
+    parser.add_argument("--threads", type=int)
+    args = parser.parse_args()
+    if args.command == "build":
+        build_panel(args.ref, threads=args.threads)
+    elif args.command == "populations":
+        # panel متبني قبل مصفوفة المراجع – نضيفها من غير إعادة PCA/ADMIXTURE
+        manifest = load_manifest(args.ref)
+        if not manifest or "pca" not in manifest["components"]:
+            raise SystemExit("الـ panel مش متبني – شغّل build الأول")
+        out_dir = panel_dir(args.ref, manifest["version"])
+        manifest["components"]["populations"] = build_populations(out_dir, manifest["components"]["pca"]["n_pcs"])
+        _save_manifest(out_dir, manifest)
+    elif args.command == "prune":
+        # prune.in + جداول QC لـ panel متبني قبلهم (أو بعد تغيير PRUNE_ARGS)
+        manifest = load_manifest(args.ref)
+        if not manifest:
+            raise SystemExit("الـ panel مش متبني – شغّل build الأول")
+        out_dir = panel_dir(args.ref, manifest["version"])
+        manifest["components"]["prune"] = build_prune(args.ref, out_dir, threads=args.threads)
+        _save_manifest(out_dir, manifest)
+    elif args.command == "f2":
+        # نفس الفكرة لـ f2 blocks الـ qpAdm
+        manifest = load_manifest(args.ref)
+        if not manifest:
+            raise SystemExit("الـ panel مش متبني – شغّل build الأول")
+        out_dir = panel_dir(args.ref, manifest["version"])
+        manifest["components"]["f2"] = build_f2(args.ref, out_dir)
+        _save_manifest(out_dir, manifest)
+    else:
+        print(panel_version(args.ref))
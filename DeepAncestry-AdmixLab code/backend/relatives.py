@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+relatives.py – مخزن genotypes كل الـ kits المكتملة على SNPs الـ panel + مطابقة أقارب بـ XOR/popcount
+
+المخزن append-only لكل panel version: صف لكل kit فيه plane-ين bits (lo و hi) بترتيب SNPs الـ panel
+(2 bit لكل SNP: 0 = 00، 1 = 10، 2 = 11، missing = 01)، في ملف واحد memmapped بكلمات uint64. kit جديد بيتضاف
+في آخر الملف تحت flock، والمطابقة بتقرا الملف كله chunks على threads (عمليات NumPy بتسيب الـ GIL):
+IBS0 و het/het و IBS1 = popcount على AND/XOR الكلمات، ومنهم kinship KING-robust لكل kit في المخزن.
+الأزواج اللي فوق MIN_KINSHIP بتتكتب في matches.jsonl (للطرفين)، والـ kit اللي بيتمسح (الـ reaper) صفه بيتصفّر.
+"""
+
+import fcntl
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+import reference_panel
+
+STORE_DIR = Path(os.getenv('GENOTYPE_STORE_DIR') or Path(__file__).resolve().parent.parent / "genotype_store")
+STORE_VERSION = 1
+# ~64 kit في الـ chunk: temporaries الـ bit ops على panel 1M SNP حوالي 100 MB لكل thread
+CHUNK_KITS = 64
+# KING: > 0.354 نفس الشخص/توأم، 0.177 درجة أولى، 0.0884 تانية، 0.0442 تالتة
+DEGREES = ((0.354, 0, "نفس الشخص / توأم متطابق"), (0.177, 1, "درجة أولى (أب/أم، أخ/أخت)"),
+           (0.0884, 2, "درجة ثانية (جد، عم/خال، نصف أخ)"), (0.0442, 3, "درجة ثالثة (ابن عم/خال)"))
+MIN_KINSHIP = float(os.getenv('RELATIVES_MIN_KINSHIP', 0.0442))
+MIN_SHARED_SNPS = int(os.getenv('RELATIVES_MIN_SHARED_SNPS', 20_000))
+
+_indexes = {}
+
+
+def store_dir(panel_version):
+    return STORE_DIR / panel_version[:12]
+
+
+@contextmanager
+def _locked(out_dir, mode=fcntl.LOCK_EX):
+    # LOCK_EX للكتابة (append / تصفير صفوف)، LOCK_SH للقراية – المطابقات بتقرا مع بعض والكتابة تستناهم
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with open(out_dir / "store.lock", 'a') as lock:
+        fcntl.flock(lock, mode)
+        yield
+
+
+def _read_jsonl(path):
+    if not path.exists():
+        return []
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _append_jsonl(path, records):
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+
+
+def _ensure_snp_index(out_dir, ref_prefix):
+    """keys SNPs الـ panel بترتيب الـ .bim = ترتيب الـ bits في كل صف؛ بيتحفظ مع المخزن عشان يفضل صالح لوحده."""
+    path = out_dir / "snp_key.npy"
+    if not path.exists():
+        tmp = out_dir / "snp_key.tmp.npy"
+        np.save(tmp, np.asarray(reference_panel.load_snp_index(ref_prefix)["key"]))
+        os.replace(tmp, path)
+    return np.load(path, mmap_mode='r')
+
+
+def words_per_plane(n_snps):
+    return (n_snps + 63) // 64
+
+
+def pack_planes(g, n_snps):
+    """عدد نسخ A1 على كل SNPs الـ panel (NaN = missing) → (2, words) uint64؛ الـ bits الزيادة في الآخر missing."""
+    n_bits = words_per_plane(n_snps) * 64
+    lo = np.zeros(n_bits, dtype=bool)
+    hi = np.ones(n_bits, dtype=bool)
+    called = ~np.isnan(g)
+    lo[:n_snps] = called & (g >= 1)
+    hi[:n_snps] = ~called | (g == 2)
+    planes = np.stack([np.packbits(lo, bitorder='little'), np.packbits(hi, bitorder='little')])
+    return planes.view(np.uint64)
+
+
+def kit_planes(ref_prefix, kit_bfile):
+    """الـ kit بعد الـ harmonization على فهرس الـ panel → planes بترتيب SNPs الـ panel."""
+    index = reference_panel.load_snp_index(ref_prefix)
+    panel_idx, g, _ = reference_panel.harmonize_kit(index, kit_bfile)
+    full = np.full(len(index["key"]), np.nan, dtype=np.float32)
+    full[panel_idx] = g
+    return pack_planes(full, len(full)), int(np.count_nonzero(~np.isnan(g)))
+
+
+def _genotypes(out_dir, n_kits, n_words, mode='r'):
+    if not n_kits:
+        return np.zeros((0, 2, n_words), dtype=np.uint64)
+    return np.memmap(out_dir / "genotypes.bin", dtype=np.uint64, mode=mode, shape=(n_kits, 2, n_words))
+
+
+def append_kit(panel_version, ref_prefix, kit_id, planes, n_called):
+    """صف الـ kit في آخر المخزن (مرة وحدة لكل kit_id) → رقم الصف."""
+    out_dir = store_dir(panel_version)
+    with _locked(out_dir):
+        _ensure_snp_index(out_dir, ref_prefix)
+        kits = _read_jsonl(out_dir / "kits.jsonl")
+        for row, entry in enumerate(kits):
+            if entry["kit_id"] == kit_id:
+                return row
+        # kits.jsonl هو المرجع لعدد الصفوف: صف اتكتب وماتسجلش (crash) بيتكتب فوقه
+        row_bytes = planes.nbytes
+        with open(out_dir / "genotypes.bin", 'ab') as f:
+            f.truncate(len(kits) * row_bytes)
+            f.write(planes.tobytes())
+        _append_jsonl(out_dir / "kits.jsonl", [{"kit_id": kit_id, "snps": n_called,
+                                                "added_at": datetime.utcnow().isoformat(timespec="seconds")}])
+        return len(kits)
+
+
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount(words, axis=-1):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).sum(axis=axis, dtype=np.int64)
+    # NumPy < 2: جدول لكل byte
+    return _POPCOUNT8[words.view(np.uint8)].sum(axis=axis, dtype=np.int64)
+
+
+def kinship_chunk(query, rows):
+    """kit واحد (2, words) ضد chunk من المخزن (n, 2, words) → عدادات + kinship KING-robust و IBS لكل صف."""
+    q_lo, q_hi = query
+    lo, hi = rows[:, 0], rows[:, 1]
+    q_called, called = q_lo | ~q_hi, lo | ~hi
+    valid = q_called & called
+    q_het, het = q_lo & ~q_hi, lo & ~hi
+    # هوموزيجوت في الاتنين (lo == hi) بأليلات عكس بعض (lo مختلف) = IBS0
+    ibs0 = popcount(~(q_lo ^ q_hi) & ~(lo ^ hi) & (q_lo ^ lo) & valid)
+    ibs1 = popcount((q_het ^ het) & valid)
+    het_het = popcount(q_het & het)
+    q_het_n, het_n = popcount(q_het & called), popcount(het & q_called)
+    n = popcount(valid)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        kinship = (het_het - 2 * ibs0) / (q_het_n + het_n)
+        ibs = (2 * (n - ibs0 - ibs1) + ibs1) / (2 * n)
+    return {"n": n, "ibs0": ibs0, "kinship": kinship, "ibs": ibs}
+
+
+def degree(kinship):
+    for bound, level, label in DEGREES:
+        if kinship > bound:
+            return level, label
+    return None, "غير مرتبط"
+
+
+def match_kit(panel_version, kit_id, planes, workers=None):
+    """الـ kit ضد كل المخزن (chunks على workers threads) → أقاربه مرتبين بالـ kinship، ومتسجلين في matches.jsonl."""
+    out_dir = store_dir(panel_version)
+
+    def run(start):
+        return kinship_chunk(planes, np.asarray(genotypes[start:start + CHUNK_KITS]))
+
+    # LOCK_SH طول القراية: append_kit / remove_kits مايقدروش يغيروا kits.jsonl أو صف في genotypes.bin في النص،
+    # فصف kits.jsonl رقم i هو نفس الصف i كامل في الـ memmap
+    with _locked(out_dir, fcntl.LOCK_SH):
+        kits = _read_jsonl(out_dir / "kits.jsonl")
+        removed = {entry["kit_id"] for entry in _read_jsonl(out_dir / "removed.jsonl")}
+        genotypes = _genotypes(out_dir, len(kits), planes.shape[1])
+        bounds = range(0, len(kits), CHUNK_KITS)
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 4) as pool:
+            chunks = list(pool.map(run, bounds))
+        del genotypes
+
+    matches = []
+    for start, result in zip(bounds, chunks):
+        for i in np.flatnonzero((result["kinship"] >= MIN_KINSHIP) & (result["n"] >= MIN_SHARED_SNPS)):
+            other = kits[start + i]["kit_id"]
+            if other == kit_id or other in removed:
+                continue
+            kinship = float(result["kinship"][i])
+            matches.append({"kits": sorted([kit_id, other]), "kinship": round(kinship, 4),
+                            "ibs": round(float(result["ibs"][i]), 4), "ibs0": int(result["ibs0"][i]),
+                            "snps": int(result["n"][i]), "degree": degree(kinship)[0]})
+    matches.sort(key=lambda m: -m["kinship"])
+    if matches:
+        with _locked(out_dir):
+            _append_jsonl(out_dir / "matches.jsonl", matches)
+    return {"compared": len(kits) - 1, "matches": matches}
+
+
+def _match_index(out_dir):
+    """{kit_id: {kit_تاني: match}} من matches.jsonl – بيقرا بس اللي اتضاف من آخر مرة (cache لكل worker)."""
+    key = str(out_dir)
+    state = _indexes.setdefault(key, {"offset": 0, "pairs": {}})
+    path = out_dir / "matches.jsonl"
+    try:
+        size = path.stat().st_size
+    except FileNotFoundError:
+        return state["pairs"]
+    if size < state["offset"]:
+        state.update(offset=0, pairs={})
+    if size > state["offset"]:
+        with open(path, 'rb') as f:
+            f.seek(state["offset"])
+            data = f.read(size - state["offset"])
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].decode('utf-8').splitlines():
+            match = json.loads(line)
+            a, b = match["kits"]
+            state["pairs"].setdefault(a, {})[b] = match
+            state["pairs"].setdefault(b, {})[a] = match
+        state["offset"] += end
+    return state["pairs"]
+
+
+def load_relatives(panel_version, kit_id):
+    """أقارب الـ kit (كل الأزواج اللي هو فيها، حتى اللي اتضافت بعده) مرتبين بالـ kinship."""
+    if not panel_version:
+        return []
+    out_dir = store_dir(panel_version)
+    if not out_dir.exists():
+        return []
+    with _locked(out_dir, fcntl.LOCK_SH):
+        removed = {entry["kit_id"] for entry in _read_jsonl(out_dir / "removed.jsonl")}
+    relatives = []
+    for other, match in _match_index(out_dir).get(kit_id, {}).items():
+        if other in removed:
+            continue
+        level, label = degree(match["kinship"])
+        relatives.append({"kit_id": other, "kinship": match["kinship"], "ibs": match["ibs"], "ibs0": match["ibs0"],
+                          "snps": match["snps"], "degree": level, "relationship": label})
+    return sorted(relatives, key=lambda r: -r["kinship"])
+
+
+def remove_kits(kit_ids):
+    """kits اتمسحت (الـ reaper): صفوفها بتتصفّر (كلها missing) في كل panel version ويتسجل tombstone."""
+    wanted = set(kit_ids)
+    if not wanted or not STORE_DIR.exists():
+        return 0
+    removed = 0
+    for out_dir in (d for d in STORE_DIR.iterdir() if (d / "kits.jsonl").exists()):
+        with _locked(out_dir):
+            kits = _read_jsonl(out_dir / "kits.jsonl")
+            rows = [row for row, entry in enumerate(kits) if entry["kit_id"] in wanted]
+            if not rows:
+                continue
+            n_words = words_per_plane(len(np.load(out_dir / "snp_key.npy", mmap_mode='r')))
+            genotypes = _genotypes(out_dir, len(kits), n_words, mode='r+')
+            genotypes[rows, 0] = 0
+            genotypes[rows, 1] = np.iinfo(np.uint64).max
+            genotypes.flush()
+            del genotypes
+            _append_jsonl(out_dir / "removed.jsonl", [{"kit_id": kits[row]["kit_id"]} for row in rows])
+            removed += len(rows)
+    return removed
+
+
+def add_and_match(ref_prefix, panel_version, kit_id, kit_bfile, workers=None):
+    """stage الـ relatives: الـ kit في المخزن + مطابقته مع كل اللي فيه."""
+    planes, n_called = kit_planes(ref_prefix, kit_bfile)
+    append_kit(panel_version, ref_prefix, kit_id, planes, n_called)
+    return match_kit(panel_version, kit_id, planes, workers=workers)
+
+
+def read_kit_ids(panel_version):
+    out_dir = store_dir(panel_version)
+    if not out_dir.exists():
+        return []
+    with _locked(out_dir, fcntl.LOCK_SH):
+        return [entry["kit_id"] for entry in _read_jsonl(out_dir / "kits.jsonl")]
+
+
+def kit_genotypes(panel_version, kit_id):
+    """صف kit من المخزن → عدد نسخ A1 على SNPs الـ panel (NaN = missing)؛ للمراجعة والـ debugging."""
+    out_dir = store_dir(panel_version)
+    with _locked(out_dir, fcntl.LOCK_SH):
+        kits = [entry["kit_id"] for entry in _read_jsonl(out_dir / "kits.jsonl")]
+        n_snps = len(np.load(out_dir / "snp_key.npy", mmap_mode='r'))
+        planes = np.array(_genotypes(out_dir, len(kits), words_per_plane(n_snps))[kits.index(kit_id)])
+    lo, hi = (np.unpackbits(plane.view(np.uint8), bitorder='little')[:n_snps].astype(bool) for plane in planes)
+    g = lo.astype(np.float32) + (lo & hi)
+    g[~lo & hi] = np.nan
+    return g
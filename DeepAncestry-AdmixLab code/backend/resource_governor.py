@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+resource_governor.py – ميزانية cores/RAM للـ node كله مشتركة بين كل الـ workers والـ subprocesses بتاعتهم
+
+كل stage بيطلب (أقل cores، أكتر cores، RAM بالـ MB) قبل ما يبدأ؛ الـ governor بيمنحه اللي فاضي فعلاً
+(--threads لـ plink2، -j لـ ADMIXTURE، workers الـ qpAdm sweep) ولو الـ node مليان الـ stage بيستنى في طابور.
+الحالة في ملف JSON واحد تحت GOVERNOR_DIR محمي بـ flock، فكل processes الـ Celery على نفس الجهاز شايفين
+نفس الـ pool؛ الحجوزات بتاعة process مات بتتشال أول ما أي حد يلمس الملف.
+"""
+
+import argparse
+import fcntl
+import json
+import os
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+GOVERNOR_DIR = Path(os.getenv('GOVERNOR_DIR') or Path(tempfile.gettempdir()) / "deepancestry_governor")
+GOVERNOR_ENABLED = os.getenv('GOVERNOR_ENABLED', '1') != '0'
+POLL_SECONDS = float(os.getenv('GOVERNOR_POLL_SECONDS', 1.0))
+# نسيب جزء من الـ RAM للـ OS والـ page cache (الـ panel memmapped)
+MEMORY_FRACTION = 0.8
+STATE_NAME = "allocations.json"
+LOCK_NAME = "allocations.lock"
+
+
+def node_cores():
+    return int(os.getenv('GOVERNOR_CORES', 0)) or os.cpu_count() or 4
+
+
+def node_memory_mb():
+    configured = int(os.getenv('GOVERNOR_MEMORY_MB', 0))
+    if configured:
+        return configured
+    total = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // (1024 * 1024)
+    return int(total * MEMORY_FRACTION)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@contextmanager
+def _locked_state():
+    """الحالة تحت flock؛ أي تعديل على الـ dict بيتكتب لما الـ with يخلص."""
+    GOVERNOR_DIR.mkdir(parents=True, exist_ok=True)
+    with open(GOVERNOR_DIR / LOCK_NAME, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        path = GOVERNOR_DIR / STATE_NAME
+        try:
+            state = json.loads(path.read_text(encoding='utf-8'))
+        except (FileNotFoundError, ValueError):
+            state = {"allocations": [], "waiting": []}
+        # حجوزات processes ماتت (worker اتقتل في نص stage) مابتفضلش ماسكة cores
+        for key in ("allocations", "waiting"):
+            state[key] = [entry for entry in state[key] if _alive(entry["pid"])]
+        yield state
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(state, ensure_ascii=False), encoding='utf-8')
+        os.replace(tmp, path)
+
+
+def _try_grant(state, request, cores, memory_mb):
+    used_cores = sum(a["cores"] for a in state["allocations"])
+    used_memory = sum(a["memory_mb"] for a in state["allocations"])
+    free_cores, free_memory = cores - used_cores, memory_mb - used_memory
+    # الطابور FIFO: stage ورا stage مستني مايعديهوش حتى لو الطلب بتاعه صغير
+    ahead = [w for w in state["waiting"] if w["since"] < request["since"] and w["id"] != request["id"]]
+    if ahead or free_cores < request["min_cores"] or free_memory < request["memory_mb"]:
+        return None
+    # لو في stages مستنية بعده، ياخد نصيبه بس من الفاضي مش كله
+    behind = sum(1 for w in state["waiting"] if w["id"] != request["id"])
+    share = max(request["min_cores"], free_cores // (behind + 1))
+    granted = min(request["max_cores"] or free_cores, share, free_cores)
+    return {**request, "cores": granted, "granted_at": time.time()}
+
+
+@contextmanager
+def allocate(stage, kit_id, min_cores=1, max_cores=None, memory_mb=0, log=print):
+    """with allocate(...) as grant → grant["cores"] و grant["memory_mb"]؛ بيستنى لحد ما الـ node يكون فيه مكان.
+
+    max_cores=None = كل الفاضي. طلب أكبر من الـ node نفسه بيتقص لحجم الـ node (بيشتغل لوحده)."""
+    cores, memory = node_cores(), node_memory_mb()
+    min_cores = max(1, min(min_cores, cores))
+    max_cores = max(min_cores, min(max_cores, cores)) if max_cores else None
+    memory_mb = min(memory_mb, memory)
+    if not GOVERNOR_ENABLED:
+        now = time.time()
+        yield {"stage": stage, "kit_id": kit_id, "cores": max_cores or cores, "memory_mb": memory_mb,
+               "since": now, "granted_at": now}
+        return
+
+    request = {"id": uuid.uuid4().hex, "pid": os.getpid(), "stage": stage, "kit_id": kit_id,
+               "min_cores": min_cores, "max_cores": max_cores, "memory_mb": memory_mb, "since": time.time()}
+    grant, queued = None, False
+    try:
+        while grant is None:
+            with _locked_state() as state:
+                grant = _try_grant(state, request, cores, memory)
+                state["waiting"] = [w for w in state["waiting"] if w["id"] != request["id"]]
+                if grant is not None:
+                    state["allocations"].append(grant)
+                else:
+                    state["waiting"].append(request)
+            if grant is None:
+                if not queued:
+                    log(f"{stage}: الـ node مليان – في الطابور ({min_cores}+ core، {memory_mb} MB)")
+                    queued = True
+                time.sleep(POLL_SECONDS)
+        if queued:
+            log(f"{stage}: اتمنح {grant['cores']} core بعد {grant['granted_at'] - request['since']:.0f} ثانية انتظار")
+        yield grant
+    finally:
+        with _locked_state() as state:
+            state["allocations"] = [a for a in state["allocations"] if a["id"] != request["id"]]
+            state["waiting"] = [w for w in state["waiting"] if w["id"] != request["id"]]
+
+
+def snapshot():
+    """الحجوزات والطابور دلوقتي (للـ debugging: /api/governor و `resource_governor.py status`)."""
+    cores, memory = node_cores(), node_memory_mb()
+    with _locked_state() as state:
+        allocations, waiting = state["allocations"], state["waiting"]
+    now = time.time()
+
+    def describe(entry, since_key):
+        times = {key: datetime.fromtimestamp(entry[key]).isoformat(timespec="seconds")
+                 for key in ("since", "granted_at") if key in entry}
+        return {**entry, **times, "seconds": round(now - entry[since_key], 1)}
+
+    return {
+        "enabled": GOVERNOR_ENABLED,
+        "cores": cores,
+        "memory_mb": memory,
+        "used_cores": sum(a["cores"] for a in allocations),
+        "used_memory_mb": sum(a["memory_mb"] for a in allocations),
+        "allocations": [describe(a, "granted_at") for a in allocations],
+        "waiting": [describe(w, "since") for w in sorted(waiting, key=lambda w: w["since"])],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DeepAncestry node resource governor")
+    parser.add_argument("command", choices=["status"])
+    args = parser.parse_args()
+    print(json.dumps(snapshot(), ensure_ascii=False, indent=2))
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+settings.py – إعدادات الـ web والـ worker من الـ environment (.env) – ثوابت بس
+
+مفيش أي side effect هنا: لا مجلدات بتتعمل ولا اتصال بالـ broker. app.py (الـ web) و tasks.py (الـ worker)
+بيقروا من هنا، فالـ worker مش محتاج يعمل import لـ Flask-WTF/Flask-Login عشان يعرف الإعدادات.
+"""
+
+import os
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BASE_DIR = Path(__file__).resolve().parent
+PROJECT_ROOT = BASE_DIR.parent
+FRONTEND_DIR = PROJECT_ROOT / "frontend"
+UPLOAD_FOLDER = Path(os.getenv('UPLOAD_FOLDER') or PROJECT_ROOT / "uploads")
+DATABASE_PATH = os.getenv('DATABASE_URL') or 'sqlite:///' + str(PROJECT_ROOT / "users.db")
+
+# الـ broker بيتعرف بس هنا – Celery مابيتصلش غير عند أول task/worker
+CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', 'redis://localhost:6379/0')
+CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', 'redis://localhost:6379/0')
+
+# Micro-batching: الـ kits بتستنى لحد BATCH_WINDOW_SECONDS أو لحد ما يتجمع BATCH_MAX_KITS وتتحسب مع بعض
+# (latency أعلى شوية مقابل merge/prune/ADMIXTURE مرة للدفعة). BATCH_MAX_KITS=1 → كل kit لوحده فوراً
+BATCH_WINDOW_SECONDS = int(os.getenv('BATCH_WINDOW_SECONDS', 30))
+BATCH_MAX_KITS = int(os.getenv('BATCH_MAX_KITS', 16))
+# /metrics و /api/governor الكامل محتاجين Authorization: Bearer <METRICS_TOKEN>؛ من غيره /metrics مقفول (404)
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+# الـ reaper (celery beat): كل REAPER_INTERVAL_SECONDS يمسح kits أقدم من KIT_RETENTION_DAYS،
+# REAPER_BATCH_SIZE kit في الدفعة ولحد REAPER_MAX_BATCHES دفعة في المرة – الباقي في المرة الجاية
+KIT_RETENTION_DAYS = int(os.getenv('KIT_RETENTION_DAYS', 30))
+REAPER_INTERVAL_SECONDS = int(os.getenv('REAPER_INTERVAL_SECONDS', 3600))
+REAPER_BATCH_SIZE = int(os.getenv('REAPER_BATCH_SIZE', 100))
+REAPER_MAX_BATCHES = int(os.getenv('REAPER_MAX_BATCHES', 20))
+# celery -A tasks.celery beat لازم يكون شغال جنب الـ workers عشان الـ reaper يتنفذ
+CELERY_BEAT_SCHEDULE = {
+    "reap-old-kits": {"task": "app.reap_old_kits", "schedule": REAPER_INTERVAL_SECONDS},
+}
+# أقصى عمر لاتصال /stream: بعده الـ server بيقفل والـ EventSource بيرجع يتصل (retry) ويكمل من Last-Event-ID –
+# worker مات والـ kit فضل processing مابيمسكش thread من الـ gunicorn للأبد
+SSE_MAX_SECONDS = int(os.getenv('SSE_MAX_SECONDS', 600))
+# PRELOAD_REFERENCE=0 → الـ master (gunicorn / celery) مابيحمّلش مصفوفات الـ panel قبل الـ fork
+PRELOAD_REFERENCE = os.getenv('PRELOAD_REFERENCE', '1') != '0'
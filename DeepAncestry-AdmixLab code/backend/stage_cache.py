@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+stage_cache.py – Content-addressed stage cache لـ run_full_pipeline
+
+كل stage بيتسجل بـ key = sha256(hash المدخلات + البارامترات + بصمة الأدوات).
+إعادة التشغيل بتنفذ بس الـ stages اللي مدخلاتها اتغيرت أو مخرجاتها اتمسحت؛ الباقي بيرجع نتيجته المحفوظة.
+الحالة في <kit>_stages.json جنب ملفات الـ kit.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from datetime import datetime
+from pathlib import Path
+
+HASH_BLOCK = 1 << 22
+# يتزود لما شكل نتيجة أي stage يتغير (مثلاً مفتاح جديد زي fingerprint) عشان النتايج القديمة ماتترجعش
+CACHE_VERSION = 2
+
+
+def tool_fingerprint(name):
+    # مسار + حجم + mtime للأداة: أي upgrade بيغيّر الـ key من غير ما نشغّل --version
+    path = shutil.which(name) or (name if os.path.exists(name) else None)
+    if path is None:
+        return f"{name}:missing"
+    st = os.stat(path)
+    return f"{os.path.realpath(path)}:{st.st_size}:{st.st_mtime_ns}"
+
+
+class StageCache:
+    def __init__(self, state_path, force=(), skip=(), log=print, on_stage=None):
+        self.path = Path(state_path)
+        self.force = set(force)
+        self.skip = set(skip)
+        self.log = log
+        # on_stage(name, event) – event: start / done / cached / skipped / failed (للـ progress)
+        self.on_stage = on_stage or (lambda name, event: None)
+        self.state = {"stages": {}, "files": {}}
+        if self.path.exists():
+            try:
+                self.state = json.loads(self.path.read_text())
+            except ValueError:
+                self.log(f"ملف الحالة تالف – هنبدأ من الأول: {self.path}")
+
+    def save(self):
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.state, indent=1))
+        os.replace(tmp, self.path)
+
+    def file_hash(self, path):
+        # الـ hash بيتحسب مرة لكل (حجم, mtime) – الملفات الكبيرة مش بتتقرأ تاني لو ماتغيرتش
+        path = str(path)
+        st = os.stat(path)
+        signature = [st.st_size, st.st_mtime_ns]
+        cached = self.state["files"].get(path)
+        if cached and cached["signature"] == signature:
+            return cached["sha256"]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for data in iter(lambda: f.read(HASH_BLOCK), b''):
+                digest.update(data)
+        self.state["files"][path] = {"signature": signature, "sha256": digest.hexdigest()}
+        return digest.hexdigest()
+
+    def stage_key(self, name, inputs, params, tools):
+        payload = {
+            "version": CACHE_VERSION,
+            "stage": name,
+            "inputs": {str(p): self.file_hash(p) for p in inputs},
+            "params": params,
+            "tools": {t: tool_fingerprint(t) for t in tools},
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _outputs_intact(self, record):
+        for path, sha in record.get("outputs", {}).items():
+            if not os.path.exists(path) or self.file_hash(path) != sha:
+                return False
+        return True
+
+    def run(self, name, func, inputs=(), params=None, tools=()):
+        """func() يرجّع dict فيه 'outputs' (قائمة مسارات) + أي قيم تانية تحتاجها الـ stages اللي بعده."""
+        record = self.state["stages"].get(name)
+        if name in self.skip:
+            if record and "result" in record:
+                self.log(f"تخطي {name} (بطلب) – استخدام النتيجة السابقة")
+                self.on_stage(name, "skipped")
+                return record["result"]
+            raise ValueError(f"مينفعش نتخطى {name}: مفيش نتيجة سابقة")
+
+        key = self.stage_key(name, inputs, params or {}, tools)
+        forced = name in self.force or "all" in self.force
+        if not forced and record and record.get("key") == key and "result" in record and self._outputs_intact(record):
+            self.log(f"{name}: مفيش تغيير – من الـ cache")
+            self.on_stage(name, "cached")
+            return record["result"]
+
+        self.on_stage(name, "start")
+        started = time.time()
+        try:
+            result = func()
+        except Exception as e:
+            self.state["stages"][name] = {"key": key, "error": str(e), "failed_at": datetime.utcnow().isoformat()}
+            self.save()
+            self.on_stage(name, "failed")
+            raise
+        self.state["stages"][name] = {
+            "key": key,
+            "result": result,
+            "outputs": {str(p): self.file_hash(p) for p in result.get("outputs", [])},
+            "seconds": round(time.time() - started, 3),
+            "finished_at": datetime.utcnow().isoformat(),
+        }
+        self.save()
+        self.on_stage(name, "done")
+        return result
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+stage_metrics.py – قياسات structured لكل stage ولكل أداة خارجية بدل نص الـ log بس
+
+stage: wall، CPU الـ process نفسه و CPU الـ children (RUSAGE_CHILDREN)، max RSS، bytes اتقرت/اتكتبت،
+عدد SNPs/العينات في المخرجات، والحالة. أداة (plink2 / admixture / qpAdm / convertf): نفس الحاجات من os.wait4
+على الـ pid بتاعها بالظبط – الـ K والموديلات بيشتغلوا مع بعض، فـ delta الـ RUSAGE_CHILDREN مش هيفرق بينهم.
+كل record بيتكتب JSON line في <kit>_metrics.jsonl لكل kit شغال (زي log_to)، وبيدخل على histograms الـ node
+(ملف JSON تحت METRICS_DIR محمي بـ flock) اللي /metrics في app بيعرضها بصيغة Prometheus.
+"""
+
+import fcntl
+import json
+import os
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+METRICS_DIR = Path(os.getenv('METRICS_DIR') or Path(tempfile.gettempdir()) / "deepancestry_metrics")
+HISTOGRAMS_NAME = "histograms.json"
+PREFIX = "deepancestry"
+SECONDS_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+BYTES_BUCKETS = tuple(2 ** n * 1024 * 1024 for n in range(6, 16))  # 64 MiB → 32 GiB
+# ru_maxrss بالـ KB على Linux
+MAXRSS_UNIT = 1024
+BLOCK_SIZE = 512
+
+_sinks = []
+_open_records = []
+_lock = threading.Lock()
+
+
+def metrics_path(kit_dir, kit_id):
+    return Path(kit_dir) / f"{kit_id}_metrics.jsonl"
+
+
+@contextmanager
+def record_to(path):
+    """كل record جوه الـ with بيتكتب في path (<kit>_metrics.jsonl)."""
+    f = open(path, 'a', encoding='utf-8')
+    _sinks.append(f)
+    try:
+        yield
+    finally:
+        _sinks.remove(f)
+        f.close()
+
+
+def _io_bytes():
+    # rchar/wchar: كل الـ bytes اللي الـ process قراها/كتبها (حتى لو من الـ page cache)
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _cpu_delta(before, after):
+    return max(0.0, round(after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime, 3))
+
+
+def _count_lines(path):
+    with open(path, 'rb') as f:
+        return sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1 << 22), b''))
+
+
+def count_outputs(outputs):
+    """{"snps", "samples"} من أول .bim / .fam / .prune.in في مخرجات الـ stage."""
+    counts = {}
+    for path in map(str, outputs):
+        if not os.path.exists(path):
+            continue
+        if path.endswith((".bim", ".prune.in")) and "snps" not in counts:
+            counts["snps"] = _count_lines(path)
+        elif path.endswith(".fam") and "samples" not in counts:
+            counts["samples"] = _count_lines(path)
+    return counts
+
+
+def emit(record):
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    with _lock:
+        for f in _sinks:
+            f.write(line)
+            f.flush()
+    observe(record)
+
+
+@contextmanager
+def measure(stage, kit_id, **fields):
+    """with measure(...) as record – الـ caller يقدر يضيف حقول (counts مثلاً)؛ الـ record بيتبعت عند الخروج."""
+    record = {"type": "stage", "stage": stage, "kit_id": kit_id, **fields,
+              "started_at": datetime.now().isoformat(timespec="seconds"), "tools": 0, "max_rss_bytes": 0}
+    wall = time.perf_counter()
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read_before, write_before = _io_bytes()
+    with _lock:
+        _open_records.append(record)
+    try:
+        yield record
+        record["status"] = "ok"
+    except BaseException as e:
+        record["status"] = "failed"
+        record["error"] = str(e)
+        raise
+    finally:
+        with _lock:
+            _open_records.remove(record)
+        self_after = resource.getrusage(resource.RUSAGE_SELF)
+        children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        read_after, write_after = _io_bytes()
+        child_read = (children_after.ru_inblock - children_before.ru_inblock) * BLOCK_SIZE
+        child_write = (children_after.ru_oublock - children_before.ru_oublock) * BLOCK_SIZE
+        record.update({
+            "wall_seconds": round(time.perf_counter() - wall, 3),
+            "cpu_seconds": _cpu_delta(self_before, self_after),
+            "child_cpu_seconds": _cpu_delta(children_before, children_after),
+            # max_rss_bytes = أكبر أداة اتشغلت في الـ stage؛ الاتنين دول peak على عمر الـ worker كله
+            "self_max_rss_bytes": self_after.ru_maxrss * MAXRSS_UNIT,
+            "children_max_rss_bytes": children_after.ru_maxrss * MAXRSS_UNIT,
+            "read_bytes": read_after - read_before + child_read,
+            "write_bytes": write_after - write_before + child_write,
+        })
+        if not record["tools"]:
+            # stage بايثون بس (clean / merge / projection) – مفيش غير peak الـ worker نفسه
+            record["max_rss_bytes"] = record["self_max_rss_bytes"]
+        emit(record)
+
+
+def run_tool(cmd, check=True, **popen_kwargs):
+    """subprocess.run(cmd, check=...) بس بيقيس الأداة نفسها (wait4) ويسجلها؛ يرجّع CompletedProcess."""
+    cmd = [str(part) for part in cmd]
+    started_at, wall = datetime.now().isoformat(timespec="seconds"), time.perf_counter()
+    proc = subprocess.Popen(cmd, **popen_kwargs)
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    proc.returncode = returncode = os.waitstatus_to_exitcode(status)
+    rss = usage.ru_maxrss * MAXRSS_UNIT
+    with _lock:
+        for record in _open_records:
+            record["tools"] += 1
+            record["max_rss_bytes"] = max(record["max_rss_bytes"], rss)
+    emit({
+        "type": "tool",
+        "tool": Path(cmd[0]).name,
+        "cmd": " ".join(cmd),
+        "stage": _open_records[-1]["stage"] if _open_records else None,
+        "started_at": started_at,
+        "wall_seconds": round(time.perf_counter() - wall, 3),
+        "cpu_seconds": round(usage.ru_utime + usage.ru_stime, 3),
+        "max_rss_bytes": rss,
+        "read_bytes": usage.ru_inblock * BLOCK_SIZE,
+        "write_bytes": usage.ru_oublock * BLOCK_SIZE,
+        "exit_status": returncode,
+        "status": "ok" if returncode == 0 else "failed",
+    })
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return subprocess.CompletedProcess(cmd, returncode)
+
+
+def load_records(kit_dir, kit_id):
+    path = metrics_path(kit_dir, kit_id)
+    if not path.exists():
+        return []
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# ---------------------------------------------------------------- Prometheus
+
+# (اسم الـ metric، النوع stage/tool، الحقل في الـ record، الـ buckets، الوصف)
+HISTOGRAMS = [
+    ("stage_wall_seconds", "stage", "wall_seconds", SECONDS_BUCKETS, "Wall time per pipeline stage"),
+    ("stage_cpu_seconds", "stage", "total_cpu_seconds", SECONDS_BUCKETS, "CPU time (worker + tools) per stage"),
+    ("stage_queued_seconds", "stage", "queued_seconds", SECONDS_BUCKETS, "Time a stage waited for the governor"),
+    ("stage_max_rss_bytes", "stage", "max_rss_bytes", BYTES_BUCKETS, "Peak RSS of the largest tool in a stage"),
+    ("tool_wall_seconds", "tool", "wall_seconds", SECONDS_BUCKETS, "Wall time per external tool run"),
+    ("tool_cpu_seconds", "tool", "cpu_seconds", SECONDS_BUCKETS, "CPU time per external tool run"),
+    ("tool_max_rss_bytes", "tool", "max_rss_bytes", BYTES_BUCKETS, "Peak RSS per external tool run"),
+]
+
+
+@contextmanager
+def _locked_histograms():
+    METRICS_DIR.mkdir(parents=True, exist_ok=True)
+    path = METRICS_DIR / HISTOGRAMS_NAME
+    with open(METRICS_DIR / f"{HISTOGRAMS_NAME}.lock", 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            state = json.loads(path.read_text(encoding='utf-8'))
+        except (FileNotFoundError, ValueError):
+            state = {"histograms": {}, "runs": {}}
+        yield state
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(state), encoding='utf-8')
+        os.replace(tmp, path)
+
+
+def observe(record):
+    """record → histograms الـ node (مشتركة بين كل الـ workers)."""
+    kind = record["type"]
+    label = record[kind]
+    values = {**record, "total_cpu_seconds": record.get("cpu_seconds", 0) + record.get("child_cpu_seconds", 0)}
+    with _locked_histograms() as state:
+        for name, metric_kind, field, buckets, _ in HISTOGRAMS:
+            value = values.get(field)
+            if metric_kind != kind or value is None:
+                continue
+            series = state["histograms"].setdefault(name, {}).setdefault(
+                label, {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+        runs = state["runs"].setdefault(kind, {}).setdefault(label, {})
+        runs[record["status"]] = runs.get(record["status"], 0) + 1
+
+
+def render_prometheus():
+    """الـ histograms بصيغة Prometheus text (0.0.4)."""
+    with _locked_histograms() as state:
+        histograms, runs = state["histograms"], state["runs"]
+    lines = []
+    for name, kind, _, buckets, help_text in HISTOGRAMS:
+        metric = f"{PREFIX}_{name}"
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} histogram"]
+        for label, series in sorted(histograms.get(name, {}).items()):
+            for bound, count in zip(buckets, series["buckets"]):
+                lines.append(f'{metric}_bucket{{{kind}="{label}",le="{bound:g}"}} {count}')
+            lines.append(f'{metric}_bucket{{{kind}="{label}",le="+Inf"}} {series["count"]}')
+            lines.append(f'{metric}_sum{{{kind}="{label}"}} {series["sum"]:.6g}')
+            lines.append(f'{metric}_count{{{kind}="{label}"}} {series["count"]}')
+    for kind in ("stage", "tool"):
+        metric = f"{PREFIX}_{kind}_runs_total"
+        lines += [f"# HELP {metric} Finished {kind} runs by status", f"# TYPE {metric} counter"]
+        for label, statuses in sorted(runs.get(kind, {}).items()):
+            for status, count in sorted(statuses.items()):
+                lines.append(f'{metric}{{{kind}="{label}",status="{status}"}} {count}')
+    return "\n".join(lines) + "\n"
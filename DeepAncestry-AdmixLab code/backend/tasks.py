@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+tasks.py – الـ Celery tasks (pipeline الـ kit، دفعات الـ cohort، الـ reaper) من غير الـ web
+
+الـ worker: celery -A tasks.celery worker (و celery -A tasks.celery beat للـ reaper).
+الإعدادات من settings، والـ pipeline نفسه (process_dna / cohort_batch) بيتعمله import
+جوه الـ task – app.py بيعمل import للملف ده (جوه routes الرفع بس) عشان enqueue_kit من غير ما يشيل الـ pipeline كله.
+في الـ worker، worker_init بيحمّل الـ pipeline ومصفوفات الـ panel في الـ parent قبل الـ prefork
+(preload.py)، فالـ children بيورثوها copy-on-write بدل ما كل child يحمّلها لوحده.
+
+أسامي الـ tasks ثابتة ("app.…") زي ما كانت في app.py – الرسايل اللي في الطابور وجدول الـ beat بيفضلوا شغالين.
+"""
+
+import json
+import shutil
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from celery import Celery, signals
+
+import settings
+from models import DNAKit, db, db_app, find_reusable_kit
+
+# Celery مابيتصلش بالـ broker غير عند أول task/worker – هنا إعدادات بس
+celery = Celery("app")
+celery.conf.update(broker_url=settings.CELERY_BROKER_URL, result_backend=settings.CELERY_RESULT_BACKEND,
+                   beat_schedule=settings.CELERY_BEAT_SCHEDULE)
+
+
+@signals.worker_init.connect
+def preload_worker(**_):
+    if settings.PRELOAD_REFERENCE:
+        import preload
+        preload.worker()
+
+
+class ProgressReporter:
+    """progress الـ pipeline → <kit>_events.jsonl (للـ SSE) + حالة Celery + DNAKit بكتابات مجمّعة.
+
+    الـ DB بيتكتب بس لو الـ progress زاد MIN_DELTA أو عدّى MIN_INTERVAL ثانية أو الـ status اتغير."""
+    MIN_DELTA = 5
+    MIN_INTERVAL = 15
+
+    def __init__(self, task, kit_id):
+        self.task = task
+        self.kit_id = kit_id
+        self.events_path = settings.UPLOAD_FOLDER / kit_id / f"{kit_id}_events.jsonl"
+        self.progress = 0
+        self.saved = (None, None)
+        self.saved_at = 0.0
+
+    def __call__(self, progress, stage, event):
+        self.emit(progress, stage, event)
+
+    def emit(self, progress, stage, event, status='processing', **fields):
+        self.progress = progress
+        with open(self.events_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({"progress": progress, "stage": stage, "event": event, "status": status,
+                                "time": datetime.utcnow().isoformat()}, ensure_ascii=False) + "\n")
+        self.task.update_state(state='PROGRESS', meta={'kit_id': self.kit_id, 'progress': progress, 'stage': stage,
+                                                       'status': status})
+
+        saved_progress, saved_status = self.saved
+        due = (status != saved_status or fields
+               or (progress != saved_progress
+                   and (saved_progress is None or progress - saved_progress >= self.MIN_DELTA
+                        or time.time() - self.saved_at >= self.MIN_INTERVAL)))
+        if due:
+            self.save(progress, status, **fields)
+
+    def save(self, progress, status, **fields):
+        kit = DNAKit.query.filter_by(kit_id=self.kit_id).first()
+        if kit is None:
+            return
+        kit.progress, kit.status = progress, status
+        for name, value in fields.items():
+            setattr(kit, name, value)
+        db.session.commit()
+        self.saved, self.saved_at = (progress, status), time.time()
+
+@celery.task(bind=True, name="app.start_background_processing")
+def start_background_processing(self, filepath: str, kit_id: str):
+    import process_dna
+
+    kit_dir = settings.UPLOAD_FOLDER / kit_id
+    log_path = kit_dir / f"{kit_id}_process.log"
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # الـ pipeline في نفس الـ process – progress بأوزان الـ stages بدل subprocess من غير أي حالة
+    with db_app().app_context(), process_dna.log_to(log_path):
+        reporter = ProgressReporter(self, kit_id)
+        process_dna.log(f"بدء المعالجة لـ {kit_id}")
+        reporter.emit(0, "queued", "start")
+        try:
+            outcome = process_dna.run_full_pipeline(
+                filepath, kit_id, progress=reporter,
+                reuse_lookup=lambda fp, pv: find_reusable_kit(fp, pv, exclude_kit_id=kit_id))
+        except Exception as e:
+            outcome = e
+        return finish_kit(reporter, outcome)
+
+def finish_kit(reporter, outcome):
+    """outcome = summary الـ pipeline أو الـ Exception → حالة DNAKit النهائية + حدث completed/failed."""
+    from process_dna import log
+
+    if isinstance(outcome, Exception):
+        db.session.rollback()
+        log(f"فشلت المعالجة: {outcome}")
+        reporter.emit(reporter.progress, "pipeline", "failed", status='failed',
+                      error_message=str(outcome), finished_at=datetime.utcnow())
+        return {"status": "failed", "error": str(outcome)}
+
+    # السجل قبل حدث الـ completed – الـ SSE بيقفل أول ما يشوفه
+    log("انتهت المعالجة بنجاح")
+    reporter.emit(100, "pipeline", "done", status='completed', finished_at=datetime.utcnow(),
+                  error_message=None, fingerprint=outcome["fingerprint"], panel_version=outcome["panel_version"])
+    return {"status": "completed", **outcome}
+
+def claim_queued_kits(limit):
+    """أقدم kits في الطابور → processing؛ الـ UPDATE المشروط بيمنع دفعتين ياخدوا نفس الـ kit."""
+    claimed = []
+    for kit in DNAKit.query.filter_by(status='queued').order_by(DNAKit.created_at).limit(limit).all():
+        if DNAKit.query.filter_by(id=kit.id, status='queued').update({"status": 'processing'}):
+            claimed.append(kit)
+    db.session.commit()
+    return claimed
+
+def enqueue_kit(kit):
+    if settings.BATCH_MAX_KITS <= 1:
+        kit.status = 'processing'
+        db.session.commit()
+        start_background_processing.delay(str(settings.UPLOAD_FOLDER / kit.kit_id / kit.original_filename), kit.kit_id)
+        return
+    # الدفعة بتتبعت فوراً لو اكتملت، وإلا بعد الـ window (أول task يصحى بياخد كل اللي في الطابور)
+    if DNAKit.query.filter_by(status='queued').count() >= settings.BATCH_MAX_KITS:
+        process_cohort_batch.delay()
+    else:
+        process_cohort_batch.apply_async(countdown=settings.BATCH_WINDOW_SECONDS)
+
+@celery.task(bind=True, name="app.process_cohort_batch")
+def process_cohort_batch(self):
+    import cohort_batch
+    import process_dna
+
+    upload_folder = settings.UPLOAD_FOLDER
+    with db_app().app_context():
+        kits = claim_queued_kits(settings.BATCH_MAX_KITS)
+        if not kits:
+            return {"status": "empty"}
+        reporters = {kit.kit_id: ProgressReporter(self, kit.kit_id) for kit in kits}
+        for kit in kits:
+            with process_dna.log_to(upload_folder / kit.kit_id / f"{kit.kit_id}_process.log"):
+                process_dna.log(f"بدء المعالجة لـ {kit.kit_id} (دفعة من {len(kits)} kit)")
+            reporters[kit.kit_id].emit(0, "queued", "start")
+
+        batch_dir = upload_folder / "_cohorts" / (self.request.id or uuid.uuid4().hex)
+        outcomes = cohort_batch.run_cohort(
+            [(upload_folder / kit.kit_id / kit.original_filename, kit.kit_id) for kit in kits], batch_dir,
+            reuse_lookup=lambda kit_id, fp, pv: find_reusable_kit(fp, pv, exclude_kit_id=kit_id),
+            progress=lambda kit_id, percent, stage, event: reporters[kit_id](percent, stage, event))
+
+        statuses = {}
+        for kit in kits:
+            with process_dna.log_to(upload_folder / kit.kit_id / f"{kit.kit_id}_process.log"):
+                statuses[kit.kit_id] = finish_kit(reporters[kit.kit_id], outcomes.get(kit.kit_id, RuntimeError("مفيش نتيجة")))["status"]
+
+        # الطابور لسه فيه kits (أكتر من BATCH_MAX_KITS) – دفعة تانية على طول
+        if DNAKit.query.filter_by(status='queued').count():
+            process_cohort_batch.delay()
+    return {"status": "done", "kits": statuses}
+
+# الـ kits اللي لسه في الطابور أو شغالة مابتتمسحش حتى لو قديمة – الـ pipeline لسه بيكتب في مجلدها
+REAPER_SKIP_STATUSES = ('queued', 'processing')
+
+def reap_kit_batch(cutoff, batch_size):
+    """أقدم batch_size kit قبل cutoff: المجلد الأول وبعدين الصف – لو وقع في النص، الصف لسه موجود والمرة الجاية تكمل."""
+    import relatives
+
+    kits = (DNAKit.query.filter(DNAKit.created_at < cutoff, DNAKit.status.notin_(REAPER_SKIP_STATUSES))
+            .order_by(DNAKit.created_at, DNAKit.id).limit(batch_size).all())
+    # الـ genotypes في مخزن الأقارب بتتمسح مع الـ kit (الصف بيتصفّر)
+    relatives.remove_kits([kit.kit_id for kit in kits])
+    for kit in kits:
+        shutil.rmtree(settings.UPLOAD_FOLDER / kit.kit_id, ignore_errors=True)
+        db.session.delete(kit)
+    db.session.commit()
+    return len(kits)
+
+@celery.task(name="app.reap_old_kits")
+def reap_old_kits():
+    from process_dna import log
+
+    with db_app().app_context():
+        cutoff = datetime.utcnow() - timedelta(days=settings.KIT_RETENTION_DAYS)
+        batch_size, reaped = settings.REAPER_BATCH_SIZE, 0
+        for _ in range(settings.REAPER_MAX_BATCHES):
+            count = reap_kit_batch(cutoff, batch_size)
+            reaped += count
+            if count < batch_size:
+                break
+        if reaped:
+            log(f"الـ reaper: اتمسح {reaped} kit أقدم من {settings.KIT_RETENTION_DAYS} يوم")
+    return {"reaped": reaped}
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# الـ backend modules flat (import genotype_io زي ما process_dna بيعمل) – نفس sys.path بتاع تشغيلها من backend/
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# settings والـ modules بيقروا المسارات من الـ environment عند الـ import – كله في مجلد مؤقت قبل أي import
+_ROOT = Path(tempfile.mkdtemp(prefix="deepancestry_tests_"))
+for _name, _sub in (("UPLOAD_FOLDER", "uploads"), ("GENOTYPE_STORE_DIR", "genotype_store"),
+                    ("GOVERNOR_DIR", "governor"), ("METRICS_DIR", "metrics"), ("REFERENCE_DIR", "reference")):
+    os.environ[_name] = str(_ROOT / _sub)
+os.environ["DATABASE_URL"] = f"sqlite:///{_ROOT / 'users.db'}"
+os.environ.setdefault("SECRET_KEY", "tests")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+
+@pytest.fixture
+def web():
+    """Flask test client بـ DB فاضية وبدون CSRF؛ web.login(email) بيعمل user ويسجل دخوله."""
+    import app as webapp
+
+    webapp.app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    webapp.init_db()
+    with webapp.app.app_context():
+        webapp.db.drop_all()
+        webapp.db.create_all()
+    client = webapp.app.test_client()
+
+    def login(email="user@example.com"):
+        with webapp.app.app_context():
+            user = webapp.User(email=email, name=email.split("@")[0],
+                               password_hash=webapp.generate_password_hash("secret"))
+            webapp.db.session.add(user)
+            webapp.db.session.commit()
+            user_id = user.id
+        with client.session_transaction() as session:
+            session["_user_id"] = str(user_id)
+            session["_fresh"] = True
+        return user_id
+
+    client.app_module, client.login = webapp, login
+    yield client
+    with webapp.app.app_context():
+        webapp.db.session.remove()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+legacy_clean.py – clean_and_sort_for_plink الأصلي (سطر بسطر في الذاكرة) قبل الـ streaming parser
+
+مرجع للـ tests بس: ناتج genotype_io لازم يطابقه على نفس الملف.
+"""
+
+import csv
+
+
+def clean_and_sort_for_plink(input_path, output_path):
+    data_rows = []
+    skipped = 0
+    with open(input_path, 'r', encoding='utf-8', errors='ignore') as f:
+        sample = f.read(2048)
+        f.seek(0)
+        delimiter = '\t' if '\t' in sample else ','
+        reader = csv.reader(f, delimiter=delimiter)
+        header_skipped = False
+        for row in reader:
+            if len(row) < 4 or not row[0].strip():
+                continue
+            if not header_skipped and ('rsid' in row[0].lower() or row[0].startswith('#')):
+                header_skipped = True
+                continue
+
+            rsid = row[0].strip()
+            chrom_raw = row[1].strip().upper().replace('CHR', '')
+            pos_str = row[2].strip()
+            if not pos_str.isdigit():
+                skipped += 1
+                continue
+
+            geno_raw = row[3].strip().upper()
+            geno_clean = geno_raw.replace(' ', '').replace('/', '').replace('|', '')
+            geno = geno_clean[:2] if len(geno_clean) >= 2 else '--'
+            if geno in {'II', 'DD', '00', '..', 'XX'}:
+                geno = '--'
+
+            chr_map = {'X': 23, 'Y': 24, 'MT': 26, 'M': 26}
+            chr_num = chr_map.get(chrom_raw, int(chrom_raw) if chrom_raw.isdigit() else None)
+            if chr_num is None or not (1 <= chr_num <= 26 and chr_num != 25):
+                skipped += 1
+                continue
+
+            chrom_out = 'X' if chr_num == 23 else 'Y' if chr_num == 24 else 'MT' if chr_num == 26 else str(chr_num)
+
+            data_rows.append((chr_num, int(pos_str), rsid, chrom_out, pos_str, geno))
+
+    data_rows.sort(key=lambda x: (x[0], x[1]))
+
+    with open(output_path, 'w', encoding='utf-8', newline='') as f:
+        for r in data_rows:
+            f.write(f"{r[2]}\t{r[3]}\t{r[4]}\t{r[5]}\n")
+    return len(data_rows), skipped
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""run_admixture_jobs: الـ K بالتوازي بميزانية cores مشتركة، و -P مع .P الـ panel (binary وهمي بدل admixture)."""
+
+import json
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+import admixture_runner
+
+# بيكتب <base>.K.Q و <base>.K.P في الـ cwd زي admixture، ويسجل الـ argv ووقت البداية والنهاية
+FAKE_ADMIXTURE = f"""#!{sys.executable}
+import json, os, sys, time
+args = sys.argv[1:]
+bed = next(a for a in args if a.endswith(".bed"))
+k = int(args[args.index(bed) + 1])
+started = time.time()
+time.sleep(0.3)
+base = bed[:-4]
+open(f"{{base}}.{{k}}.Q", "w").write(" ".join(["0.5"] * k) + "\\n")
+open(f"{{base}}.{{k}}.P", "w").write("0.1\\n")
+p_in = f"{{base}}.{{k}}.P.in"
+json.dump({{"args": args, "started": started, "ended": time.time(),
+           "p_in": os.path.realpath(p_in) if os.path.exists(p_in) else None}}, open("call.json", "w"))
+"""
+
+
+@pytest.fixture
+def fake_admixture(tmp_path, monkeypatch):
+    path = tmp_path / "admixture"
+    path.write_text(FAKE_ADMIXTURE)
+    path.chmod(0o755)
+    monkeypatch.setattr(admixture_runner, "ADMIXTURE_PATH", str(path))
+    bfile = tmp_path / "kit"
+    for ext in (".bed", ".bim", ".fam"):
+        Path(f"{bfile}{ext}").write_text("")
+    return str(bfile)
+
+
+@pytest.mark.parametrize("n_jobs,budget,expected", [(4, 8, (4, 2)), (4, 2, (2, 1)), (2, 16, (2, 8)), (3, 1, (1, 1))])
+def test_split_cores(n_jobs, budget, expected):
+    assert admixture_runner.split_cores(n_jobs, budget) == expected
+
+
+def calls(work_dir, ks):
+    return {k: json.loads((work_dir / f"K{k}" / "call.json").read_text()) for k in ks}
+
+
+def test_projection_jobs_run_concurrently(tmp_path, fake_admixture):
+    ks, work_dir = [5, 8, 10, 13], tmp_path / "admixture_out"
+    p_files = {k: tmp_path / f"panel.{k}.P" for k in ks}
+    for path in p_files.values():
+        path.write_text("0.2\n")
+    outputs = admixture_runner.run_admixture_jobs(fake_admixture, ks, work_dir, p_files=p_files, budget=8)
+
+    assert sorted(outputs) == ks
+    assert all(Path(q).exists() and Path(q).name == f"kit.{k}.Q" for k, (q, _) in outputs.items())
+    runs = calls(work_dir, ks)
+    for k, run in runs.items():
+        assert run["args"] == ["-P", "kit.bed", str(k), "-j2"]
+        assert run["p_in"] == os.path.realpath(p_files[k])
+    # الـ 4 K شغالين مع بعض: كلهم بدأوا قبل ما أي واحد يخلص
+    assert max(run["started"] for run in runs.values()) < min(run["ended"] for run in runs.values())
+
+
+def test_unsupervised_jobs_share_budget(tmp_path, fake_admixture):
+    ks, work_dir = [5, 8, 10], tmp_path / "admixture_out"
+    admixture_runner.run_admixture_jobs(fake_admixture, ks, work_dir, budget=2)
+    runs = calls(work_dir, ks)
+    assert all(run["args"] == ["--cv", "--acceleration", "kit.bed", str(k), "-j1"] and run["p_in"] is None
+               for k, run in runs.items())
+    # budget = 2 → مفيش أكتر من 2 K في نفس الوقت
+    events = sorted([(run["started"], 1) for run in runs.values()] + [(run["ended"], -1) for run in runs.values()])
+    running, peak = 0, 0
+    for _, step in events:
+        running += step
+        peak = max(peak, running)
+    assert peak <= 2
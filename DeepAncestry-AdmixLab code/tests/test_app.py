@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""routes الـ web على Flask test client (DB مؤقتة من conftest)."""
+
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+import resource_governor
+
+
+def add_kit(web, user_id, kit_id, status='completed', **fields):
+    webapp = web.app_module
+    with webapp.app.app_context():
+        webapp.db.session.add(webapp.DNAKit(user_id=user_id, kit_id=kit_id, original_filename="kit.txt",
+                                            status=status, **fields))
+        webapp.db.session.commit()
+
+
+# ---------------------------------------------------------------- /api/kits
+
+def test_kits_pagination(web):
+    other = web.login("other@example.com")
+    user_id = web.login()
+    base = datetime(2026, 1, 1)
+    # 3 kits بنفس الـ created_at → الترتيب بالـ id جوه نفس الوقت، والـ cursor مابيكررش ولا بيفوّت
+    times = [base, base + timedelta(hours=1), base + timedelta(hours=1), base + timedelta(hours=1),
+             base + timedelta(hours=2), base + timedelta(hours=3), base + timedelta(hours=4)]
+    for i, created_at in enumerate(times):
+        add_kit(web, user_id, f"KIT{i}", status='processing', created_at=created_at)
+    add_kit(web, other, "FOREIGN", status='processing', created_at=base + timedelta(hours=5))
+
+    seen, cursor = [], None
+    while True:
+        response = web.get("/api/kits", query_string={"limit": 3, **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        page = response.get_json()
+        assert len(page["kits"]) <= 3
+        seen += [kit["kit_id"] for kit in page["kits"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == ["KIT6", "KIT5", "KIT4", "KIT3", "KIT2", "KIT1", "KIT0"]
+    assert web.get("/api/kits", query_string={"cursor": "!!"}).status_code == 400
+
+
+def test_kits_etag(web):
+    user_id = web.login()
+    add_kit(web, user_id, "KIT1", status='processing', progress=40)
+    first = web.get("/api/kits")
+    etag = first.headers["ETag"]
+    assert first.status_code == 200 and first.headers["Cache-Control"] == "private, no-cache"
+
+    cached = web.get("/api/kits", headers={"If-None-Match": etag})
+    assert cached.status_code == 304 and cached.data == b"" and cached.headers["ETag"] == etag
+
+    webapp = web.app_module
+    with webapp.app.app_context():
+        webapp.DNAKit.query.filter_by(kit_id="KIT1").update({"status": "failed"})
+        webapp.db.session.commit()
+    changed = web.get("/api/kits", headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["ETag"] != etag
+    assert changed.get_json()["kits"][0]["status"] == "failed"
+
+
+def test_completed_kit_without_dir(web):
+    # kit مكتمل ومجلده اتمسح (الـ reaper) → 404 في صفحة النتائج، والقايمة من الـ DB بس
+    user_id = web.login()
+    add_kit(web, user_id, "GONE", status='completed', progress=100)
+    assert web.get("/results/GONE").status_code == 404
+    summary = web.get("/api/kits").get_json()["kits"][0]
+    assert summary["kit_id"] == "GONE" and summary["status"] == "completed" and "best_match" not in summary
+
+
+# ---------------------------------------------------------------- /stream
+
+def sse_events(body):
+    """نص الـ stream → [(event, id, data)] (الـ retry والـ heartbeat مش events)."""
+    events = []
+    for message in body.decode().split("\n\n"):
+        fields = {}
+        for line in message.splitlines():
+            name, _, value = line.partition(": ")
+            fields[name] = f"{fields[name]}\n{value}" if name == "data" and name in fields else value
+        if "event" in fields:
+            events.append((fields["event"], fields.get("id"), fields.get("data")))
+    return events
+
+
+def test_stream_event_order(web, monkeypatch):
+    monkeypatch.setattr(web.app_module, "SSE_POLL_SECONDS", 0)
+    user_id = web.login()
+    add_kit(web, user_id, "KIT1", status='processing', progress=10)
+    kit_dir = web.app_module.UPLOAD_FOLDER / "KIT1"
+    kit_dir.mkdir(parents=True, exist_ok=True)
+    log_lines = "تنظيف\nدمج\n"
+    (kit_dir / "KIT1_process.log").write_text(log_lines, encoding='utf-8')
+    events = [{"progress": 40, "stage": "merge", "event": "done", "status": "processing"},
+              {"progress": 100, "stage": "pipeline", "event": "done", "status": "completed"}]
+    (kit_dir / "KIT1_events.jsonl").write_text("".join(json.dumps(e) + "\n" for e in events))
+    ids = f"{len(log_lines.encode())}:{(kit_dir / 'KIT1_events.jsonl').stat().st_size}"
+
+    response = web.get("/stream/KIT1")
+    assert response.mimetype == "text/event-stream" and response.headers["Cache-Control"] == "no-cache"
+    body = response.get_data()
+    assert body.startswith(b"retry: 3000\n\n")
+    # الأحداث المتراكمة → آخر حالة بس، وبعدها done
+    assert sse_events(body) == [
+        ("progress", None, json.dumps({"progress": 10, "status": "processing"})),
+        ("log", ids, "تنظيف\nدمج"),
+        ("progress", ids, json.dumps({"progress": 100, "status": "completed", "stage": "pipeline"})),
+        ("done", ids, json.dumps({"progress": 100, "status": "completed"})),
+    ]
+
+    # إعادة الاتصال بـ Last-Event-ID: مفيش أسطر سجل مكررة
+    with web.app_module.app.app_context():
+        web.app_module.DNAKit.query.filter_by(kit_id="KIT1").update({"status": "completed", "progress": 100})
+        web.app_module.db.session.commit()
+    resumed = sse_events(web.get("/stream/KIT1", headers={"Last-Event-ID": ids}).get_data())
+    assert [event for event, _, _ in resumed] == ["progress", "done"]
+    assert web.get("/stream/OTHER").status_code == 404
+
+
+# ---------------------------------------------------------------- metrics / governor
+
+@pytest.fixture
+def governor_state(monkeypatch):
+    now = time.time()
+
+    def entry(kit_id, stage, cores):
+        return {"id": kit_id + stage, "pid": os.getpid(), "stage": stage, "kit_id": kit_id, "cores": cores,
+                "memory_mb": 100, "min_cores": 1, "max_cores": None, "since": now, "granted_at": now}
+
+    resource_governor.GOVERNOR_DIR.mkdir(parents=True, exist_ok=True)
+    (resource_governor.GOVERNOR_DIR / resource_governor.STATE_NAME).write_text(json.dumps({
+        "allocations": [entry("MINE", "pca", 2), entry("OTHER", "admixture", 3)],
+        "waiting": [entry("OTHER", "qpadm", 1)]}))
+    monkeypatch.setenv("GOVERNOR_CORES", "8")
+    yield
+    (resource_governor.GOVERNOR_DIR / resource_governor.STATE_NAME).unlink()
+
+
+def test_metrics_fails_closed(web, monkeypatch):
+    monkeypatch.setitem(web.app_module.app.config, "METRICS_TOKEN", None)
+    assert web.get("/metrics").status_code == 404
+    monkeypatch.setitem(web.app_module.app.config, "METRICS_TOKEN", "s3cret")
+    assert web.get("/metrics").status_code == 401
+    assert web.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    assert web.get("/metrics", headers={"Authorization": "Bearer s3cret"}).status_code == 200
+
+
+def test_governor_only_shows_own_kits(web, monkeypatch, governor_state):
+    monkeypatch.setitem(web.app_module.app.config, "METRICS_TOKEN", "s3cret")
+    assert web.get("/api/governor").status_code == 302  # login
+
+    user_id = web.login()
+    add_kit(web, user_id, "MINE", status='processing')
+    data = web.get("/api/governor").get_json()
+    assert [a["kit_id"] for a in data["allocations"]] == ["MINE"]
+    assert data["waiting"] == [] and data["waiting_count"] == 1
+    assert data["used_cores"] == 5 and data["cores"] == 8
+    assert "pid" not in data["allocations"][0]
+
+    full = web.get("/api/governor", headers={"Authorization": "Bearer s3cret"}).get_json()
+    assert {a["kit_id"] for a in full["allocations"]} == {"MINE", "OTHER"}
+    assert full["allocations"][0]["pid"] == os.getpid()
+
+
+def test_import_app_is_lazy():
+    # import app مابيشيلش numpy ولا celery؛ app.celery (celery -A app.celery) بيجيبه من tasks وقت الطلب
+    probe = ("import sys, app; heavy = [m for m in ('numpy', 'celery', 'tasks') if m in sys.modules]; "
+             "assert not heavy, heavy; assert app.celery.main and app.enqueue_kit")
+    subprocess.run([sys.executable, "-c", probe], cwd=Path(__file__).resolve().parent.parent / "backend",
+                   check=True, env=os.environ)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""write_bfile مقابل .bed/.bim/.fam محسوبين باليد (نفس ناتج plink2 --23file)."""
+
+import hashlib
+
+import numpy as np
+
+import genotype_io
+from genotype_io import GenotypeBlock, POS_BITS
+
+
+def block(rows):
+    chrom = {'X': 23, 'Y': 24, 'MT': 26}
+    key = np.array([(chrom.get(c) or int(c)) << POS_BITS | p for c, p, _, _ in rows], dtype=np.int64)
+    return GenotypeBlock(key, np.array([g for _, _, _, g in rows], dtype='S2'),
+                         np.array([r for _, _, r, _ in rows], dtype='S10'))
+
+
+FEMALE = [
+    ('1', 100, b'rs1', b'AA'),
+    ('1', 200, b'rs2', b'AG'),
+    ('1', 300, b'rs3', b'--'),
+    ('2', 50, b'rs4', b'TC'),
+    ('X', 10, b'rs5', b'GT'),
+    ('MT', 7, b'rs6', b'CC'),
+]
+# A1 = الأليل التاني لو het وإلا '.'، A2 = الأول (missing → '.'): HOM → كود 3، HET → 2، missing → 1
+FEMALE_BIM = (b"1\trs1\t0\t100\t.\tA\n"
+              b"1\trs2\t0\t200\tG\tA\n"
+              b"1\trs3\t0\t300\t.\t.\n"
+              b"2\trs4\t0\t50\tC\tT\n"
+              b"X\trs5\t0\t10\tT\tG\n"
+              b"MT\trs6\t0\t7\t.\tC\n")
+FEMALE_BED = b'\x6c\x1b\x01' + bytes([3, 2, 1, 2, 2, 3])
+
+
+def write(tmp_path, blocks, name="kit"):
+    prefix = str(tmp_path / name)
+    genotype_io.write_bfile(blocks, prefix, "FAM1", "IND1")
+    return prefix
+
+
+def read(prefix, ext):
+    with open(f"{prefix}.{ext}", 'rb') as f:
+        return f.read()
+
+
+def test_write_bfile_bytes(tmp_path):
+    prefix = write(tmp_path, [block(FEMALE[:3]), block(FEMALE[3:])])
+    assert read(prefix, "bed") == FEMALE_BED
+    assert read(prefix, "bim") == FEMALE_BIM
+    # het على X → أنثى
+    assert read(prefix, "fam") == b"FAM1\tIND1\t0\t0\t2\t-9\n"
+
+
+def test_write_bfile_sex(tmp_path):
+    male = write(tmp_path, [block([('X', 10, b'rs5', b'GG'), ('Y', 20, b'rs7', b'A-')]),
+                            block([('Y', 30, b'rs8', b'TT')])], "male")
+    assert read(male, "fam").split(b'\t')[4] == b'1'
+    assert read(male, "bed") == b'\x6c\x1b\x01' + bytes([3, 1, 3])
+
+    unknown = write(tmp_path, [block([('X', 10, b'rs5', b'GG'), ('Y', 20, b'rs7', b'--')])], "unknown")
+    assert read(unknown, "fam").split(b'\t')[4] == b'0'
+
+
+def test_bfile_round_trip(tmp_path):
+    prefix = write(tmp_path, [block(FEMALE)])
+    dosage = np.concatenate(list(genotype_io.iter_bed_dosages(prefix, 1)))[:, 0]
+    np.testing.assert_array_equal(dosage, [0, 1, np.nan, 1, 1, 0])
+
+    # نفس الـ fingerprint سواء اتحسب من الـ stream أو من الـ .bed اللي اتكتب
+    from_stream, from_bed = hashlib.sha256(), hashlib.sha256()
+    list(genotype_io.fingerprint_blocks([block(FEMALE)], from_stream))
+    genotype_io.fingerprint_bfile(prefix, from_bed)
+    assert from_stream.hexdigest() == from_bed.hexdigest()
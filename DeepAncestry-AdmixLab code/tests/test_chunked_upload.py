@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""رفع على أجزاء: resume من الـ offset المؤكد (حتى بعد restart)، sha256، والـ sniffer على أول الملف."""
+
+import gzip
+import hashlib
+import io
+
+import pytest
+
+import chunked_upload
+from chunked_upload import UploadError
+
+HEADER = b"# rsid\tchromosome\tposition\tgenotype\n"
+
+
+def kit_bytes(n_rows):
+    return HEADER + b"".join(b"rs%d\t%d\t%d\tAG\n" % (i, 1 + i % 22, 1000 + i) for i in range(n_rows))
+
+
+def upload(kit_dir, payload, chunk, start=0):
+    offset = start
+    while offset < len(payload):
+        result = chunked_upload.write_chunk(kit_dir, offset, io.BytesIO(payload[offset:offset + chunk]))
+        offset = result["offset"]
+    return offset
+
+
+def test_resume_after_restart(tmp_path):
+    payload = kit_bytes(60_000)  # > SNIFF_BYTES → الـ sniff بيتحسم أثناء الرفع
+    chunked_upload.init_upload(tmp_path, "kit.txt", len(payload))
+    half = upload(tmp_path, payload[:len(payload) // 2], 256 * 1024)
+    assert chunked_upload.upload_offset(tmp_path)[1] == half
+
+    # worker تاني / restart: الـ sha256 والـ sniffer بيتبنوا من الـ .part
+    chunked_upload._sessions.clear()
+    with pytest.raises(UploadError) as err:
+        chunked_upload.write_chunk(tmp_path, half + 10, io.BytesIO(payload[half + 10:]))
+    assert err.value.status == 409 and err.value.offset == half
+    assert upload(tmp_path, payload, 300_000, start=half) == len(payload)
+
+    result = chunked_upload.finalize_upload(tmp_path, hashlib.sha256(payload).hexdigest().upper())
+    assert result["sha256"] == hashlib.sha256(payload).hexdigest()
+    assert result["path"].read_bytes() == payload
+    assert result["sniff"]["format"] == "text" and result["sniff"]["ok"]
+    assert not (tmp_path / chunked_upload.STATE_NAME).exists()
+
+
+def test_incomplete_and_checksum(tmp_path):
+    payload = kit_bytes(200)
+    chunked_upload.init_upload(tmp_path, "kit.txt", len(payload))
+    upload(tmp_path, payload[:100], 50)
+    with pytest.raises(UploadError) as err:
+        chunked_upload.finalize_upload(tmp_path)
+    assert err.value.status == 409 and err.value.offset == 100
+
+    upload(tmp_path, payload, 64, start=100)
+    with pytest.raises(UploadError) as err:
+        chunked_upload.finalize_upload(tmp_path, "0" * 64)
+    assert err.value.status == 422 and err.value.reject
+
+
+def test_oversize_rejected(tmp_path):
+    payload = kit_bytes(200)
+    chunked_upload.init_upload(tmp_path, "kit.txt", len(payload) - 1)
+    with pytest.raises(UploadError) as err:
+        chunked_upload.write_chunk(tmp_path, 0, io.BytesIO(payload))
+    assert err.value.status == 413 and err.value.reject
+
+
+def test_gzip_sniffed_through_container(tmp_path):
+    payload = gzip.compress(kit_bytes(200))
+    chunked_upload.init_upload(tmp_path, "kit.txt.gz", len(payload))
+    upload(tmp_path, payload, 100)
+    sniff = chunked_upload.finalize_upload(tmp_path)["sniff"]
+    assert sniff["ok"] and sniff["snps"] == 200
+
+
+def test_non_dna_rejected_on_first_chunks(tmp_path):
+    payload = b"lorem ipsum dolor sit amet\n" * 60_000
+    chunked_upload.init_upload(tmp_path, "notes.txt", len(payload))
+    with pytest.raises(UploadError) as err:
+        upload(tmp_path, payload, 512 * 1024)
+    assert err.value.status == 415 and err.value.reject
+    # اترفض قبل ما الملف كله يترفع
+    assert chunked_upload.upload_offset(tmp_path)[1] < len(payload)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""الـ cohort: merge الـ kits مع الـ panel (harmonization + إعادة pack آخر byte) وتقسيم نتايج الدفعة على الـ kits."""
+
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import cohort_batch
+import genotype_io
+import reference_panel
+from genotype_io import GenotypeBlock, POS_BITS
+
+# (pos, A1, A2) – الـ SNP التالت والسادس A/T و C/G (الـ strand مش معروف → بيتشالوا)
+PANEL_SNPS = [(100, "A", "G"), (200, "C", "T"), (300, "A", "T"), (400, "G", "T"), (500, "A", "C"), (600, "C", "G")]
+N_REF = 7  # مش مضاعف 4 → آخر byte في كل صف لازم يتعاد pack مع الـ kits
+
+KITS = {
+    # 100 het → 1، 200 TT → 0 نسخ C، 300 ambiguous، 400 CC = GG على الـ strand التاني → 2، 500 no-call، 700 برا الـ panel
+    "KIT1": [(100, b"AG"), (200, b"TT"), (300, b"AA"), (400, b"CC"), (500, b"--"), (700, b"AA")],
+    "KIT2": [(100, b"GG"), (200, b"CT"), (500, b"AC"), (600, b"CC")],
+}
+EXPECTED = {"KIT1": [1, 0, np.nan, 2, np.nan, np.nan], "KIT2": [0, 1, np.nan, np.nan, 1, np.nan]}
+
+
+@pytest.fixture
+def ref_panel(tmp_path):
+    prefix = tmp_path / "ref" / "ref_panel"
+    prefix.parent.mkdir()
+    rng = np.random.default_rng(4)
+    dosage = rng.integers(0, 3, (len(PANEL_SNPS), N_REF)).astype(np.float32)
+    dosage[rng.random(dosage.shape) < 0.1] = np.nan
+    with open(f"{prefix}.bed", 'wb') as bed:
+        bed.write(genotype_io.BED_MAGIC + genotype_io.pack_bed_codes(genotype_io.dosage_codes(dosage)))
+    with open(f"{prefix}.bim", 'w') as bim:
+        bim.writelines(f"1\trs{pos}\t0\t{pos}\t{a1}\t{a2}\n" for pos, a1, a2 in PANEL_SNPS)
+    with open(f"{prefix}.fam", 'w') as fam:
+        fam.writelines(f"POP{i % 2}\tS{i}\t0\t0\t0\t-9\n" for i in range(N_REF))
+    return str(prefix), dosage
+
+
+def write_kit(tmp_path, kit_id):
+    rows = KITS[kit_id]
+    block = GenotypeBlock(np.array([1 << POS_BITS | pos for pos, _ in rows], dtype=np.int64),
+                          np.array([g for _, g in rows], dtype='S2'),
+                          np.array([b"rs%d" % pos for pos, _ in rows], dtype='S10'))
+    return genotype_io.write_bfile([block], str(tmp_path / kit_id), kit_id, kit_id)
+
+
+def test_merge_cohort_with_panel(tmp_path, monkeypatch, ref_panel):
+    monkeypatch.setattr(reference_panel, "MIN_OVERLAP_SNPS", 1)
+    prefix, ref_dosage = ref_panel
+    ids = [(kit_id, kit_id) for kit_id in KITS]
+    out = cohort_batch.merge_cohort([write_kit(tmp_path, kit_id) for kit_id in KITS], prefix,
+                                    str(tmp_path / "cohort"), ids)
+
+    fam = genotype_io.read_fam_ids(out)
+    assert len(fam) == N_REF + len(KITS) and fam[N_REF:] == ids
+    # صفوف التقاطع بس: SNPs ليها call متطابق عند kit واحد على الأقل
+    expected = np.array([EXPECTED[kit_id] for kit_id in KITS]).T
+    rows = np.flatnonzero(~np.isnan(expected).all(axis=1))
+    bim = genotype_io.read_bim(out)
+    assert (bim.key & ((1 << POS_BITS) - 1)).tolist() == [PANEL_SNPS[r][0] for r in rows]
+    assert bim.a1.tolist() == [PANEL_SNPS[r][1].encode() for r in rows]
+
+    merged = np.concatenate(list(genotype_io.iter_bed_dosages(out, len(fam))))
+    np.testing.assert_array_equal(merged[:, :N_REF], ref_dosage[rows])
+    np.testing.assert_array_equal(merged[:, N_REF:], expected[rows])
+
+
+def test_split_results(tmp_path):
+    ctxs = []
+    for kit_id in KITS:
+        kit_dir = tmp_path / kit_id
+        kit_dir.mkdir()
+        ctxs.append({"kit_id": kit_id, "kit_dir": kit_dir, "pca_prefix": str(kit_dir / f"{kit_id}_pca")})
+    cohort = tmp_path / "cohort"
+    header = "#FID\tIID\tPC1\tPC2\n"
+    Path(f"{cohort}.eigenvec").write_text(header + "POP0\tS0\t0.1\t0.2\nKIT1\tKIT1\t0.3\t0.4\nKIT2\tKIT2\t0.5\t0.6\n")
+    Path(f"{cohort}.eigenval").write_text("2.0\n1.0\n")
+    cohort_batch.split_eigenvec(str(cohort), ctxs)
+    assert (tmp_path / "KIT2" / "KIT2_pca.eigenvec").read_text() == header + "KIT2\tKIT2\t0.5\t0.6\n"
+    assert (tmp_path / "KIT1" / "KIT1_pca.eigenval").read_text() == "2.0\n1.0\n"
+
+    q_file, p_file = tmp_path / "cohort.2.Q", tmp_path / "cohort.2.P"
+    q_file.write_text("0.9 0.1\n0.2 0.8\n0.6 0.4\n")
+    p_file.write_text("0.5 0.5\n")
+    fam_ids = [("POP0", "S0"), ("KIT1", "KIT1"), ("KIT2", "KIT2")]
+    produced = cohort_batch.split_admixture({2: (str(q_file), str(p_file))}, fam_ids, ctxs, keep_p=True)
+    assert (tmp_path / "KIT1" / "KIT1.K2.Q").read_text() == "0.2 0.8\n"
+    assert (tmp_path / "KIT2" / "KIT2.K2.Q").read_text() == "0.6 0.4\n"
+    assert (tmp_path / "KIT2" / "KIT2.K2.P").exists()
+    assert produced == {kit_id: [str(tmp_path / kit_id / f"{kit_id}.K2.Q")] for kit_id in KITS}
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""الـ streaming parser + الـ k-way merge لازم يطلّعوا نفس ناتج الـ cleaner القديم سطر بسطر."""
+
+import gzip
+import shutil
+import struct
+import zlib
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import genotype_io
+import process_dna
+from legacy_clean import clean_and_sort_for_plink as legacy_clean
+
+FIXTURES = Path(__file__).parent / "fixtures"
+KIT = FIXTURES / "kit_23andme.txt"
+
+
+def normalized(lines):
+    # الفرق الوحيد المقصود: الـ position بيتكتب كرقم (0077 → 77) – شوف format_23file_lines
+    out = []
+    for line in lines:
+        rsid, chrom, pos, geno = line.split(b'\t')
+        out.append(b'\t'.join([rsid, chrom, str(int(pos)).encode(), geno]))
+    return out
+
+
+@pytest.fixture
+def legacy_lines(tmp_path):
+    path = tmp_path / "legacy.txt"
+    legacy_clean(KIT, path)
+    return path.read_bytes().splitlines()
+
+
+def test_clean_matches_legacy(tmp_path, legacy_lines):
+    out = tmp_path / "clean.txt"
+    assert process_dna.clean_and_sort_for_plink(str(KIT), str(out))
+    assert out.read_bytes().splitlines() == normalized(legacy_lines)
+
+
+@pytest.mark.parametrize("chunk_rows,block_rows", [(1, 1), (3, 2), (7, 5)])
+def test_kway_merge_matches_legacy(tmp_path, monkeypatch, legacy_lines, chunk_rows, block_rows):
+    # chunks صغيرة → runs كتير مش مرتبة → _merge_runs (مع مكررات على نفس الموقع عبر الـ runs)
+    merged = []
+    merge_runs = genotype_io._merge_runs
+    monkeypatch.setattr(genotype_io, "_merge_runs", lambda runs, rows: merged.append(len(runs)) or merge_runs(runs, rows))
+    state = {}
+    blocks = list(genotype_io.iter_sorted_genotypes(KIT, state, work_dir=tmp_path, chunk_rows=chunk_rows,
+                                                    block_rows=block_rows))
+    assert merged and merged[0] > 1
+    lines = b''.join(genotype_io.format_23file_lines(b) for b in blocks).splitlines()
+    assert lines == normalized(legacy_lines)
+    assert state['valid'] == len(legacy_lines)
+
+
+def test_gzip_matches_legacy(tmp_path, legacy_lines):
+    packed = tmp_path / "kit.txt.gz"
+    with open(KIT, 'rb') as src, gzip.open(packed, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    out = tmp_path / "clean.txt"
+    assert process_dna.clean_and_sort_for_plink(str(packed), str(out))
+    assert out.read_bytes().splitlines() == normalized(legacy_lines)
+
+
+def test_position_written_as_integer(tmp_path):
+    out = tmp_path / "clean.txt"
+    process_dna.clean_and_sort_for_plink(str(KIT), str(out))
+    rows = {line.split(b'\t')[0]: line.split(b'\t')[2] for line in out.read_bytes().splitlines()}
+    assert rows[b'rs10'] == b'77'
+    # +78 و 79x مرفوضين زي الـ cleaner القديم
+    assert b'rs12' not in rows and b'rs13' not in rows
+
+
+def test_ancestry_allele_columns(tmp_path):
+    # Ancestry: allele1 و allele2 في عمودين – بيتجمعوا genotype (الـ cleaner القديم كان بيطلّع '--')،
+    # و 0 0 (no-call عند Ancestry) → '--'
+    kit = tmp_path / "ancestry.txt"
+    kit.write_bytes(b"#AncestryDNA raw data\n"
+                    b"rsid\tchromosome\tposition\tallele1\tallele2\n"
+                    b"rs3\t2\t50\tT\tT\n"
+                    b"rs1\t1\t100\tA\tG\n"
+                    b"rs2\t1\t200\t0\t0\n"
+                    b"rs4\t23\t10\tC\tC\n")
+    out = tmp_path / "clean.txt"
+    assert process_dna.clean_and_sort_for_plink(str(kit), str(out))
+    assert out.read_bytes().splitlines() == [b"rs1\t1\t100\tAG", b"rs2\t1\t200\t--", b"rs3\t2\t50\tTT",
+                                             b"rs4\tX\t10\tCC"]
+
+
+def test_position_digit_limit():
+    # الـ key = chrom << 40 | pos: أكتر من 12 رقم ممكن يعدّي 2**40 ويبوّظ الكروموسوم → الصف بيتشال
+    state = {'skipped': 0, 'header_skipped': True}
+    lines = [b"rs1\t1\t999999999999\tAA\n", b"rs2\t1\t1099511627776\tAA\n", b"rs3\t1\t0000000000077\tAA\n"]
+    block = genotype_io.parse_chunk(lines, b'\t', state)
+    assert block.rsid.tolist() == [b"rs1"]
+    assert block.key.tolist() == [1 << genotype_io.POS_BITS | 999999999999]
+    assert state['skipped'] == 2
+
+
+def bgzf_block(data):
+    deflate = zlib.compressobj(6, zlib.DEFLATED, -15)
+    body = deflate.compress(data) + deflate.flush()
+    # gzip member + subfield BC = حجم الـ block كله − 1
+    head = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+    return head + struct.pack('<H', len(head) + 2 + len(body) + 8 - 1) + body + struct.pack('<II', zlib.crc32(data),
+                                                                                              len(data))
+
+
+@pytest.fixture
+def bgzf_vcf(tmp_path):
+    rng = np.random.default_rng(5)
+    text = b"##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\n"
+    for i in range(600):
+        chrom, pos = rng.integers(1, 4), rng.integers(1, 10**6)
+        ident = b"." if i % 7 == 0 else b"rs%d" % i
+        gt = [b"0/0", b"0/1", b"1|1", b"./."][i % 4]
+        text += b"%d\t%d\t%s\tA\tG\t.\tPASS\t.\tGT:DP\t%s:%d\n" % (chrom, pos, ident, gt, i)
+    # blocks صغيرة (أسطر كتير بتتقسم بين blockين) + block فاضي في النص و EOF الـ BGZF في الآخر
+    pieces = [text[start:start + 97] for start in range(0, len(text), 97)]
+    pieces.insert(len(pieces) // 2, b"")
+    path = tmp_path / "kit.vcf.gz"
+    path.write_bytes(b"".join(bgzf_block(piece) for piece in pieces) + bgzf_block(b""))
+    return path, text
+
+
+def test_bgzf_ranges_cover_every_line_once(bgzf_vcf):
+    path, text = bgzf_vcf
+    offsets = genotype_io._bgzf_blocks(path)
+    n_blocks = len(offsets) - 1
+    for workers in (2, 3, 7, n_blocks):
+        bounds = np.linspace(0, n_blocks, workers + 1).astype(int)
+        parts = [b"".join(genotype_io._iter_bgzf_range(path, offsets, int(a), int(b)))
+                 for a, b in zip(bounds[:-1], bounds[1:])]
+        assert b"".join(parts) == text
+        assert all(part.endswith(b"\n") for part in parts if part)
+
+
+def test_parallel_bgzf_matches_sequential(tmp_path, monkeypatch, bgzf_vcf):
+    path, _ = bgzf_vcf
+    monkeypatch.setattr(genotype_io, "PARALLEL_MIN_BYTES", 0)
+    assert genotype_io._can_parallelize(path, 4) and not genotype_io._can_parallelize(path, 1)
+
+    def read(workers):
+        state = {}
+        blocks = list(genotype_io.iter_sorted_genotypes(path, state, work_dir=tmp_path, chunk_rows=50,
+                                                        block_rows=64, workers=workers))
+        return genotype_io._concat(blocks), state
+
+    (sequential, seq_state), (parallel, par_state) = read(1), read(4)
+    assert (seq_state['valid'], seq_state['skipped']) == (par_state['valid'], par_state['skipped'])
+    assert seq_state['valid'] + seq_state['skipped'] == 600
+    for field in ("key", "geno", "rsid"):
+        np.testing.assert_array_equal(getattr(parallel, field), getattr(sequential, field))
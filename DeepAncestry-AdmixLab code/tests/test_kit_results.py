@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""<kit>_results.json: صف الـ kit من الـ eigenvec، الـ Q، والـ LRU cache (بيتجدد مع أي إعادة كتابة للملف)."""
+
+import json
+
+import pytest
+
+import kit_results
+
+
+@pytest.fixture
+def kit_dir(tmp_path):
+    kit_dir = tmp_path / "KIT1"
+    kit_dir.mkdir()
+    pcs = [f"{0.01 * (i + 1):g}" for i in range(kit_results.N_PCS)]
+    header = "#FID\tIID\t" + "\t".join(f"PC{i + 1}" for i in range(kit_results.N_PCS)) + "\n"
+    # صفوف مرجعية قبل الـ kit (الـ eigenvec بتاع plink2 على الـ merge كله)
+    rows = [f"POP\tS{i}\t" + "\t".join(["0.5"] * kit_results.N_PCS) + "\n" for i in range(3)]
+    (kit_dir / "KIT1_pca.eigenvec").write_text(header + "".join(rows) + "KIT1\tKIT1\t" + "\t".join(pcs) + "\n")
+    (kit_dir / "KIT1_pca.eigenval").write_text("3.0\n2.0\n")
+    (kit_dir / "KIT1.K5.Q").write_text("0.1 0.2 0.3 0.15 0.25\n")
+    return kit_dir
+
+
+def test_build_kit_results(kit_dir):
+    res = kit_results.build_kit_results(kit_dir, "KIT1", "v1")
+    assert res["pc_values"][:3] == [0.01, 0.02, 0.03] and len(res["pc_values"]) == kit_results.N_PCS
+    assert res["pc_variance"][:3] == [3.0, 2.0, 0.0]
+    assert res["admixture"] == {"5": [10.0, 20.0, 30.0, 15.0, 25.0]}
+    assert res["qpAdm_content"] == kit_results.QPADM_PENDING and res["p_value"] is None and not res["is_honest"]
+    # مفيش مصفوفة populations متبنية → الـ demo refs
+    assert set(res["distances"]) == set(kit_results.DEMO_REFS)
+    assert res["best_match"] == max(res["distances"], key=res["distances"].get)
+
+
+def test_load_uses_cache_until_rewritten(kit_dir):
+    kit_results._read_results.cache_clear()
+    first = kit_results.load_kit_results(kit_dir, "KIT1", "v1")
+    path = kit_results.results_path(kit_dir, "KIT1")
+    assert path.exists() and json.loads(path.read_text())["pc_values"] == first["pc_values"]
+
+    hits = kit_results._read_results.cache_info().hits
+    assert kit_results.load_kit_results(kit_dir, "KIT1", "v1") is first
+    assert kit_results._read_results.cache_info().hits == hits + 1
+
+    # الـ pipeline كتب نتيجة جديدة (الـ K13 خلص) → entry جديد
+    (kit_dir / "KIT1.K13.Q").write_text(" ".join(["0.0769"] * 13) + "\n")
+    kit_results.write_kit_results(kit_dir, "KIT1", "v1")
+    assert "13" in kit_results.load_kit_results(kit_dir, "KIT1", "v1")["admixture"]
+
+
+def test_load_rebuilds_stale_results(kit_dir):
+    path = kit_results.results_path(kit_dir, "KIT1")
+    path.write_text(json.dumps({"version": kit_results.RESULTS_VERSION - 1, "panel_version": "v1"}))
+    assert kit_results.load_kit_results(kit_dir, "KIT1", "v1")["pc_values"][0] == 0.01
+    # panel تاني → بتتبني تاني بالـ panel_version الجديد
+    assert kit_results.load_kit_results(kit_dir, "KIT1", "v2")["panel_version"] == "v2"
+    assert json.loads(path.read_text())["panel_version"] == "v2"
+
+
+def test_missing_kit_dir(tmp_path):
+    assert kit_results.load_kit_results(tmp_path / "GONE", "GONE", "v1") is None
+    assert not (tmp_path / "GONE").exists()
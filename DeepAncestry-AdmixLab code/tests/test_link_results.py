@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""link_kit_results: kit بنفس الـ fingerprint بياخد نتايج kit مكتمل – الـ kit_id بيتبدل في الحقول المعروفة بس."""
+
+from pathlib import Path
+
+import process_dna
+import qpadm_sweep
+
+SRC, DST = "DA0000000001", "DA0000000002"
+# id تاني أوله id الـ source – مايتلمسش
+NEIGHBOUR = SRC + "9"
+
+
+def qpadm_model(work_dir, name, sources, p_value):
+    model_dir = work_dir / name
+    model_dir.mkdir(parents=True)
+    (model_dir / "qpadm.out").write_text(
+        f"genotypename: /uploads/{SRC}/{SRC}_eigen.geno\nleft pops:\n{SRC}\n{NEIGHBOUR}\n" + "\n".join(sources) + "\n")
+    entry = qpadm_sweep.model_entry(sources, [1 / len(sources)] * len(sources), [0.01] * len(sources), 1.0, 2, p_value)
+    return {**entry, "output": str(Path(work_dir.name) / name / "qpadm.out")}
+
+
+def test_link_rewrites_known_fields(tmp_path):
+    src_dir, dst_dir = tmp_path / SRC, tmp_path / DST
+    src_dir.mkdir()
+    dst_dir.mkdir()
+    header = "#FID\tIID\tPC1\tPC2\n"
+    (src_dir / f"{SRC}_pca.eigenvec").write_text(header + f"{SRC}\t{SRC}\t0.1\t0.2\n{NEIGHBOUR}\tX{SRC}\t0.3\t0.4\n")
+    (src_dir / f"{SRC}.K5.Q").write_text("0.3 0.7\n")
+    work_dir = src_dir / f"{SRC}_qpadm"
+    models = [qpadm_model(work_dir, "model_000", ["Yamnaya", "EEF"], 0.2),
+              qpadm_model(work_dir, "model_001", ["WHG", "EEF"], 0.01)]
+    qpadm_sweep.write_report(src_dir, SRC, {"engine": "qpAdm", "target": SRC, "right": ["Mbuti"], "missing": [],
+                                            "models": models})
+
+    linked = process_dna.link_kit_results(src_dir, SRC, dst_dir, DST)
+    assert sorted(Path(p).name for p in linked) == sorted(
+        [f"{DST}_qpadm.json", f"{DST}_qpAdm.out", f"{DST}_pca.eigenvec", f"{DST}.K5.Q"])
+
+    assert (dst_dir / f"{DST}_pca.eigenvec").read_text() == (
+        header + f"{DST}\t{DST}\t0.1\t0.2\n{NEIGHBOUR}\tX{SRC}\t0.3\t0.4\n")
+    assert (dst_dir / f"{DST}.K5.Q").read_text() == "0.3 0.7\n"
+
+    report = qpadm_sweep.load_report(dst_dir, DST)
+    assert report["target"] == DST
+    assert f"target: {DST}" in (dst_dir / f"{DST}_qpAdm.out").read_text()
+    for model in report["models"]:
+        # المسار نسبي لمجلد الـ kit الجديد ومايشاورش على الـ source
+        output = dst_dir / model["output"]
+        assert output.is_file() and Path(model["output"]).parts[0] == f"{DST}_qpadm"
+        text = output.read_text()
+        assert f"/uploads/{DST}/{DST}_eigen.geno" in text and f"\n{DST}\n{NEIGHBOUR}\n" in text
+        assert SRC not in text.replace(NEIGHBOUR, "")
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""stage_merge: .bim التقاطع بس لما مكونات الـ panel متبنية، والـ merge الكامل لو مش متبنية؛
+و merge_with_panel (harmonization + إعادة pack آخر byte) ذهاب وعودة على .bed."""
+
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import genotype_io
+import process_dna
+import reference_panel
+from genotype_io import GenotypeBlock, POS_BITS
+
+# (pos, A1, A2)؛ 300 A/T (بيتشال)
+PANEL_SNPS = [(100, "A", "G"), (200, "C", "T"), (300, "A", "T"), (400, "G", "T"), (500, "A", "C")]
+N_REF = 5
+# 100 و 200 مباشر، 300 ambiguous، 400 CC = GG على الـ strand التاني، 500 no-call، 700 برا الـ panel
+KIT = [(100, b"AG"), (200, b"TT"), (300, b"AA"), (400, b"CC"), (500, b"--"), (700, b"AA")]
+OVERLAP = [b"rs100", b"rs200", b"rs400"]
+PANEL_PRUNE = np.array([b"rs100", b"rs300", b"rs400", b"rs500"])
+
+
+def write_bfile(prefix, snps, dosage, fam_ids):
+    """snps = [(pos, A1, A2)]، dosage = (SNPs × samples) عدد نسخ A1 (NaN = missing)."""
+    with open(f"{prefix}.bed", 'wb') as bed:
+        bed.write(genotype_io.BED_MAGIC + genotype_io.pack_bed_codes(genotype_io.dosage_codes(dosage)))
+    with open(f"{prefix}.bim", 'w') as bim:
+        bim.writelines(f"1\trs{pos}\t0\t{pos}\t{a1}\t{a2}\n" for pos, a1, a2 in snps)
+    with open(f"{prefix}.fam", 'w') as fam:
+        fam.writelines(f"{fid}\t{iid}\t0\t0\t0\t-9\n" for fid, iid in fam_ids)
+    return str(prefix)
+
+
+def write_ref(tmp_path, n_ref):
+    prefix = tmp_path / "ref" / "ref_panel"
+    prefix.parent.mkdir()
+    rng = np.random.default_rng(n_ref)
+    dosage = rng.integers(0, 3, (len(PANEL_SNPS), n_ref)).astype(np.float32)
+    dosage[rng.random(dosage.shape) < 0.1] = np.nan
+    return write_bfile(prefix, PANEL_SNPS, dosage, [("POP", f"S{i}") for i in range(n_ref)]), dosage
+
+
+@pytest.fixture
+def ctx(tmp_path, monkeypatch):
+    monkeypatch.setattr(reference_panel, "MIN_OVERLAP_SNPS", 1)
+    monkeypatch.setattr(reference_panel, "load_prune", lambda ref_prefix: PANEL_PRUNE)
+    prefix, _ = write_ref(tmp_path, N_REF)
+    block = GenotypeBlock(np.array([1 << POS_BITS | pos for pos, _ in KIT], dtype=np.int64),
+                          np.array([g for _, g in KIT], dtype='S2'),
+                          np.array([b"rs%d" % pos for pos, _ in KIT], dtype='S10'))
+    kit_bfile = genotype_io.write_bfile([block], str(tmp_path / "KIT1"), "KIT1", "KIT1")
+    return {"kit_id": "KIT1", "kit_bfile": kit_bfile, "ref_bed": str(prefix), "has_ref": True,
+            "merged_prefix": str(tmp_path / "KIT1_merged"), "pruned_prefix": str(tmp_path / "KIT1_pruned"),
+            "panel_pca": {"version": "v"}, "p_files": {2: "panel.2.P"}, "exact_prune": False}
+
+
+def prune(ctx):
+    ctx["base_prefix"] = process_dna.stage_merge(ctx)["base_prefix"]
+    process_dna.stage_prune(ctx)
+    return open(f"{ctx['pruned_prefix']}.prune.in", 'rb').read().split()
+
+
+def test_panel_built_skips_genotype_merge(ctx):
+    assert not process_dna.full_merge_needed(ctx)
+    assert prune(ctx) == [b"rs100", b"rs400"]
+    assert genotype_io.read_bim(ctx["merged_prefix"]).rsid.tolist() == OVERLAP
+    assert not Path(f"{ctx['merged_prefix']}.bed").exists()
+    assert not Path(f"{ctx['merged_prefix']}.fam").exists()
+
+
+@pytest.mark.parametrize("missing", [{"panel_pca": None, "p_files": {}}, {"p_files": {}}, {"exact_prune": True}])
+def test_full_merge_fallback(ctx, monkeypatch, missing):
+    ctx.update(missing)
+    assert process_dna.full_merge_needed(ctx)
+    if ctx["exact_prune"]:
+        # plink2 مش موجود هنا – الـ merge بس
+        ctx["base_prefix"] = process_dna.stage_merge(ctx)["base_prefix"]
+    else:
+        assert prune(ctx) == [b"rs100", b"rs400"]
+    fam = genotype_io.read_fam_ids(ctx["merged_prefix"])
+    assert len(fam) == N_REF + 1 and fam[-1] == ("KIT1", "KIT1")
+    assert genotype_io.read_bim(ctx["merged_prefix"]).rsid.tolist() == OVERLAP
+
+
+# (pos, A1, A2, عدد نسخ A1 بتاع الـ kit) → عدد نسخ A1 بتاع الـ panel المتوقع
+SWAPPED_KIT = [
+    (100, "G", "A", 2, 0),        # ref/alt معكوسين: GG = 0 نسخ A
+    (200, "C", "T", 1, 1),        # مباشر
+    (300, "A", "T", 2, np.nan),   # A/T – بيتشال
+    (400, "C", "A", 2, 2),        # strand flip: CC = GG
+    (500, "C", "A", 0, 2),        # ref/alt معكوسين: AA = 2 نسخ A
+]
+
+
+@pytest.mark.parametrize("n_ref", [5, 6, 7])
+def test_merge_round_trip(tmp_path, monkeypatch, n_ref):
+    # عدد الـ samples مش مضاعف 4 → آخر byte في كل صف بيتعاد pack مع عمود الـ kit
+    monkeypatch.setattr(reference_panel, "MIN_OVERLAP_SNPS", 1)
+    ref_prefix, ref_dosage = write_ref(tmp_path, n_ref)
+    kit_bfile = write_bfile(tmp_path / "KIT1", [snp[:3] for snp in SWAPPED_KIT],
+                            np.array([[snp[3]] for snp in SWAPPED_KIT], dtype=np.float32), [("KIT1", "KIT1")])
+    expected = np.array([snp[4] for snp in SWAPPED_KIT], dtype=np.float32)
+
+    panel_idx, g, stats = reference_panel.harmonize_kit(reference_panel.load_snp_index(ref_prefix), kit_bfile)
+    assert (stats["flipped"], stats["ambiguous"], stats["used"]) == (1, 1, 4)
+    out = reference_panel.merge_with_panel(ref_prefix, [(panel_idx, g)], [("KIT1", "KIT1")], str(tmp_path / "merged"))
+
+    rows = np.flatnonzero(~np.isnan(expected))
+    assert genotype_io.read_bim(out).rsid.tolist() == [b"rs%d" % PANEL_SNPS[r][0] for r in rows]
+    assert genotype_io.read_fam_ids(out)[-1] == ("KIT1", "KIT1")
+    merged = np.concatenate(list(genotype_io.iter_bed_dosages(out, n_ref + 1)))
+    np.testing.assert_array_equal(merged[:, :n_ref], ref_dosage[rows])
+    np.testing.assert_array_equal(merged[:, n_ref], expected[rows])
+    assert Path(f"{out}.bed").stat().st_size == 3 + len(rows) * ((n_ref + 1 + 3) // 4)
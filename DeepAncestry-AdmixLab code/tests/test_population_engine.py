@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""المسافات والخلطات (NNLS الدقيق و FISTA الـ batched) على مصفوفة مراجع صغيرة بخليط معروف."""
+
+from itertools import combinations
+
+import numpy as np
+import pytest
+
+import population_engine
+
+
+@pytest.fixture
+def pops():
+    rng = np.random.default_rng(2)
+    matrix = rng.normal(0, 1, (8, 6))
+    return {
+        "matrix": matrix,
+        "names": np.array([f"P{i}" for i in range(len(matrix))]),
+        "ranges": {"population": (0, 5), "sample": (5, len(matrix))},
+        "sq_norms": np.einsum('ij,ij->i', matrix, matrix),
+        "scale": np.ones(matrix.shape[1]),
+    }
+
+
+def test_distance_matrix(pops):
+    targets = pops["matrix"][[1, 6]] + 0.01
+    dist = population_engine.distance_matrix(pops, targets)
+    expected = np.linalg.norm(targets[:, None] - pops["matrix"][None, :5], axis=-1)
+    np.testing.assert_allclose(dist, expected, atol=1e-9)
+
+    cosine = population_engine.distance_matrix(pops, targets, metric="cosine", kind="sample")
+    m = pops["matrix"][5:]
+    expected = 1 - targets @ m.T / np.outer(np.linalg.norm(targets, axis=1), np.linalg.norm(m, axis=1))
+    np.testing.assert_allclose(cosine, expected, atol=1e-9)
+
+    assert population_engine.nearest(pops, targets, k=2)[0][0][0] == "P1"
+    assert population_engine.nearest(pops, targets, k=1, kind="sample")[1][0][0] == "P6"
+
+
+def test_fit_mixture_recovers_weights(pops):
+    target = 0.5 * pops["matrix"][0] + 0.3 * pops["matrix"][2] + 0.2 * pops["matrix"][4]
+    weights, distance = population_engine.fit_mixture(pops, target, [0, 2, 4, 1])
+    np.testing.assert_allclose(weights, [0.5, 0.3, 0.2, 0], atol=1e-6)
+    assert distance == pytest.approx(0, abs=1e-5)
+
+
+def test_score_combinations_matches_exact_fit(pops):
+    target = 0.7 * pops["matrix"][1] + 0.3 * pops["matrix"][3]
+    combos = np.array(list(combinations(range(5), 2)))
+    weights, distances = population_engine.score_combinations(pops, target, combos)
+    np.testing.assert_allclose(weights.sum(axis=1), 1)
+    assert np.all(weights >= 0)
+    # FISTA على الـ simplex بيوصل لنفس الـ optimum بتاع الـ NNLS لكل توليفة
+    for combo, w, d in zip(combos, weights, distances):
+        exact_w, exact_d = population_engine.fit_mixture(pops, target, combo)
+        np.testing.assert_allclose(w, exact_w, atol=1e-3)
+        assert d == pytest.approx(exact_d, abs=1e-3)
+    best = combos[np.argmin(distances)]
+    assert best.tolist() == [1, 3]
+
+
+def test_best_mixtures(pops, monkeypatch):
+    target = 0.6 * pops["matrix"][0] + 0.4 * pops["matrix"][4]
+    models = population_engine.best_mixtures(pops, target, [0, 1, 2, 3, 4], size=2, top=3)
+    assert len(models) == 3
+    assert [m["distance"] for m in models] == sorted(m["distance"] for m in models)
+    best = {s["name"]: s["weight"] for s in models[0]["sources"]}
+    assert best == pytest.approx({"P0": 0.6, "P4": 0.4}, abs=1e-6)
+
+    monkeypatch.setattr(population_engine, "MAX_COMBINATIONS", 5)
+    with pytest.raises(ValueError):
+        population_engine.best_mixtures(pops, target, [0, 1, 2, 3, 4], size=2)
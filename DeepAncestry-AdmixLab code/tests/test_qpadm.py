@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""fit_rank / fit_model على f2 مبني بأوزان معروفة، وترتيب الموديلات، والـ sweep كله على panel الـ benchmark."""
+
+import numpy as np
+import pytest
+
+import benchmark
+import process_dna
+import qpadm_sweep
+import reference_panel
+
+N_SNPS, N_BLOCKS = 20_000, 50
+SOURCES, RIGHT = [1, 2, 3], [4, 5, 6, 7, 8]
+
+
+@pytest.fixture(scope="module")
+def f2_blocks():
+    """target = 0.6·S1 + 0.4·S2؛ كل right pop بيشارك سلالات المصادر بنسب مختلفة → (full, loo)."""
+    rng = np.random.default_rng(11)
+    p0 = rng.uniform(0.1, 0.9, N_SNPS)
+
+    def drift(sd):
+        return rng.normal(0, sd, N_SNPS)
+
+    a1, a2, a3 = drift(0.05), drift(0.05), drift(0.05)
+    sources = [p0 + a1 + drift(0.03), p0 + a2 + drift(0.03), p0 + a3 + drift(0.03)]
+    right = [p0 + drift(0.05), p0 + 0.7 * a1 + drift(0.05), p0 + 0.7 * a2 + drift(0.05),
+             p0 + 0.7 * a3 + drift(0.05), p0 + 0.4 * (a1 + a3) + drift(0.05)]
+    target = 0.6 * sources[0] + 0.4 * sources[1] + drift(0.01)
+    pops = np.stack([target] + sources + right)
+
+    block = np.arange(N_SNPS) * N_BLOCKS // N_SNPS
+    sq = (pops[:, None] - pops[None]) ** 2
+    blocks = np.stack([sq[:, :, block == b].mean(axis=-1) for b in range(N_BLOCKS)])
+    full = blocks.mean(axis=0)
+    return full, (full * N_BLOCKS - blocks) / (N_BLOCKS - 1)
+
+
+def p_value(chisq, dof):
+    from scipy.special import gammaincc
+    return gammaincc(dof / 2, chisq / 2)
+
+
+def test_fit_rank_exact():
+    rng = np.random.default_rng(5)
+    x = np.outer(rng.normal(size=3), rng.normal(size=4)) + np.outer(rng.normal(size=3), rng.normal(size=4))
+    q_inv = np.eye(12)
+    a, chisq = qpadm_sweep.fit_rank(x, q_inv, 2)
+    assert a.shape == (3, 2) and chisq == pytest.approx(0, abs=1e-12)
+    # rank 0: chisq = ‖X‖² لما Q = I، ورank 1 أقل من 2 مش كفاية
+    assert qpadm_sweep.fit_rank(x, q_inv, 0)[1] == pytest.approx((x ** 2).sum())
+    assert qpadm_sweep.fit_rank(x, q_inv, 1)[1] > 1e-3
+
+
+def test_fit_model_recovers_weights(f2_blocks):
+    full, loo = f2_blocks
+    weights, se, chisq, dof = qpadm_sweep.fit_model(full, loo, 0, SOURCES[:2], RIGHT)
+    np.testing.assert_allclose(weights, [0.6, 0.4], atol=0.01)
+    assert weights.sum() == pytest.approx(1)
+    assert np.all(se < 0.01)
+    assert dof == 3 and p_value(chisq, dof) > qpadm_sweep.P_THRESHOLD
+
+    # مصدر زيادة وزنه ~0 والموديل لسه بيعدّي
+    weights, _, chisq, dof = qpadm_sweep.fit_model(full, loo, 0, SOURCES, RIGHT)
+    np.testing.assert_allclose(weights, [0.6, 0.4, 0], atol=0.01)
+    assert dof == 2 and p_value(chisq, dof) > qpadm_sweep.P_THRESHOLD
+
+
+@pytest.mark.parametrize("sources", [[1, 3], [2, 3]])
+def test_fit_model_rejects_wrong_sources(f2_blocks, sources):
+    full, loo = f2_blocks
+    _, _, chisq, dof = qpadm_sweep.fit_model(full, loo, 0, sources, RIGHT)
+    assert p_value(chisq, dof) < 1e-6
+
+
+def test_rank_models_prefers_simplest_passing():
+    def model(names, weights, p):
+        return qpadm_sweep.model_entry(names, weights, [0.1] * len(names), 1.0, 2, p)
+
+    models = [
+        model(["A", "B", "C"], [0.6, 0.4, 0.0], 0.99),
+        model(["A", "C"], [1.2, -0.2], 0.9),
+        model(["A", "B"], [0.6, 0.4], 0.7),
+        model(["B", "C"], [0.5, 0.5], 0.01),
+        model(["A", "D"], [0.5, 0.5], 0.2),
+    ]
+    ranked = [[s["name"] for s in m["sources"]] for m in qpadm_sweep.rank_models(models)]
+    assert ranked == [["A", "B"], ["A", "D"], ["A", "B", "C"], ["B", "C"], ["A", "C"]]
+
+
+def test_sweep_recovers_benchmark_mixture(tmp_path, monkeypatch):
+    # نفس الـ panel الصناعي بتاع benchmark.py: الـ kit = KIT_MIXTURE
+    panel_snps = 30_000
+    ref_prefix = tmp_path / "ref" / "ref_panel"
+    benchmark.write_panel(ref_prefix, panel_snps, 10)
+    out_dir = tmp_path / "panel"
+    out_dir.mkdir()
+    reference_panel.build_f2(ref_prefix, out_dir)
+    monkeypatch.setattr(reference_panel, "load_manifest", lambda _: {"version": "test", "components": {"f2": {}}})
+    monkeypatch.setattr(reference_panel, "panel_dir", lambda *_: out_dir)
+    f2 = qpadm_sweep.load_f2(ref_prefix)
+
+    kit = tmp_path / "kit.txt"
+    benchmark.write_kit(kit, "txt", panel_snps, panel_snps)
+    assert process_dna.clean_to_bed(str(kit), str(tmp_path / "kit"), "KIT")
+    report = qpadm_sweep.sweep_f2(f2, str(tmp_path / "kit"), "KIT", workers=2)
+
+    best = report["models"][0]
+    weights = {s["name"]: s["weight"] for s in best["sources"]}
+    assert qpadm_sweep.passes(best)
+    assert weights.keys() == benchmark.KIT_MIXTURE.keys()
+    for pop, weight in benchmark.KIT_MIXTURE.items():
+        assert weights[pop] == pytest.approx(weight, abs=benchmark.MIXTURE_TOLERANCE)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""panel_version (cache الـ sha256 جنب الـ panel)، _build_once (مجلد مؤقت + rename)، prune.in و QC الـ panel،
+و EIGENSTRAT الـ panel (cache مرة وحدة) + أعمدة الـ kits."""
+
+import hashlib
+import json
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import genotype_io
+import reference_panel
+
+
+def write_panel(tmp_path):
+    prefix = tmp_path / "ref_panel"
+    for ext, data in ((".bed", b"\x6c\x1b\x01\x03"), (".bim", b"1\trs1\t0\t100\tA\tG\n"), (".fam", b"P\tS\t0\t0\t0\t-9\n")):
+        Path(f"{prefix}{ext}").write_bytes(data)
+    return str(prefix)
+
+
+def test_panel_version_cache(tmp_path):
+    prefix = write_panel(tmp_path)
+    expected = hashlib.sha256(b"".join(Path(f"{prefix}{ext}").read_bytes() for ext in (".bed", ".bim", ".fam")))
+    assert reference_panel.panel_version(prefix) == expected.hexdigest()
+    assert [p.name for p in tmp_path.iterdir() if "version" in p.name] == ["ref_panel.version.json"]
+
+    # الـ cache بيتقرا طول ما الـ signature (حجم + mtime) زي ما هو
+    cache = Path(f"{prefix}.version.json")
+    cache.write_text(json.dumps({**json.loads(cache.read_text()), "version": "cached"}))
+    assert reference_panel.panel_version(prefix) == "cached"
+    Path(f"{prefix}.fam").write_bytes(b"P\tS\t0\t0\t0\t-9\nP\tS2\t0\t0\t0\t-9\n")
+    assert reference_panel.panel_version(prefix) not in ("cached", expected.hexdigest())
+
+
+def test_build_once_replaces_stale_dir(tmp_path):
+    out_dir = tmp_path / "panel_x" / "snp_index"
+    out_dir.mkdir(parents=True)
+    (out_dir / "key.npy").write_bytes(b"partial")
+    built = []
+
+    def build(tmp):
+        built.append(tmp)
+        (tmp / "done").write_text("ok")
+
+    assert reference_panel._build_once(out_dir, "done", build) == out_dir
+    assert sorted(p.name for p in out_dir.iterdir()) == ["done"]
+    # الـ marker موجود → مابيتبنيش تاني
+    reference_panel._build_once(out_dir, "done", build)
+    assert len(built) == 1 and [p.name for p in out_dir.parent.iterdir()] == ["snp_index"]
+
+
+# (pos, A1, A2)؛ 300 A/T
+EIGEN_SNPS = [(100, "A", "G"), (200, "C", "T"), (300, "A", "T"), (400, "G", "T")]
+EIGEN_FAM = [("POP0", "S0"), ("OUT", "S1"), ("POP1", "S2"), ("POP0", "S3"), ("OUT", "S4")]
+
+
+def write_bfile(prefix, snps, dosage, fam_ids):
+    with open(f"{prefix}.bed", 'wb') as bed:
+        bed.write(genotype_io.BED_MAGIC + genotype_io.pack_bed_codes(genotype_io.dosage_codes(dosage)))
+    with open(f"{prefix}.bim", 'w') as bim:
+        bim.writelines(f"1\trs{pos}\t0\t{pos}\t{a1}\t{a2}\n" for pos, a1, a2 in snps)
+    with open(f"{prefix}.fam", 'w') as fam:
+        fam.writelines(f"{fid}\t{iid}\t0\t0\t0\t-9\n" for fid, iid in fam_ids)
+    return str(prefix)
+
+
+def test_eigenstrat_overlay(tmp_path, monkeypatch):
+    ref_dosage = np.array([[0, 1, 2, np.nan, 1], [2, 2, 0, 1, 0], [1, 0, 1, 1, 2], [0, 0, 1, 2, np.nan]],
+                          dtype=np.float32)
+    ref_prefix = write_bfile(tmp_path / "ref_panel", EIGEN_SNPS, ref_dosage, EIGEN_FAM)
+    # KIT1: 100 مباشر، 300 A/T بيتشال، 400 strand flip (CC = GG)؛ KIT2: 200 بالأليلات معكوسة (TT = 0 نسخ C)
+    kit1 = write_bfile(tmp_path / "KIT1", [(100, "A", "G"), (300, "A", "T"), (400, "C", "A")],
+                       np.array([[1], [2], [2]], dtype=np.float32), [("KIT1", "KIT1")])
+    kit2 = write_bfile(tmp_path / "KIT2", [(200, "T", "C")], np.array([[2]], dtype=np.float32), [("KIT2", "KIT2")])
+
+    built = []
+    build = reference_panel.build_eigenstrat
+    monkeypatch.setattr(reference_panel, "build_eigenstrat", lambda *args: built.append(args) or build(*args))
+    eigen = reference_panel.load_eigenstrat(ref_prefix, ["POP1", "POP0"])
+    reference_panel._loaded.clear()
+    assert reference_panel.load_eigenstrat(ref_prefix, ["POP0", "POP1"])["n_samples"] == 3
+    assert len(built) == 1
+
+    out = str(tmp_path / "cohort_eigen")
+    reference_panel.write_eigenstrat_overlay(eigen, [kit1, kit2], [("KIT1", "KIT1"), ("KIT2", "KIT2")], out)
+    assert os.path.realpath(f"{out}.snp") == str(eigen["dir"] / "ref.snp")
+    assert Path(f"{out}.ind").read_text().splitlines() == [
+        "S0\tU\tPOP0", "S2\tU\tPOP1", "S3\tU\tPOP0", "KIT1\tU\tKIT1", "KIT2\tU\tKIT2"]
+    # عدد نسخ A1 بتاع الـ panel (9 = missing): أعمدة POP0/POP1 من الـ panel + KIT1 + KIT2
+    assert Path(f"{out}.geno").read_text().splitlines() == ["02919", "20190", "11199", "01229"]
+
+
+# plink2 وهمي: بيسجل الـ args وبيكتب <out>.prune.in (مش مرتب – load_prune بيرتبه)
+FAKE_PLINK2 = f"""#!{sys.executable}
+import json, sys
+args = sys.argv[1:]
+out = args[args.index("--out") + 1]
+json.dump(args, open(out + ".args.json", "w"))
+open(out + ".prune.in", "w").write("rs400\\nrs100\\n")
+"""
+
+
+@pytest.fixture
+def fake_plink2(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "plink2").write_text(FAKE_PLINK2)
+    (bin_dir / "plink2").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+
+def test_panel_prune_component(tmp_path, fake_plink2):
+    ref_dosage = np.array([[0, 1, 2, np.nan, 1], [2, 2, 2, 2, 2], [1, 0, 1, 1, 2], [np.nan, 0, np.nan, 1, np.nan]],
+                          dtype=np.float32)
+    ref_prefix = write_bfile(tmp_path / "ref_panel", EIGEN_SNPS, ref_dosage, EIGEN_FAM)
+    out_dir = reference_panel.panel_dir(ref_prefix)
+    out_dir.mkdir()
+    component = reference_panel.build_prune(ref_prefix, out_dir, threads=2)
+    assert component["args"] == reference_panel.PRUNE_ARGS and component["n_snps"] == 4
+    args = json.loads((out_dir / "prune.args.json").read_text())
+    assert args[:2] == ["--bfile", ref_prefix] and args[2:2 + len(reference_panel.PRUNE_ARGS)] == reference_panel.PRUNE_ARGS
+
+    with np.load(out_dir / "qc.npz") as qc:
+        np.testing.assert_allclose(qc["maf"], [0.5, 0.0, 0.5, 0.25], rtol=1e-6)
+        np.testing.assert_allclose(qc["missing"], [0.2, 0.0, 0.0, 0.6], rtol=1e-6)
+        assert qc["rsid"].tolist() == [b"rs100", b"rs200", b"rs300", b"rs400"]
+
+    # من غير manifest أو بـ PRUNE_ARGS تانية → None (الـ kit بيرجع لـ plink2 على الـ merge)
+    assert reference_panel.load_prune(ref_prefix) is None
+    version = reference_panel.panel_version(ref_prefix)
+    reference_panel._save_manifest(out_dir, {"version": version,
+                                             "components": {"prune": {**component, "args": ["--maf", "0.01"]}}})
+    assert reference_panel.load_prune(ref_prefix) is None
+    reference_panel._save_manifest(out_dir, {"version": version, "components": {"prune": component}})
+    prune_ids = reference_panel.load_prune(ref_prefix)
+    assert prune_ids.tolist() == [b"rs100", b"rs400"]
+    assert reference_panel.load_qc(ref_prefix)["maf"][0] == pytest.approx(0.5)
+
+    kit = write_bfile(tmp_path / "KIT1", [(100, "A", "G"), (200, "C", "T")], np.array([[1], [0]], dtype=np.float32),
+                      [("KIT1", "KIT1")])
+    assert reference_panel.intersect_prune(prune_ids, kit, tmp_path / "kit.prune.in") == 1
+    assert (tmp_path / "kit.prune.in").read_bytes() == b"rs100\n"
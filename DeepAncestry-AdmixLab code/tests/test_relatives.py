@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""kinship_chunk (XOR/popcount على الـ planes) مقابل KING-robust محسوب مباشرة على الـ genotypes."""
+
+import numpy as np
+import pytest
+
+import relatives
+
+N_SNPS = 1000  # مش مضاعف 64 – الـ bits الزيادة في آخر كلمة لازم تتحسب missing
+
+
+def random_kits(rng, n_kits, missing=0.1):
+    freq = rng.uniform(0.05, 0.95, N_SNPS)
+    g = rng.binomial(2, freq, (n_kits, N_SNPS)).astype(np.float32)
+    g[rng.random(g.shape) < missing] = np.nan
+    return g
+
+
+def king_direct(a, b):
+    valid = ~np.isnan(a) & ~np.isnan(b)
+    a, b = a[valid], b[valid]
+    het_a, het_b = a == 1, b == 1
+    ibs0 = int(np.sum(np.abs(a - b) == 2))
+    ibs1 = int(np.sum(np.abs(a - b) == 1))
+    n = int(valid.sum())
+    kinship = (np.sum(het_a & het_b) - 2 * ibs0) / (het_a.sum() + het_b.sum())
+    return n, ibs0, kinship, (2 * (n - ibs0 - ibs1) + ibs1) / (2 * n)
+
+
+def test_kinship_chunk_matches_king(rng=np.random.default_rng(7)):
+    g = random_kits(rng, 12)
+    # قريب: نفس الشخص ونص الـ SNPs متبدلة (شبه درجة أولى)
+    g[1] = np.where(rng.random(N_SNPS) < 0.5, g[0], g[1])
+    planes = np.stack([relatives.pack_planes(row, N_SNPS) for row in g])
+    assert planes.shape == (12, 2, relatives.words_per_plane(N_SNPS))
+
+    got = relatives.kinship_chunk(planes[0], planes)
+    for j in range(len(g)):
+        n, ibs0, kinship, ibs = king_direct(g[0], g[j])
+        assert got["n"][j] == n
+        assert got["ibs0"][j] == ibs0
+        assert got["kinship"][j] == pytest.approx(kinship)
+        assert got["ibs"][j] == pytest.approx(ibs)
+    # الـ kit مع نفسه → 0.5، والقريب أعلى بوضوح من الغرب
+    assert got["kinship"][0] == pytest.approx(0.5)
+    assert got["kinship"][1] > relatives.MIN_KINSHIP > got["kinship"][2:].max()
+
+
+def test_popcount_fallback(monkeypatch, rng=np.random.default_rng(3)):
+    words = rng.integers(0, 2**63, (5, 7), dtype=np.uint64)
+    expected = relatives.popcount(words)
+    monkeypatch.delattr(np, "bitwise_count", raising=False)
+    np.testing.assert_array_equal(relatives.popcount(words), expected)
+    assert expected.sum() == sum(bin(int(w)).count("1") for w in words.ravel())
+
+
+def test_all_missing_kit():
+    empty = relatives.pack_planes(np.full(N_SNPS, np.nan, dtype=np.float32), N_SNPS)
+    other = relatives.pack_planes(np.ones(N_SNPS, dtype=np.float32), N_SNPS)
+    got = relatives.kinship_chunk(empty, other[None])
+    assert got["n"][0] == 0 and np.isnan(got["kinship"][0])
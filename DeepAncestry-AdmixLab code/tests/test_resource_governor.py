@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""الـ governor: منح الـ cores من الفاضي، طابور FIFO، وحجوزات الـ processes الميتة."""
+
+import json
+import threading
+import time
+
+import pytest
+
+import resource_governor
+
+
+@pytest.fixture(autouse=True)
+def node(tmp_path, monkeypatch):
+    monkeypatch.setattr(resource_governor, "GOVERNOR_DIR", tmp_path)
+    monkeypatch.setattr(resource_governor, "GOVERNOR_ENABLED", True)
+    monkeypatch.setattr(resource_governor, "POLL_SECONDS", 0.01)
+    monkeypatch.setenv("GOVERNOR_CORES", "8")
+    monkeypatch.setenv("GOVERNOR_MEMORY_MB", "1000")
+
+
+def quiet(msg):
+    pass
+
+
+def held():
+    with resource_governor._locked_state() as state:
+        return [(a["stage"], a["cores"]) for a in state["allocations"]]
+
+
+def test_grants_from_free_pool():
+    with resource_governor.allocate("pca", "K1", min_cores=2, max_cores=6, log=quiet) as a:
+        assert a["cores"] == 6
+        with resource_governor.allocate("admixture", "K2", min_cores=1, log=quiet) as b:
+            assert b["cores"] == 2  # max_cores=None → كل الفاضي
+            assert held() == [("pca", 6), ("admixture", 2)]
+    assert held() == []
+    # طلب أكبر من الـ node بيتقص لحجمه
+    with resource_governor.allocate("big", "K3", min_cores=64, memory_mb=5000, log=quiet) as c:
+        assert c["cores"] == 8 and c["memory_mb"] == 1000
+
+
+def test_queue_is_fifo():
+    order = []
+
+    def stage(name, min_cores, memory_mb=0):
+        with resource_governor.allocate(name, name, min_cores=min_cores, max_cores=min_cores,
+                                        memory_mb=memory_mb, log=quiet):
+            order.append(name)
+
+    with resource_governor.allocate("running", "K0", min_cores=7, max_cores=7, log=quiet):
+        big = threading.Thread(target=stage, args=("big", 4))
+        big.start()
+        time.sleep(0.1)
+        # طلب صغير يقدر ياخد الـ core الفاضي بس جه ورا big في الطابور → بيستنى
+        small = threading.Thread(target=stage, args=("small", 1))
+        small.start()
+        time.sleep(0.1)
+        assert order == []
+        assert [w["stage"] for w in resource_governor.snapshot()["waiting"]] == ["big", "small"]
+    big.join(5), small.join(5)
+    assert order[0] == "big"
+    assert sorted(order) == ["big", "small"]
+    assert held() == []
+
+
+def test_memory_blocks_grant():
+    granted = threading.Event()
+
+    def stage():
+        with resource_governor.allocate("admixture", "K2", memory_mb=600, log=quiet):
+            granted.set()
+
+    with resource_governor.allocate("pca", "K1", min_cores=1, max_cores=1, memory_mb=600, log=quiet):
+        worker = threading.Thread(target=stage)
+        worker.start()
+        assert not granted.wait(0.2)
+    assert granted.wait(5)
+    worker.join(5)
+
+
+def test_dead_process_released(tmp_path):
+    dead = {"id": "x", "pid": 2 ** 22 + 12345, "stage": "pca", "kit_id": "K9", "cores": 8, "memory_mb": 0,
+            "min_cores": 1, "max_cores": None, "since": time.time(), "granted_at": time.time()}
+    (tmp_path / resource_governor.STATE_NAME).write_text(json.dumps({"allocations": [dead], "waiting": [dead]}))
+    with resource_governor.allocate("pca", "K1", log=quiet) as grant:
+        assert grant["cores"] == 8
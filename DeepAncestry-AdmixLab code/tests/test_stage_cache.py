@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""StageCache: hit لو المدخلات والبارامترات والمخرجات زي ما هي، وإعادة تنفيذ لو أي حاجة فيهم اتغيرت؛
+و StageProgress (الـ on_stage بتاعه) بأوزان الـ stages."""
+
+import pytest
+
+import process_dna
+import stage_cache
+
+
+@pytest.fixture
+def kit(tmp_path):
+    src = tmp_path / "kit.txt"
+    src.write_text("rs1\t1\t100\tAA\n")
+    return tmp_path, src
+
+
+def make_stage(tmp_path, runs):
+    def stage():
+        runs.append(1)
+        out = tmp_path / "out.bed"
+        out.write_text(f"run {len(runs)}")
+        return {"outputs": [str(out)], "value": len(runs)}
+    return stage
+
+
+def cache_for(tmp_path, events=None, **kwargs):
+    on_stage = (lambda name, event: events.append((name, event))) if events is not None else None
+    return stage_cache.StageCache(tmp_path / "kit_stages.json", log=lambda msg: None, on_stage=on_stage, **kwargs)
+
+
+def test_cache_hit_and_invalidation(kit):
+    tmp_path, src = kit
+    runs, events = [], []
+    stage = make_stage(tmp_path, runs)
+
+    assert cache_for(tmp_path, events).run("clean", stage, inputs=[src], params={"k": 1})["value"] == 1
+    # ملف الحالة بيتقرا من جديد (إعادة تشغيل الـ worker) – نفس المدخلات → من الـ cache
+    assert cache_for(tmp_path, events).run("clean", stage, inputs=[src], params={"k": 1})["value"] == 1
+    assert events == [("clean", "start"), ("clean", "done"), ("clean", "cached")]
+
+    cache_for(tmp_path).run("clean", stage, inputs=[src], params={"k": 2})
+    assert len(runs) == 2
+    src.write_text("rs1\t1\t100\tAG\nrs2\t1\t200\tCC\n")
+    cache_for(tmp_path).run("clean", stage, inputs=[src], params={"k": 2})
+    assert len(runs) == 3
+    # مخرج اتمسح أو اتعدل → الـ stage بيتعاد
+    (tmp_path / "out.bed").unlink()
+    cache_for(tmp_path).run("clean", stage, inputs=[src], params={"k": 2})
+    (tmp_path / "out.bed").write_text("edited")
+    cache_for(tmp_path).run("clean", stage, inputs=[src], params={"k": 2})
+    assert len(runs) == 5
+    cache_for(tmp_path, force=["clean"]).run("clean", stage, inputs=[src], params={"k": 2})
+    assert len(runs) == 6
+    cache_for(tmp_path).run("clean", stage, inputs=[src], params={"k": 2})
+    assert len(runs) == 6
+
+
+def test_failed_stage_resumes(kit):
+    tmp_path, src = kit
+    runs, events = [], []
+    cache = cache_for(tmp_path, events)
+    cache.run("clean", make_stage(tmp_path, runs), inputs=[src])
+
+    def broken():
+        raise RuntimeError("qpAdm died")
+
+    with pytest.raises(RuntimeError):
+        cache.run("qpadm", broken, inputs=[tmp_path / "out.bed"])
+    assert "qpAdm died" in cache_for(tmp_path).state["stages"]["qpadm"]["error"]
+
+    # إعادة التشغيل: الـ stage اللي خلص من الـ cache، واللي فشل بيتنفذ تاني
+    retry = cache_for(tmp_path, events)
+    retry.run("clean", make_stage(tmp_path, runs), inputs=[src])
+    assert retry.run("qpadm", lambda: {"outputs": []}, inputs=[tmp_path / "out.bed"]) == {"outputs": []}
+    assert len(runs) == 1
+    assert events == [("clean", "start"), ("clean", "done"), ("qpadm", "start"), ("qpadm", "failed"),
+                      ("clean", "cached"), ("qpadm", "start"), ("qpadm", "done")]
+
+
+def test_skip_needs_previous_result(kit):
+    tmp_path, src = kit
+    runs = []
+    with pytest.raises(ValueError):
+        cache_for(tmp_path, skip=["clean"]).run("clean", make_stage(tmp_path, runs), inputs=[src])
+    cache_for(tmp_path).run("clean", make_stage(tmp_path, runs), inputs=[src])
+    src.write_text("changed")
+    assert cache_for(tmp_path, skip=["clean"]).run("clean", make_stage(tmp_path, runs), inputs=[src])["value"] == 1
+    assert len(runs) == 1
+
+
+def test_corrupt_state_starts_over(kit):
+    tmp_path, src = kit
+    (tmp_path / "kit_stages.json").write_text("{not json")
+    runs = []
+    cache_for(tmp_path).run("clean", make_stage(tmp_path, runs), inputs=[src])
+    assert len(runs) == 1
+
+
+def test_stage_progress_weights(kit):
+    tmp_path, src = kit
+    plan = ["clean", "merge", "prune", "pca", "admixture"]
+    reported = []
+    tracker = process_dna.StageProgress(plan, lambda percent, stage, event: reported.append((percent, stage, event)))
+    total = sum(process_dna.STAGE_WEIGHTS[name] for name in plan)
+    runs = []
+    cache_for(tmp_path).run("clean", make_stage(tmp_path, runs), inputs=[src])
+
+    # clean من الـ cache، merge اتنفذ، prune اتخطى، pca فشل
+    cache = stage_cache.StageCache(tmp_path / "kit_stages.json", skip=["prune"], log=lambda msg: None,
+                                   on_stage=tracker)
+    cache.run("clean", make_stage(tmp_path, runs), inputs=[src])
+    cache.run("merge", lambda: {"outputs": []})
+    cache.state["stages"]["prune"] = {"result": {"outputs": []}}
+    cache.run("prune", lambda: {"outputs": []})
+
+    def broken():
+        raise RuntimeError("plink2")
+
+    with pytest.raises(RuntimeError):
+        cache.run("pca", broken)
+
+    clean, merge, prune = (process_dna.STAGE_WEIGHTS[name] for name in ("clean", "merge", "prune"))
+    assert reported == [
+        (100 * clean // total, "clean", "cached"),
+        (100 * clean // total, "merge", "start"),
+        (100 * (clean + merge) // total, "merge", "done"),
+        (100 * (clean + merge + prune) // total, "prune", "skipped"),
+        (100 * (clean + merge + prune) // total, "pca", "start"),
+        (100 * (clean + merge + prune) // total, "pca", "failed"),
+    ]
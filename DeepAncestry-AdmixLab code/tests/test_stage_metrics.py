@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""stage_metrics: record لكل stage ولكل أداة في <kit>_metrics.jsonl، و histograms الـ node بصيغة Prometheus."""
+
+import subprocess
+import sys
+
+import pytest
+
+import stage_metrics
+
+
+@pytest.fixture(autouse=True)
+def metrics_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(stage_metrics, "METRICS_DIR", tmp_path / "metrics")
+
+
+def test_stage_and_tool_records(tmp_path):
+    bim = tmp_path / "kit.bim"
+    bim.write_text("1\trs1\t0\t100\tA\tG\n1\trs2\t0\t200\tC\tT\n")
+    with stage_metrics.record_to(stage_metrics.metrics_path(tmp_path, "KIT1")):
+        with stage_metrics.measure("prune", "KIT1", threads=2) as record:
+            stage_metrics.run_tool([sys.executable, "-c", "x = bytearray(32 << 20)"])
+            record.update(stage_metrics.count_outputs([tmp_path / "missing.fam", bim]))
+        with pytest.raises(subprocess.CalledProcessError):
+            with stage_metrics.measure("pca", "KIT1"):
+                stage_metrics.run_tool([sys.executable, "-c", "raise SystemExit(3)"])
+    # برا record_to: مابيتكتبش في ملف الـ kit
+    with stage_metrics.measure("relatives", "KIT1"):
+        pass
+
+    tool, stage, failed_tool, failed_stage = stage_metrics.load_records(tmp_path, "KIT1")
+    assert (tool["type"], tool["stage"], tool["status"], tool["exit_status"]) == ("tool", "prune", "ok", 0)
+    assert tool["max_rss_bytes"] >= 32 << 20 and tool["wall_seconds"] > 0
+    assert (stage["type"], stage["stage"], stage["threads"], stage["tools"]) == ("stage", "prune", 2, 1)
+    assert stage["status"] == "ok" and stage["snps"] == 2 and "samples" not in stage
+    assert stage["max_rss_bytes"] == tool["max_rss_bytes"] and stage["child_cpu_seconds"] >= 0
+    assert (failed_tool["exit_status"], failed_tool["status"]) == (3, "failed")
+    assert failed_stage["status"] == "failed" and "exit status 3" in failed_stage["error"]
+
+
+def test_prometheus_histograms():
+    stage_metrics.observe({"type": "stage", "stage": "pca", "status": "ok", "wall_seconds": 0.3,
+                           "cpu_seconds": 0.2, "child_cpu_seconds": 1.0, "max_rss_bytes": 100})
+    stage_metrics.observe({"type": "stage", "stage": "pca", "status": "failed", "wall_seconds": 45})
+    text = stage_metrics.render_prometheus()
+    assert 'deepancestry_stage_wall_seconds_bucket{stage="pca",le="0.1"} 0' in text
+    assert 'deepancestry_stage_wall_seconds_bucket{stage="pca",le="0.5"} 1' in text
+    assert 'deepancestry_stage_wall_seconds_bucket{stage="pca",le="60"} 2' in text
+    assert 'deepancestry_stage_wall_seconds_count{stage="pca"} 2' in text
+    assert 'deepancestry_stage_wall_seconds_sum{stage="pca"} 45.3' in text
+    # CPU = الـ worker + الأدوات
+    assert 'deepancestry_stage_cpu_seconds_sum{stage="pca"} 1.2' in text
+    assert 'deepancestry_stage_runs_total{stage="pca",status="failed"} 1' in text
+    assert 'deepancestry_stage_runs_total{stage="pca",status="ok"} 1' in text